@@ -0,0 +1,71 @@
+import time
+import torch
+import flatbuffers
+
+import pyprob
+from pyprob import util
+from pyprob.remote import ModelServer
+from pyprob.ppx import Tensor as ppx_Tensor
+
+
+def variable_to_protocol_tensor_per_element(builder, variable):
+    # The previous encoder: one Prepend call per element
+    variable_numpy = util.to_numpy(variable)
+    data = variable_numpy.flatten().tolist()
+    shape = list(variable_numpy.shape)
+    ppx_Tensor.TensorStartDataVector(builder, len(data))
+    for d in reversed(data):
+        builder.PrependFloat64(d)
+    data = builder.EndVector(len(data))
+    ppx_Tensor.TensorStartShapeVector(builder, len(shape))
+    for s in reversed(shape):
+        builder.PrependInt32(s)
+    shape = builder.EndVector(len(shape))
+    ppx_Tensor.TensorStart(builder)
+    ppx_Tensor.TensorAddData(builder, data)
+    ppx_Tensor.TensorAddShape(builder, shape)
+    return ppx_Tensor.TensorEnd(builder)
+
+
+def protocol_tensor_to_variable_double_copy(protocol_tensor):
+    # The previous decoder: torch.from_numpy followed by util.to_tensor
+    data = protocol_tensor.DataAsNumpy()
+    shape = protocol_tensor.ShapeAsNumpy()
+    t = torch.from_numpy(data.copy())
+    if len(shape) != 0:
+        t = t.view(shape.tolist())
+    return util.to_tensor(t)
+
+
+def round_trip(encode, decode, variable):
+    builder = flatbuffers.Builder(64)
+    builder.Finish(encode(builder, variable))
+    message_buffer = builder.Output()
+    protocol_tensor = ppx_Tensor.Tensor.GetRootAsTensor(message_buffer, 0)
+    return decode(protocol_tensor)
+
+
+def benchmark(func, num_repeats):
+    time_start = time.time()
+    for i in range(num_repeats):
+        ret = func()
+    duration = time.time() - time_start
+    return 1e3 * duration / num_repeats, ret
+
+
+if __name__ == '__main__':
+    pyprob.set_random_seed(123)
+    # The per-element encoder is not run for larger tensors, where it takes minutes
+    max_size_per_element = 10**5
+    print('Size       | msec/round trip (per element) | msec/round trip (current) | Correct')
+    for size in [10**i for i in range(8)]:
+        variable = torch.randn(size)
+        num_repeats = max(1, min(100, 10**6 // size))
+        msec_current, ret_current = benchmark(lambda: round_trip(ModelServer._variable_to_protocol_tensor, ModelServer._protocol_tensor_to_variable, variable), num_repeats)
+        if size <= max_size_per_element:
+            msec_previous, ret_previous = benchmark(lambda: round_trip(variable_to_protocol_tensor_per_element, protocol_tensor_to_variable_double_copy, variable), num_repeats)
+            previous = '{:,.3f}'.format(msec_previous)
+        else:
+            previous = 'skipped'
+        correct = torch.equal(ret_current.view(-1), variable)
+        print('{:10,} | {:>29} | {:>25,.3f} | {}'.format(size, previous, msec_current, correct))
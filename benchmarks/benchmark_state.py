@@ -0,0 +1,51 @@
+import time
+
+import pyprob
+from pyprob import util, Model
+from pyprob.distributions import Normal, Categorical
+
+
+class NormalModel(Model):
+    def __init__(self, samples_per_trace):
+        self._samples_per_trace = samples_per_trace
+        super().__init__('Scalar Normal')
+
+    def forward(self):
+        for i in range(self._samples_per_trace):
+            pyprob.sample(Normal(0., 1.))
+        pyprob.observe(Normal(0., 1.), 0., name='obs')
+        return 0
+
+
+class CategoricalModel(Model):
+    def __init__(self, samples_per_trace):
+        self._samples_per_trace = samples_per_trace
+        super().__init__('Scalar Categorical')
+
+    def forward(self):
+        for i in range(self._samples_per_trace):
+            pyprob.sample(Categorical([0.1, 0.2, 0.7]))
+        pyprob.observe(Normal(0., 1.), 0., name='obs')
+        return 0
+
+
+def benchmark(model, num_traces, fast_inference):
+    util.set_fast_inference(fast_inference)
+    time_start = time.time()
+    traces = model.prior_traces(num_traces)
+    duration = time.time() - time_start
+    util.set_fast_inference(False)
+    num_samples = num_traces * model._samples_per_trace
+    return 1e6 * duration / num_samples, traces
+
+
+if __name__ == '__main__':
+    pyprob.set_random_seed(123)
+    pyprob.set_verbosity(1)
+    num_traces = 200
+    samples_per_trace = 50
+    print('Model              | Fast inference | usec/sample')
+    for model in [NormalModel(samples_per_trace), CategoricalModel(samples_per_trace)]:
+        for fast_inference in [False, True]:
+            usec_per_sample, _ = benchmark(model, num_traces, fast_inference)
+            print('{} | {} | {:,.2f}'.format(model.name.ljust(18), str(fast_inference).ljust(14), usec_per_sample))
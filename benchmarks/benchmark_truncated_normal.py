@@ -0,0 +1,42 @@
+import time
+import torch
+
+import pyprob
+from pyprob import util
+from pyprob.distributions import Normal, TruncatedNormal
+
+
+def sample_whole_batch_rejection(dist, max_attempts):
+    # The previous sampler: the whole batch is redrawn through the inverse cdf until no element is NaN or infinite
+    standard_normal_dist = Normal(torch.zeros_like(dist._alpha), torch.ones_like(dist._alpha))
+    cdf_alpha = standard_normal_dist.cdf(dist._alpha)
+    cdf_beta = standard_normal_dist.cdf(dist._beta)
+    for attempt in range(max_attempts):
+        ret = standard_normal_dist.icdf(cdf_alpha + torch.rand(dist._alpha.size()) * (cdf_beta - cdf_alpha)) * dist.stddev_non_truncated + dist.mean_non_truncated
+        if not util.has_nan_or_inf(ret):
+            return ret
+    return None
+
+
+def benchmark(sample_func, num_repeats):
+    sample_func()
+    time_start = time.time()
+    for i in range(num_repeats):
+        ret = sample_func()
+    duration = time.time() - time_start
+    return 1e6 * duration / num_repeats, ret
+
+
+if __name__ == '__main__':
+    pyprob.set_random_seed(123)
+    batch_size = 1024
+    num_repeats = 20
+    max_attempts = 100
+    print('Batch size: {}'.format(batch_size))
+    print('low      | high     | usec/batch (whole-batch rejection) | usec/batch (current) | mean (current)')
+    for low, high in [(-1., 1.), (-4., 4.), (2., 3.), (4., 4.5), (6., 6.0001), (10., float('inf')), (30., 30.01), (-50., -40.), (100., 101.)]:
+        dist = TruncatedNormal(torch.zeros(batch_size), torch.ones(batch_size), torch.zeros(batch_size).fill_(low), torch.zeros(batch_size).fill_(high))
+        usec_previous, ret_previous = benchmark(lambda: sample_whole_batch_rejection(dist, max_attempts), num_repeats)
+        usec_current, ret_current = benchmark(dist.sample, num_repeats)
+        previous = 'failed after {} attempts'.format(max_attempts) if ret_previous is None else '{:,.1f}'.format(usec_previous)
+        print('{:8} | {:8} | {:>34} | {:>20,.1f} | {:+.4f}'.format(low, high, previous, usec_current, float(ret_current.mean())))
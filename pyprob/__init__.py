@@ -1,6 +1,6 @@
 __version__ = '0.11.dev1'
 
-from .util import TraceMode, PriorInflation, InferenceEngine, InferenceNetwork, ObserveEmbedding, set_verbosity, set_random_seed, set_cuda
+from .util import TraceMode, PriorInflation, InferenceEngine, InferenceNetwork, ObserveEmbedding, set_verbosity, set_random_seed, set_cuda, set_fast_inference, set_trace_budget, TraceBudgetExceeded
 from .state import sample, observe
 from .model import Model, ModelRemote
 from .diagnostics import Diagnostics
@@ -11,20 +11,40 @@ from . import __version__, util, PriorInflation, InferenceEngine
 from .distributions import Empirical
 from .graph import Graph
 from .trace import Trace
+from .nn import read_metrics
 
 
-def network_statistics(inference_network, report_dir=None):
+def network_statistics(inference_network, report_dir=None, metrics_file_name=None):
+    if metrics_file_name is None:
+        history_train_loss, history_train_loss_trace = inference_network._history_train_loss, inference_network._history_train_loss_trace
+        history_valid_loss, history_valid_loss_trace = inference_network._history_valid_loss, inference_network._history_valid_loss_trace
+        history_num_params, history_num_params_trace = inference_network._history_num_params, inference_network._history_num_params_trace
+    else:
+        # Full-resolution histories from the metrics file written during training, instead of the downsampled in-memory histories
+        metrics = read_metrics(metrics_file_name)
+
+        # Rows can have empty cells, for example the rows appended by a resumed run before its first validation
+        def history(column):
+            return [v for v in metrics[column] if v is not None], [t for t, v in zip(metrics['traces'], metrics[column]) if v is not None]
+
+        history_train_loss, history_train_loss_trace = history('loss')
+        if len(history_train_loss) == 0:
+            raise RuntimeError('Metrics file has no entries: {}'.format(metrics_file_name))
+        history_valid_loss, history_valid_loss_trace = history('valid_loss')
+        if len(history_valid_loss) == 0:
+            raise RuntimeError('Metrics file has no validation entries: {}'.format(metrics_file_name))
+        history_num_params, history_num_params_trace = history('num_params')
     train_iter_per_sec = inference_network._total_train_iterations / inference_network._total_train_seconds
     train_traces_per_sec = inference_network._total_train_traces / inference_network._total_train_seconds
     train_traces_per_iter = inference_network._total_train_traces / inference_network._total_train_iterations
-    train_loss_initial = inference_network._history_train_loss[0]
-    train_loss_final = inference_network._history_train_loss[-1]
+    train_loss_initial = history_train_loss[0]
+    train_loss_final = history_train_loss[-1]
     train_loss_change = train_loss_final - train_loss_initial
     train_loss_change_per_sec = train_loss_change / inference_network._total_train_seconds
     train_loss_change_per_iter = train_loss_change / inference_network._total_train_iterations
     train_loss_change_per_trace = train_loss_change / inference_network._total_train_traces
-    valid_loss_initial = inference_network._history_valid_loss[0]
-    valid_loss_final = inference_network._history_valid_loss[-1]
+    valid_loss_initial = history_valid_loss[0]
+    valid_loss_final = history_valid_loss[-1]
     valid_loss_change = valid_loss_final - valid_loss_initial
     valid_loss_change_per_sec = valid_loss_change / inference_network._total_train_seconds
     valid_loss_change_per_iter = valid_loss_change / inference_network._total_train_iterations
@@ -53,6 +73,12 @@ def network_statistics(inference_network, report_dir=None):
     stats['valid_loss_change_per_sec'] = valid_loss_change_per_sec
     stats['valid_loss_change_per_iter'] = valid_loss_change_per_iter
     stats['valid_loss_change_per_trace'] = valid_loss_change_per_trace
+    if metrics_file_name is not None:
+        stats['metrics_file_name'] = metrics_file_name
+        batch_wait_sec = history('batch_wait_sec')[0]
+        sub_batch_size_mean = history('sub_batch_size_mean')[0]
+        stats['batch_wait_sec_total'] = sum(batch_wait_sec)
+        stats['sub_batch_size_mean'] = sum(sub_batch_size_mean) / len(sub_batch_size_mean) if len(sub_batch_size_mean) > 0 else None
 
     if report_dir is not None:
         if not os.path.exists(report_dir):
@@ -74,8 +100,8 @@ def network_statistics(inference_network, report_dir=None):
         print('Plotting loss to file: {} ...'.format(file_name_loss))
         fig = plt.figure(figsize=(10, 7))
         ax = plt.subplot(111)
-        ax.plot(inference_network._history_train_loss_trace, inference_network._history_train_loss, label='Training')
-        ax.plot(inference_network._history_valid_loss_trace, inference_network._history_valid_loss, label='Validation')
+        ax.plot(history_train_loss_trace, history_train_loss, label='Training')
+        ax.plot(history_valid_loss_trace, history_valid_loss, label='Validation')
         ax.legend()
         plt.xlabel('Training traces')
         plt.ylabel('Loss')
@@ -87,7 +113,7 @@ def network_statistics(inference_network, report_dir=None):
         print('Plotting number of parameters to file: {} ...'.format(file_name_num_params))
         fig = plt.figure(figsize=(10, 7))
         ax = plt.subplot(111)
-        ax.plot(inference_network._history_num_params_trace, inference_network._history_num_params, label='Training')
+        ax.plot(history_num_params_trace, history_num_params, label='Training')
         plt.xlabel('Training traces')
         plt.ylabel('Number of parameters')
         plt.grid()
@@ -405,10 +431,10 @@ class Diagnostics():
     def __init__(self, model):
         self._model = model
 
-    def inference_network(self, report_dir=None):
+    def inference_network(self, report_dir=None, metrics_file_name=None):
         if self._model._inference_network is None:
             raise RuntimeError('The model does not have a trained inference network. Use learn_inference_network first.')
-        return network_statistics(self._model._inference_network, report_dir)
+        return network_statistics(self._model._inference_network, report_dir, metrics_file_name)
 
     def prior_graph(self, num_traces=1000, prior_inflation=PriorInflation.DISABLED, use_address_base=True, bins=100, log_xscale=False, log_yscale=False, n_most_frequent=None, base_graph=None, report_dir=None, *args, **kwargs):
         trace_dist = self._model.prior_traces(num_traces=num_traces, prior_inflation=prior_inflation, *args, **kwargs)
@@ -7,3 +7,5 @@ from .poisson import Poisson
 from .beta import Beta
 from .mixture import Mixture
 from .truncated_normal import TruncatedNormal
+from .normal_mixture import NormalMixture
+from .truncated_normal_mixture import TruncatedNormalMixture
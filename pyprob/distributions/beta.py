@@ -6,11 +6,11 @@ from .. import util
 
 class Beta(Distribution):
     def __init__(self, concentration1, concentration0, low=0, high=1):
-        concentration1 = util.to_tensor(concentration1)
-        concentration0 = util.to_tensor(concentration0)
+        concentration1 = util._as_tensor(concentration1)
+        concentration0 = util._as_tensor(concentration0)
         super().__init__(name='Beta', address_suffix='Beta', torch_dist=torch.distributions.Beta(concentration1, concentration0))
-        self._low = util.to_tensor(low)
-        self._high = util.to_tensor(high)
+        self._low = util._as_tensor(low)
+        self._high = util._as_tensor(high)
         self._range = self._high - self._low
 
     def __repr__(self):
@@ -1,4 +1,9 @@
 import torch
+import numpy as np
+import math
+import random
+import bisect
+import itertools
 
 from . import Distribution
 from .. import util
@@ -6,31 +11,118 @@ from .. import util
 
 class Categorical(Distribution):
     def __init__(self, probs=None, logits=None):
-        if probs is not None:
-            probs = util.to_tensor(probs)
-            if probs.dim() == 0:
-                raise ValueError('probs cannot be a scalar.')
-        if logits is not None:
-            logits = util.to_tensor(logits)
-            if logits.dim() == 0:
-                raise ValueError('logits cannot be a scalar.')
-        torch_dist = torch.distributions.Categorical(probs=probs, logits=logits)
-        self._probs = torch_dist.probs
-        self._logits = torch_dist.logits
-        self._num_categories = self._probs.size(-1)
-        super().__init__(name='Categorical', address_suffix='Categorical(len_probs:{})'.format(self._probs.size(-1)), torch_dist=torch_dist)
+        params = probs if probs is not None else logits
+        params_list = Categorical._to_scalar_list(params)
+        if params_list is not None and not Categorical._valid_scalar_params(params_list, probs is not None):
+            # Invalid parameters take the torch path, whose argument validation raises
+            params_list = None
+        if params_list is not None:
+            # Scalar fast path: sample and log_prob use Python math and random, the probs/logits tensors and the torch distribution are only constructed when needed
+            if probs is not None:
+                total = math.fsum(params_list)
+                self._probs_list = [p / total for p in params_list]
+            else:
+                max_logit = max(params_list)
+                exps = [math.exp(l - max_logit) for l in params_list]
+                total = math.fsum(exps)
+                self._probs_list = [e / total for e in exps]
+            self._probs_cumsum = list(itertools.accumulate(self._probs_list))
+            self._probs = None
+            self._logits = None
+            self._num_categories = len(self._probs_list)
+            super().__init__(name='Categorical', address_suffix='Categorical(len_probs:{})'.format(self._num_categories))
+        else:
+            self._probs_list = None
+            if probs is not None:
+                probs = util._as_tensor(probs)
+                if probs.dim() == 0:
+                    raise ValueError('probs cannot be a scalar.')
+            if logits is not None:
+                logits = util._as_tensor(logits)
+                if logits.dim() == 0:
+                    raise ValueError('logits cannot be a scalar.')
+            torch_dist = torch.distributions.Categorical(probs=probs, logits=logits)
+            self._probs = torch_dist.probs
+            self._logits = torch_dist.logits
+            self._num_categories = self._probs.size(-1)
+            super().__init__(name='Categorical', address_suffix='Categorical(len_probs:{})'.format(self._probs.size(-1)), torch_dist=torch_dist)
 
     def __repr__(self):
         return 'Categorical(num_categories: {}, probs:{})'.format(self.num_categories, self.probs)
 
+    def __setstate__(self, state):
+        # Pickled before the scalar fast path, the probabilities are only in the torch distribution
+        state.setdefault('_probs_list', None)
+        self.__dict__.update(state)
+
+    @staticmethod
+    def _to_scalar_list(params):
+        # Returns params as a list of floats when they are a 1d sequence of numbers, otherwise None
+        if torch.is_tensor(params):
+            if params.dim() != 1 or params.requires_grad:
+                return None
+            return params.tolist()
+        elif isinstance(params, np.ndarray):
+            if params.ndim != 1:
+                return None
+            return params.tolist()
+        elif isinstance(params, (list, tuple)):
+            if len(params) == 0 or not all(isinstance(p, (int, float, np.number)) for p in params):
+                return None
+            return [float(p) for p in params]
+        else:
+            return None
+
+    @staticmethod
+    def _valid_scalar_params(params_list, is_probs):
+        # Probabilities must be non-negative with a positive finite sum, logits must not be NaN and their maximum must be finite
+        if is_probs:
+            total = math.fsum(params_list)
+            return all(p >= 0 for p in params_list) and 0 < total < float('inf')
+        else:
+            return all(l == l for l in params_list) and math.isfinite(max(params_list))
+
+    def _get_torch_dist(self):
+        if self._torch_dist is None:
+            self._torch_dist = torch.distributions.Categorical(probs=util.to_tensor(self._probs_list))
+        return self._torch_dist
+
+    def sample(self):
+        if self._probs_list is None:
+            return super().sample()
+        i = min(bisect.bisect_right(self._probs_cumsum, random.random()), self._num_categories - 1)
+        return util.to_tensor(i, dtype=torch.long)
+
+    def log_prob(self, value, sum=False):
+        if self._probs_list is None:
+            return super().log_prob(value, sum)
+        if util.is_scalar(value) and float(value).is_integer() and 0 <= float(value) < self._num_categories:
+            # Values outside the support are left to the torch distribution, which rejects them
+            p = self._probs_list[int(value)]
+            return util.to_tensor(math.log(p) if p > 0 else float('-inf'))
+        lp = self._get_torch_dist().log_prob(util.to_tensor(value))
+        return torch.sum(lp) if sum else lp
+
+    @property
+    def mean(self):
+        return self._get_torch_dist().mean
+
+    @property
+    def variance(self):
+        return self._get_torch_dist().variance
+
     @property
     def num_categories(self):
         return self._num_categories
 
     @property
     def probs(self):
+        if self._probs is None:
+            self._probs = self._get_torch_dist().probs
         return self._probs
 
     @property
     def logits(self):
+        if self._logits is None:
+            self._logits = self._get_torch_dist().logits
         return self._logits
@@ -71,11 +71,17 @@ class Distribution():
     def expectation(self, func):
         raise NotImplementedError()
 
+    def _get_torch_dist(self):
+        # Distributions with a scalar fast path override this to construct their torch distribution on demand
+        return self._torch_dist
+
     @staticmethod
     def kl_divergence(distribution_1, distribution_2):
-        if distribution_1._torch_dist is None or distribution_2._torch_dist is None:
+        torch_dist_1 = distribution_1._get_torch_dist()
+        torch_dist_2 = distribution_2._get_torch_dist()
+        if torch_dist_1 is None or torch_dist_2 is None:
             raise ValueError('KL divergence is not currently supported for this pair of distributions.')
-        return torch.distributions.kl.kl_divergence(distribution_1._torch_dist, distribution_2._torch_dist)
+        return torch.distributions.kl.kl_divergence(torch_dist_1, torch_dist_2)
 
     def save(self, file_name):
         data = {}
@@ -103,7 +109,7 @@ class Distribution():
             tmp_file = os.path.join(tmp_dir, 'pyprob_distribution')
             tar.extract('pyprob_distribution', tmp_dir)
             tar.close()
-            data = torch.load(tmp_file, map_location=torch.device('cpu'))
+            data = util.torch_load(tmp_file, map_location=torch.device('cpu'))
             shutil.rmtree(tmp_dir)
         except Exception as e:
             raise RuntimeError('Cannot load distribution. {}'.format(traceback.format_exc()))
@@ -11,7 +11,7 @@ class Mixture(Distribution):
         if probs is None:
             self._probs = util.to_tensor(torch.zeros(self.length)).fill_(1./self.length)
         else:
-            self._probs = util.to_tensor(probs)
+            self._probs = util._as_tensor(probs)
             self._probs = self._probs / self._probs.sum(-1, keepdim=True)
         self._log_probs = torch.log(self._probs)
 
@@ -76,3 +76,49 @@ class Mixture(Distribution):
             else:
                 self._variance = torch.diag(torch.mm(self._probs, variances))
         return self._variance
+
+
+# Base for mixtures whose K components are held in a single distribution with [batch_size, K] parameters, so that log_prob is one logsumexp and sample is one gather instead of a loop over component distributions
+class _ComponentMixture(Distribution):
+    def __init__(self, name, components, probs, batch_length):
+        self._components = components
+        self._batch_length = batch_length
+        self._probs = util._as_tensor(probs).view(self._components_shape)
+        self._probs = self._probs / self._probs.sum(-1, keepdim=True)
+        self._log_probs = torch.log(self._probs)
+        self._mean = None
+        self._variance = None
+        batch_shape = torch.Size() if batch_length == 0 else torch.Size([batch_length])
+        super().__init__(name=name, address_suffix=name, batch_shape=batch_shape, event_shape=torch.Size())
+
+    def __len__(self):
+        return self._components_shape[1]
+
+    def _gathered_components(self, indices):
+        raise NotImplementedError()
+
+    def _squeeze(self, value):
+        return value.squeeze(0) if self._batch_length == 0 else value
+
+    def log_prob(self, value, sum=False):
+        value = util.to_tensor(value).view(-1, 1)
+        lp = self._squeeze(torch.logsumexp(self._log_probs + self._components.log_prob(value).view(self._components_shape), dim=1))
+        return torch.sum(lp) if sum else lp
+
+    def sample(self):
+        indices = torch.multinomial(self._probs, 1)
+        return self._squeeze(self._gathered_components(indices).sample().view(-1))
+
+    @property
+    def mean(self):
+        if self._mean is None:
+            self._mean = self._squeeze((self._probs * self._components.mean.view(self._components_shape)).sum(1))
+        return self._mean
+
+    @property
+    def variance(self):
+        if self._variance is None:
+            means = self._components.mean.view(self._components_shape)
+            mean = (self._probs * means).sum(1, keepdim=True)
+            self._variance = self._squeeze((self._probs * ((means - mean).pow(2) + self._components.variance.view(self._components_shape))).sum(1))
+        return self._variance
@@ -1,20 +1,77 @@
 import torch
+import math
+import random
 
 from . import Distribution
 from .. import util
 
 
+_log_sqrt_2pi = 0.5 * math.log(2 * math.pi)
+
+
 class Normal(Distribution):
     def __init__(self, loc, scale):
-        loc = util.to_tensor(loc)
-        scale = util.to_tensor(scale)
-        super().__init__(name='Normal', address_suffix='Normal', torch_dist=torch.distributions.Normal(loc, scale))
+        if util.is_scalar(loc) and util.is_scalar(scale) and math.isfinite(float(loc)) and math.isfinite(float(scale)) and float(scale) > 0:
+            # Scalar fast path: sample and log_prob use Python math and the torch distribution is only constructed when needed
+            # Invalid parameters take the torch path, whose argument validation raises
+            self._loc_scalar = float(loc)
+            self._scale_scalar = float(scale)
+            super().__init__(name='Normal', address_suffix='Normal')
+        else:
+            self._loc_scalar = None
+            self._scale_scalar = None
+            loc = util._as_tensor(loc)
+            scale = util._as_tensor(scale)
+            super().__init__(name='Normal', address_suffix='Normal', torch_dist=torch.distributions.Normal(loc, scale))
 
     def __repr__(self):
         return 'Normal(mean:{}, stddev:{})'.format(self.mean, self.stddev)
 
+    def __setstate__(self, state):
+        # Distributions pickled before the scalar fast path have no scalar parameters and use their torch distribution
+        state.setdefault('_loc_scalar', None)
+        state.setdefault('_scale_scalar', None)
+        self.__dict__.update(state)
+
+    def _get_torch_dist(self):
+        if self._torch_dist is None:
+            self._torch_dist = torch.distributions.Normal(util.to_tensor(self._loc_scalar), util.to_tensor(self._scale_scalar))
+        return self._torch_dist
+
+    def sample(self):
+        if self._loc_scalar is None:
+            return super().sample()
+        # random.gauss is not thread-safe, batches can be prefetched in threads
+        return util.to_tensor(random.normalvariate(self._loc_scalar, self._scale_scalar))
+
+    def log_prob(self, value, sum=False):
+        if self._loc_scalar is None:
+            return super().log_prob(value, sum)
+        if util.is_scalar(value):
+            return util.to_tensor(-((float(value) - self._loc_scalar) ** 2) / (2 * self._scale_scalar ** 2) - math.log(self._scale_scalar) - _log_sqrt_2pi)
+        lp = -((util.to_tensor(value) - self._loc_scalar) ** 2) / (2 * self._scale_scalar ** 2) - math.log(self._scale_scalar) - _log_sqrt_2pi
+        return torch.sum(lp) if sum else lp
+
+    @property
+    def mean(self):
+        if self._loc_scalar is None:
+            return super().mean
+        return util.to_tensor(self._loc_scalar)
+
+    @property
+    def variance(self):
+        if self._loc_scalar is None:
+            return super().variance
+        return util.to_tensor(self._scale_scalar ** 2)
+
+    @property
+    def stddev(self):
+        if self._loc_scalar is None:
+            return super().stddev
+        return util.to_tensor(self._scale_scalar)
+
     def cdf(self, value):
-        return self._torch_dist.cdf(value)
+        return self._get_torch_dist().cdf(value)
 
     def icdf(self, value):
-        return self._torch_dist.icdf(value)
+        return self._get_torch_dist().icdf(value)
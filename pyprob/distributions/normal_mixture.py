@@ -0,0 +1,27 @@
+import torch
+
+from . import Normal
+from .mixture import _ComponentMixture
+from .. import util
+
+
+class NormalMixture(_ComponentMixture):
+    def __init__(self, means, stddevs, probs):
+        means = util._as_tensor(means)
+        stddevs = util._as_tensor(stddevs)
+        if means.dim() == 1:
+            batch_length = 0
+        elif means.dim() == 2:
+            batch_length = means.size(0)
+        else:
+            raise ValueError('Expecting 1d or 2d (batched) mixture parameters.')
+        self._components_shape = torch.Size([max(batch_length, 1), means.size(-1)])
+        self._means = means.view(self._components_shape)
+        self._stddevs = stddevs.view(self._components_shape)
+        super().__init__(name='NormalMixture', components=Normal(self._means, self._stddevs), probs=probs, batch_length=batch_length)
+
+    def __repr__(self):
+        return 'NormalMixture(means:{}, stddevs:{}, probs:{})'.format(self._means, self._stddevs, self._probs)
+
+    def _gathered_components(self, indices):
+        return Normal(self._means.gather(1, indices), self._stddevs.gather(1, indices))
@@ -1,4 +1,6 @@
 import torch
+import numpy as np
+import math
 
 from . import Distribution
 from .. import util
@@ -6,12 +8,62 @@ from .. import util
 
 class Poisson(Distribution):
     def __init__(self, rate):
-        rate = util.to_tensor(rate)
-        super().__init__(name='Poisson', address_suffix='Poisson', torch_dist=torch.distributions.Poisson(rate))
+        if util.is_scalar(rate) and float(rate) > 0:
+            # Scalar fast path: sample and log_prob use NumPy and Python math and the torch distribution is only constructed when needed
+            # Invalid parameters take the torch path, whose argument validation raises
+            self._rate_scalar = float(rate)
+            super().__init__(name='Poisson', address_suffix='Poisson')
+        else:
+            self._rate_scalar = None
+            rate = util._as_tensor(rate)
+            super().__init__(name='Poisson', address_suffix='Poisson', torch_dist=torch.distributions.Poisson(rate))
 
     def __repr__(self):
         return 'Poisson(rate: {})'.format(self.rate)
 
+    def __setstate__(self, state):
+        # Pickled before the scalar fast path, the rate is only in the torch distribution
+        state.setdefault('_rate_scalar', None)
+        self.__dict__.update(state)
+
+    def _get_torch_dist(self):
+        if self._torch_dist is None:
+            self._torch_dist = torch.distributions.Poisson(util.to_tensor(self._rate_scalar))
+        return self._torch_dist
+
+    def sample(self):
+        if self._rate_scalar is None:
+            return super().sample()
+        return util.to_tensor(float(np.random.poisson(self._rate_scalar)))
+
+    def log_prob(self, value, sum=False):
+        if self._rate_scalar is None:
+            return super().log_prob(value, sum)
+        # Values outside the support (negative or non-integer counts) are left to the torch distribution, which rejects them
+        if util.is_scalar(value):
+            value = float(value)
+            if value >= 0 and value.is_integer():
+                return util.to_tensor(value * math.log(self._rate_scalar) - self._rate_scalar - math.lgamma(value + 1))
+            return self._get_torch_dist().log_prob(util.to_tensor(value))
+        value = util.to_tensor(value)
+        if bool(value.ge(0).all()) and bool(value.eq(value.floor()).all()):
+            lp = value * math.log(self._rate_scalar) - self._rate_scalar - torch.lgamma(value + 1)
+        else:
+            lp = self._get_torch_dist().log_prob(value)
+        return torch.sum(lp) if sum else lp
+
+    @property
+    def mean(self):
+        if self._rate_scalar is None:
+            return super().mean
+        return util.to_tensor(self._rate_scalar)
+
+    @property
+    def variance(self):
+        if self._rate_scalar is None:
+            return super().variance
+        return util.to_tensor(self._rate_scalar)
+
     @property
     def rate(self):
-        return self._torch_dist.mean
+        return self.mean
@@ -1,16 +1,74 @@
 import torch
+from termcolor import colored
 
 from . import Distribution, Normal
 from .. import util
 
 
+# Standardized truncation intervals [alpha, beta] starting below this point are sampled by inversion, intervals further in the tail by rejection
+_tail_threshold = 5.
+
+
+def _log_normal_interval_prob(alpha, beta):
+    # log(Phi(beta) - Phi(alpha)) computed from log cdfs on the side of zero where the interval lies, so that it stays finite deep in the tails
+    flip = (alpha + beta) > 0
+    a = torch.where(flip, -beta, alpha)
+    b = torch.where(flip, -alpha, beta)
+    log_cdf_a = torch.special.log_ndtr(a)
+    log_cdf_b = torch.special.log_ndtr(b)
+    return log_cdf_b + torch.log1p(-torch.exp(log_cdf_a - log_cdf_b))
+
+
+def _sample_standard_truncated_normal(alpha, beta):
+    # Exact sampler for the standard normal truncated to [alpha, beta], intervals are reflected so that they never lie mostly below zero
+    shape = torch.broadcast_shapes(alpha.size(), beta.size())
+    alpha = alpha.double().expand(shape).reshape(-1)
+    beta = beta.double().expand(shape).reshape(-1)
+    flip = (alpha + beta) < 0
+    a = torch.where(flip, -beta, alpha)
+    b = torch.where(flip, -alpha, beta)
+    ret = torch.zeros_like(a)
+
+    # Inversion of the upper tail probabilities in float64, which is accurate for these intervals
+    inversion = a < _tail_threshold
+    q_a = torch.special.ndtr(-a[inversion])
+    q_b = torch.special.ndtr(-b[inversion])
+    ret[inversion] = -torch.special.ndtri(q_b + torch.rand_like(q_a) * (q_a - q_b))
+
+    # Rejection for the intervals in the tail (Robert, 1995), only the rejected elements are redrawn
+    pending = torch.nonzero(~inversion).view(-1)
+    attempt_count = 0
+    while pending.numel() > 0:
+        attempt_count += 1
+        util.check_trace_deadline()
+        if attempt_count == 10000:
+            print(colored('Warning: truncated normal rejection sampler did not finish after {} attempts for {} element(s)'.format(attempt_count, pending.numel()), 'red', attrs=['bold']))
+        a_pending = a[pending]
+        b_pending = b[pending]
+        # Translated exponential proposal with the optimal rate, accepted with probability exp(-(x - rate)^2 / 2)
+        rate = (a_pending + torch.sqrt(a_pending * a_pending + 4)) / 2
+        x_exponential = a_pending - torch.log1p(-torch.rand_like(a_pending)) / rate
+        accept_exponential = (x_exponential <= b_pending) & (torch.rand_like(a_pending) <= torch.exp(-0.5 * (x_exponential - rate).pow(2)))
+        # Narrow intervals use a uniform proposal instead, accepted with probability exp((a^2 - x^2) / 2)
+        x_uniform = a_pending + (b_pending - a_pending) * torch.rand_like(a_pending)
+        accept_uniform = torch.rand_like(a_pending) <= torch.exp(0.5 * (a_pending - x_uniform) * (a_pending + x_uniform))
+        exponential = (b_pending - a_pending) * a_pending >= 1
+        x = torch.where(exponential, x_exponential, x_uniform)
+        accepted = torch.where(exponential, accept_exponential, accept_uniform)
+        ret[pending[accepted]] = x[accepted]
+        pending = pending[~accepted]
+
+    ret = torch.where(flip, -ret, ret)
+    return ret.view(shape)
+
+
 # Beware: clamp_mean_between_low_high=True prevents derivative computation with respect to mean when it's outside [low, high]
 class TruncatedNormal(Distribution):
     def __init__(self, mean_non_truncated, stddev_non_truncated, low, high, clamp_mean_between_low_high=False):
-        self._mean_non_truncated = util.to_tensor(mean_non_truncated)
-        self._stddev_non_truncated = util.to_tensor(stddev_non_truncated)
-        self._low = util.to_tensor(low)
-        self._high = util.to_tensor(high)
+        self._mean_non_truncated = util._as_tensor(mean_non_truncated)
+        self._stddev_non_truncated = util._as_tensor(stddev_non_truncated)
+        self._low = util._as_tensor(low)
+        self._high = util._as_tensor(high)
         if clamp_mean_between_low_high:
             self._mean_non_truncated = torch.max(torch.min(self._mean_non_truncated, self._high), self._low)
         if self._mean_non_truncated.dim() == 0:
@@ -33,7 +91,7 @@ class TruncatedNormal(Distribution):
         self._standard_normal_cdf_alpha = self._standard_normal_dist.cdf(self._alpha)
         self._standard_normal_cdf_beta = self._standard_normal_dist.cdf(self._beta)
         self._Z = self._standard_normal_cdf_beta - self._standard_normal_cdf_alpha
-        self._log_stddev_Z = torch.log(self._stddev_non_truncated * self._Z)
+        self._log_stddev_Z = torch.log(self._stddev_non_truncated) + _log_normal_interval_prob(self._alpha, self._beta)
         self._mean = None
         self._variance = None
         batch_shape = self._mean_non_truncated.size()
@@ -93,20 +151,11 @@ class TruncatedNormal(Distribution):
         return self._variance
 
     def sample(self):
-        shape = self._low.size()
-        attempt_count = 0
-        ret = torch.zeros(shape).fill_(float('NaN'))
-        outside_domain = True
-        while util.has_nan_or_inf(ret) or outside_domain:
-            attempt_count += 1
-            if (attempt_count == 10000):
-                print('Warning: trying to sample from the tail of a truncated normal distribution, which can take a long time. A more efficient implementation is pending.')
-            rand = torch.zeros(shape).uniform_()
-            ret = self._standard_normal_dist.icdf(self._standard_normal_cdf_alpha + rand * (self._standard_normal_cdf_beta - self._standard_normal_cdf_alpha)) * self._stddev_non_truncated + self._mean_non_truncated
-            lb = ret.ge(self._low).type_as(self._low)
-            ub = ret.lt(self._high).type_as(self._low)
-            outside_domain = (int(torch.sum(lb.mul(ub))) == 0)
-
+        with torch.no_grad():
+            z = _sample_standard_truncated_normal(self._alpha, self._beta).type_as(self._mean_non_truncated)
+        ret = z * self._stddev_non_truncated + self._mean_non_truncated
+        # Guards against rounding outside the domain when mapping back from the standardized interval
+        ret = torch.max(torch.min(ret, self._high), self._low)
         if self._batch_length == 1:
             ret = ret.squeeze(0)
         return ret
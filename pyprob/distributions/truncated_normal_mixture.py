@@ -0,0 +1,38 @@
+import torch
+
+from . import TruncatedNormal
+from .mixture import _ComponentMixture
+from .. import util
+
+
+class TruncatedNormalMixture(_ComponentMixture):
+    def __init__(self, means_non_truncated, stddevs_non_truncated, low, high, probs):
+        means_non_truncated = util._as_tensor(means_non_truncated)
+        stddevs_non_truncated = util._as_tensor(stddevs_non_truncated)
+        if means_non_truncated.dim() == 1:
+            batch_length = 0
+        elif means_non_truncated.dim() == 2:
+            batch_length = means_non_truncated.size(0)
+        else:
+            raise ValueError('Expecting 1d or 2d (batched) mixture parameters.')
+        self._components_shape = torch.Size([max(batch_length, 1), means_non_truncated.size(-1)])
+        self._means_non_truncated = means_non_truncated.view(self._components_shape)
+        self._stddevs_non_truncated = stddevs_non_truncated.view(self._components_shape)
+        # low and high are shared by the components, one per batch element
+        self._low = util._as_tensor(low).view(-1, 1).expand(self._components_shape[0], 1)
+        self._high = util._as_tensor(high).view(-1, 1).expand(self._components_shape[0], 1)
+        super().__init__(name='TruncatedNormalMixture', components=TruncatedNormal(self._means_non_truncated, self._stddevs_non_truncated, self._low, self._high), probs=probs, batch_length=batch_length)
+
+    def __repr__(self):
+        return 'TruncatedNormalMixture(means_non_truncated:{}, stddevs_non_truncated:{}, low:{}, high:{}, probs:{})'.format(self._means_non_truncated, self._stddevs_non_truncated, self._low, self._high, self._probs)
+
+    @property
+    def low(self):
+        return self._squeeze(self._low.view(-1))
+
+    @property
+    def high(self):
+        return self._squeeze(self._high.view(-1))
+
+    def _gathered_components(self, indices):
+        return TruncatedNormal(self._means_non_truncated.gather(1, indices), self._stddevs_non_truncated.gather(1, indices), self._low, self._high)
@@ -1,4 +1,6 @@
 import torch
+import math
+import random
 
 from . import Distribution
 from .. import util
@@ -6,17 +8,74 @@ from .. import util
 
 class Uniform(Distribution):
     def __init__(self, low, high):
-        low = util.to_tensor(low)
-        high = util.to_tensor(high)
-        super().__init__(name='Uniform', address_suffix='Uniform', torch_dist=torch.distributions.Uniform(low, high))
+        if util.is_scalar(low) and util.is_scalar(high) and float(low) < float(high):
+            # Scalar fast path: sample and log_prob use Python math and the torch distribution is only constructed when needed
+            # Invalid parameters take the torch path, whose argument validation raises
+            self._low_scalar = float(low)
+            self._high_scalar = float(high)
+            super().__init__(name='Uniform', address_suffix='Uniform')
+        else:
+            self._low_scalar = None
+            self._high_scalar = None
+            low = util._as_tensor(low)
+            high = util._as_tensor(high)
+            super().__init__(name='Uniform', address_suffix='Uniform', torch_dist=torch.distributions.Uniform(low, high))
 
     def __repr__(self):
         return 'Uniform(lwo: {}, high: {})'.format(self.low, self.high)
 
+    def __setstate__(self, state):
+        # Pickled before the scalar fast path, low and high are only in the torch distribution
+        state.setdefault('_low_scalar', None)
+        state.setdefault('_high_scalar', None)
+        self.__dict__.update(state)
+
+    def _get_torch_dist(self):
+        if self._torch_dist is None:
+            self._torch_dist = torch.distributions.Uniform(util.to_tensor(self._low_scalar), util.to_tensor(self._high_scalar))
+        return self._torch_dist
+
+    def sample(self):
+        if self._low_scalar is None:
+            return super().sample()
+        return util.to_tensor(self._low_scalar + (self._high_scalar - self._low_scalar) * random.random())
+
+    def log_prob(self, value, sum=False):
+        if self._low_scalar is None:
+            return super().log_prob(value, sum)
+        # Values outside the support of torch.distributions.Uniform, low <= value < high, are left to the torch distribution, which rejects them
+        if util.is_scalar(value):
+            value = float(value)
+            if self._low_scalar <= value < self._high_scalar:
+                return util.to_tensor(-math.log(self._high_scalar - self._low_scalar))
+            return self._get_torch_dist().log_prob(util.to_tensor(value))
+        value = util.to_tensor(value)
+        if bool(value.ge(self._low_scalar).all()) and bool(value.lt(self._high_scalar).all()):
+            lp = torch.full_like(value, -math.log(self._high_scalar - self._low_scalar))
+        else:
+            lp = self._get_torch_dist().log_prob(value)
+        return torch.sum(lp) if sum else lp
+
+    @property
+    def mean(self):
+        if self._low_scalar is None:
+            return super().mean
+        return util.to_tensor((self._low_scalar + self._high_scalar) / 2)
+
+    @property
+    def variance(self):
+        if self._low_scalar is None:
+            return super().variance
+        return util.to_tensor((self._high_scalar - self._low_scalar) ** 2 / 12)
+
     @property
     def low(self):
-        return self._torch_dist.low
+        if self._low_scalar is None:
+            return self._torch_dist.low
+        return util.to_tensor(self._low_scalar)
 
     @property
     def high(self):
-        return self._torch_dist.high
+        if self._low_scalar is None:
+            return self._torch_dist.high
+        return util.to_tensor(self._high_scalar)
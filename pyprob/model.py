@@ -1,5 +1,6 @@
 import torch
 import time
+import asyncio
 import sys
 import os
 import math
@@ -8,8 +9,13 @@ from termcolor import colored
 
 from .distributions import Empirical
 from . import util, state, TraceMode, PriorInflation, InferenceEngine, InferenceNetwork
-from .nn import BatchGenerator, InferenceNetworkFeedForward
-from .remote import ModelServer
+from .nn import Batch, BatchGenerator, InferenceNetworkFeedForward
+from .remote import ModelServer, SimulatorPool
+
+
+def _check_consecutive_rejections(num_consecutive_rejections, exception):
+    if num_consecutive_rejections >= util._trace_max_consecutive_rejections:
+        raise RuntimeError('{:,} consecutive traces exceeded their budget and were rejected, the trace budget (see set_trace_budget) is likely too small for this model. Last rejection: {}'.format(num_consecutive_rejections, exception))
 
 
 class Model():
@@ -17,21 +23,38 @@ class Model():
         super().__init__()
         self.name = name
         self._inference_network = None
+        self._num_traces_rejected = 0
+        self._vectorized = None
+        self._vectorized_addresses = None
+        self._vectorized_value_shapes = None
 
     def forward(self):
         raise NotImplementedError()
 
-    def _trace_generator(self, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, observe=None, metropolis_hastings_trace=None, *args, **kwargs):
+    # num_traces: the number of traces that will be taken from the generator, if known
+    def _trace_generator(self, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, observe=None, metropolis_hastings_trace=None, num_traces=None, *args, **kwargs):
+        num_consecutive_rejections = 0
         while True:
-            state.begin_trace(self.forward, trace_mode, prior_inflation, inference_engine, inference_network, observe, metropolis_hastings_trace)
-            result = self.forward(*args, **kwargs)
-            trace = state.end_trace(result)
+            with util._fast_inference_grad_mode():
+                state.begin_trace(self.forward, trace_mode, prior_inflation, inference_engine, inference_network, observe, metropolis_hastings_trace)
+                try:
+                    result = self.forward(*args, **kwargs)
+                except util.TraceBudgetExceeded as e:
+                    # Over-budget traces are rejected and replaced by a new trace
+                    state.abort_trace()
+                    self._num_traces_rejected += 1
+                    num_consecutive_rejections += 1
+                    _check_consecutive_rejections(num_consecutive_rejections, e)
+                    continue
+                trace = state.end_trace(result)
+            num_consecutive_rejections = 0
             yield trace
 
     def _traces(self, num_traces=10, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, map_func=None, silent=False, observe=None, file_name=None, *args, **kwargs):
-        generator = self._trace_generator(trace_mode=trace_mode, prior_inflation=prior_inflation, inference_engine=inference_engine, inference_network=inference_network, observe=observe, *args, **kwargs)
+        generator = self._trace_generator(trace_mode=trace_mode, prior_inflation=prior_inflation, inference_engine=inference_engine, inference_network=inference_network, observe=observe, num_traces=num_traces, *args, **kwargs)
         traces = Empirical(file_name=file_name)
         time_start = time.time()
+        num_traces_rejected_start = self._num_traces_rejected
         if (util._verbosity > 1) and not silent:
             len_str_num_traces = len(str(num_traces))
             print('Time spent  | Time remain.| Progress             | {} | Traces/sec'.format('Trace'.ljust(len_str_num_traces * 2 + 1)))
@@ -54,9 +77,74 @@ class Model():
             traces.add(trace, log_weight)
         if (util._verbosity > 1) and not silent:
             print()
+        num_traces_rejected = self._num_traces_rejected - num_traces_rejected_start
+        if num_traces_rejected > 0 and util._verbosity > 0:
+            print(colored('Warning: {:,} traces exceeded their budget and were rejected'.format(num_traces_rejected), 'red', attrs=['bold']))
         traces.finalize()
         return traces
 
+    def _vectorized_traces(self, num_traces, prior_inflation=PriorInflation.DISABLED, *args, **kwargs):
+        with util._fast_inference_grad_mode():
+            state.begin_trace(self.forward, TraceMode.PRIOR, prior_inflation, vectorized_num_traces=num_traces, vectorized_value_shapes=self._vectorized_value_shapes)
+            result = self.forward(*args, **kwargs)
+            trace = state.end_trace(result)
+        if [variable.address for variable in trace.variables] != self._vectorized_addresses:
+            raise RuntimeError('Vectorized run diverged from the static trace structure.')
+        return state.split_trace(trace, num_traces)
+
+    def _replayed_trace(self, replay_trace, prior_inflation=PriorInflation.DISABLED, *args, **kwargs):
+        with torch.no_grad():
+            state.begin_trace(self.forward, TraceMode.PRIOR, prior_inflation, replay_trace=replay_trace)
+            result = self.forward(*args, **kwargs)
+            return state.end_trace(result)
+
+    # A model whose probe traces all have the same trace type (see Batch) and address sequence is run vectorized, sampling all traces of a batch in one pass of forward with batched values. The vectorized traces are verified by replaying them through the Python path.
+    def _check_vectorized(self, prior_inflation=PriorInflation.DISABLED, num_probe_traces=8, num_verify_traces=4, silent=False, *args, **kwargs):
+        self._vectorized = False
+        probe_traces = self._traces(num_probe_traces, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, silent=True, *args, **kwargs).get_values()
+        addresses = [variable.address for variable in probe_traces[0].variables]
+        if len(Batch(probe_traces).sub_batches) > 1:
+            return False
+        for trace in probe_traces:
+            if [variable.address for variable in trace.variables] != addresses:
+                return False
+        self._vectorized_addresses = addresses
+        self._vectorized_value_shapes = {variable.address: variable.value.size() for variable in probe_traces[0].variables if variable.value is not None}
+        try:
+            for trace in self._vectorized_traces(num_verify_traces, prior_inflation, *args, **kwargs):
+                replayed_trace = self._replayed_trace(trace, prior_inflation, *args, **kwargs)
+                if [variable.address for variable in replayed_trace.variables] != addresses:
+                    raise RuntimeError('Replayed trace has a different structure.')
+                for variable, replayed_variable in zip(trace.variables, replayed_trace.variables):
+                    if not torch.allclose(util.to_tensor(variable.log_prob), util.to_tensor(replayed_variable.log_prob), atol=1e-4):
+                        raise RuntimeError('Replayed trace has a different log_prob at address: {}'.format(variable.address))
+                if torch.is_tensor(trace.result) and torch.is_tensor(replayed_trace.result):
+                    if trace.result.size() != replayed_trace.result.size() or not torch.allclose(trace.result.float(), replayed_trace.result.float(), atol=1e-4):
+                        raise RuntimeError('Replayed trace has a different result.')
+        except Exception as e:
+            state.abort_trace()
+            if util._verbosity > 0:
+                print(colored('Warning: model has a static trace structure but cannot be vectorized, sampling traces one by one: {}'.format(e), 'red', attrs=['bold']))
+            return False
+        self._vectorized = True
+        if (util._verbosity > 1) and not silent:
+            print('Model has a static trace structure, sampling prior traces vectorized.')
+        return True
+
+    # Prior traces for training, sampled vectorized when the model allows it and vectorized is True
+    def _training_traces(self, num_traces, prior_inflation=PriorInflation.DISABLED, silent=True, vectorized=True, *args, **kwargs):
+        if vectorized and self._vectorized is None:
+            self._check_vectorized(prior_inflation, silent=silent, *args, **kwargs)
+        if vectorized and self._vectorized:
+            try:
+                return self._vectorized_traces(num_traces, prior_inflation, *args, **kwargs)
+            except Exception as e:
+                state.abort_trace()
+                if util._verbosity > 0:
+                    print(colored('Warning: vectorized run failed, sampling traces one by one: {}'.format(e), 'red', attrs=['bold']))
+                self._vectorized = False
+        return self._traces(num_traces, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, silent=silent, *args, **kwargs).get_values()
+
     def prior_traces(self, num_traces=10, prior_inflation=PriorInflation.DISABLED, map_func=None, file_name=None, *args, **kwargs):
         prior = self._traces(num_traces=num_traces, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, map_func=map_func, file_name=file_name, *args, **kwargs)
         prior.rename('Prior, num_traces={:,}'.format(prior.length))
@@ -130,20 +218,28 @@ class Model():
     def posterior_distribution(self, num_traces=10, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, initial_trace=None, map_func=lambda trace: trace.result, observe=None, file_name=None, *args, **kwargs):
         return self.posterior_traces(num_traces=num_traces, inference_engine=inference_engine, initial_trace=initial_trace, map_func=map_func, observe=observe, file_name=file_name, *args, **kwargs)
 
-    def learn_inference_network(self, num_traces=None, inference_network=InferenceNetwork.FEEDFORWARD, prior_inflation=PriorInflation.DISABLED, trace_store_dir=None, observe_embeddings={}, batch_size=64, valid_size=64, valid_interval=5000, learning_rate=0.0001, weight_decay=1e-5, auto_save_file_name_prefix=None, auto_save_interval_sec=600):
+    def learn_inference_network(self, num_traces=None, inference_network=InferenceNetwork.FEEDFORWARD, prior_inflation=PriorInflation.DISABLED, trace_store_dir=None, trace_store_shuffle_buffer_size=1024, observe_embeddings={}, batch_size=64, valid_size=64, valid_interval=5000, learning_rate=0.0001, weight_decay=1e-5, auto_save_file_name_prefix=None, auto_save_interval_sec=600, prefetch_batches=0, prefetch_workers=1, bucketing_buffer_size=None, bucketing_mix=0.25, distributed=False, scan_trace_store=False, shared_proposal_trunks=False, metrics_file_name=None, replay_buffer_size=None, replay_mix=0.5, replay_eviction='fifo', replay_buffer_file_name=None, vectorized=True):
+        # prefetch_batches: when above 0, prefetch_workers background threads keep up to this number of batches ready while training. Traces are then generated off the main thread, which changes the order in which the random number generators are used, so results under set_random_seed differ from training without prefetching
+        # vectorized: prior traces of models with a static trace structure are sampled vectorized (see _check_vectorized), False samples them one by one
+        # distributed: data-parallel training over the processes of a torch.distributed job (e.g. started with torchrun), using the gloo backend unless a process group is already initialized
+        if distributed and not torch.distributed.is_initialized():
+            torch.distributed.init_process_group('gloo')
         if self._inference_network is None:
             print('Creating new inference network...')
             if inference_network == InferenceNetwork.FEEDFORWARD:
-                self._inference_network = InferenceNetworkFeedForward(model=self, observe_embeddings=observe_embeddings, valid_size=valid_size)
+                self._inference_network = InferenceNetworkFeedForward(model=self, observe_embeddings=observe_embeddings, valid_size=valid_size, shared_proposal_trunks=shared_proposal_trunks)
             else:
                 raise ValueError('Unknown inference_network: {}'.format(inference_network))
         else:
             print('Continuing to train existing inference network...')
             print('Total number of parameters: {:,}'.format(self._inference_network._history_num_params[-1]))
 
-        batch_generator = BatchGenerator(self, prior_inflation, trace_store_dir)
+        batch_generator = BatchGenerator(self, prior_inflation, trace_store_dir, trace_store_shuffle_buffer_size=trace_store_shuffle_buffer_size, bucketing_buffer_size=bucketing_buffer_size, bucketing_mix=bucketing_mix, replay_buffer_size=replay_buffer_size, replay_mix=replay_mix, replay_eviction=replay_eviction, replay_buffer_file_name=replay_buffer_file_name, vectorized=vectorized)
         self._inference_network.to(device=util._device)
-        self._inference_network.optimize(num_traces, batch_generator, batch_size=batch_size, valid_interval=valid_interval, learning_rate=learning_rate, weight_decay=weight_decay, auto_save_file_name_prefix=auto_save_file_name_prefix, auto_save_interval_sec=auto_save_interval_sec)
+        try:
+            self._inference_network.optimize(num_traces, batch_generator, batch_size=batch_size, valid_interval=valid_interval, learning_rate=learning_rate, weight_decay=weight_decay, auto_save_file_name_prefix=auto_save_file_name_prefix, auto_save_interval_sec=auto_save_interval_sec, prefetch_batches=prefetch_batches, prefetch_workers=prefetch_workers, scan_trace_store=scan_trace_store, metrics_file_name=metrics_file_name)
+        finally:
+            batch_generator.close()
 
     def save_inference_network(self, file_name):
         if self._inference_network is None:
@@ -155,19 +251,32 @@ class Model():
         # The following is due to a temporary hack related with https://github.com/pytorch/pytorch/issues/9981 and can be deprecated by using dill as pickler with torch > 0.4.1
         self._inference_network._model = self
 
-    def save_trace_store(self, trace_store_dir, files=16, traces_per_file=16, prior_inflation=PriorInflation.DISABLED, *args, **kwargs):
+    # vectorized: see learn_inference_network
+    def save_trace_store(self, trace_store_dir, files=16, traces_per_file=16, prior_inflation=PriorInflation.DISABLED, num_workers=1, vectorized=True, *args, **kwargs):
         if not os.path.exists(trace_store_dir):
             print('Directory does not exist, creating: {}'.format(trace_store_dir))
             os.makedirs(trace_store_dir)
-        batch_generator = BatchGenerator(self, prior_inflation)
-        batch_generator.save_trace_store(trace_store_dir, files, traces_per_file)
+        batch_generator = BatchGenerator(self, prior_inflation, vectorized=vectorized)
+        batch_generator.save_trace_store(trace_store_dir, files, traces_per_file, num_workers=num_workers)
 
 
 class ModelRemote(Model):
-    def __init__(self, server_address='tcp://127.0.0.1:5555'):
+    # timeout_sec: seconds to wait for each reply from the server, after which the trace is rejected and the connection is reset
+    # server_address can be a list of addresses, or simulator_command can launch num_simulators simulators locally (see SimulatorPool), so that traces run on several simulators concurrently
+    # runs_per_connection: runs importance sampling traces on asynchronous zmq.DEALER connections (see AsyncModelServer), with up to this number of runs in flight on each simulator
+    def __init__(self, server_address='tcp://127.0.0.1:5555', timeout_sec=None, simulator_command=None, num_simulators=1, runs_per_connection=None):
+        if runs_per_connection is not None and runs_per_connection < 1:
+            raise ValueError('Expecting runs_per_connection of at least 1.')
         self._server_address = server_address
+        self._timeout_sec = timeout_sec
         self._model_server = None
+        self._simulator_pool = None
+        self._event_loop = None
+        if simulator_command is not None or not isinstance(server_address, str) or runs_per_connection is not None:
+            server_addresses = [server_address] if isinstance(server_address, str) else server_address
+            self._simulator_pool = SimulatorPool(None if simulator_command is not None else server_addresses, timeout_sec, simulator_command, num_simulators, runs_per_connection)
         super().__init__('ModelRemote')
+        self._vectorized = False
 
     def __enter__(self):
         return self
@@ -181,10 +290,201 @@ class ModelRemote(Model):
     def close(self):
         if self._model_server is not None:
             self._model_server.close()
+        if self._simulator_pool is not None:
+            self._simulator_pool.close()
+        if self._event_loop is not None:
+            # Lets the closed connections cancel their receivers
+            self._event_loop.run_until_complete(asyncio.sleep(0))
+            self._event_loop.close()
+            self._event_loop = None
+
+    def save_trace_store(self, trace_store_dir, files=16, traces_per_file=16, prior_inflation=PriorInflation.DISABLED, num_workers=1, vectorized=True, *args, **kwargs):
+        if num_workers > 1:
+            raise ValueError('ModelRemote cannot be shared by several trace store workers, use a pool of simulators instead.')
+        super().save_trace_store(trace_store_dir, files, traces_per_file, prior_inflation, num_workers, vectorized, *args, **kwargs)
+
+    def reset(self):
+        # Drops the connection, the next trace reconnects to the server with a new handshake
+        if self._model_server is not None:
+            self._model_server.close()
+            self._model_server = None
+        if self._simulator_pool is not None:
+            for server_address in self._simulator_pool.server_addresses:
+                self._simulator_pool.reset(server_address)
+
+    def _get_event_loop(self):
+        if self._event_loop is None:
+            self._event_loop = asyncio.new_event_loop()
+        return self._event_loop
+
+    def _pool_model_server(self, server_address):
+        model_server = self._simulator_pool.model_server(server_address)
+        if model_server is not None:
+            self._set_name(model_server)
+        return model_server
+
+    # Asynchronous connections know the model name only once their handshake result arrives
+    def _set_name(self, model_server):
+        if model_server.model_name is not None:
+            self.name = '{} running on {}'.format(model_server.model_name, model_server.system_name)
 
     def forward(self):
+        if self._simulator_pool is not None:
+            # A single run, on the first simulator that connects
+            while True:
+                for server_address in self._simulator_pool.idle_server_addresses():
+                    model_server = self._pool_model_server(server_address)
+                    if model_server is not None:
+                        try:
+                            if self._simulator_pool.runs_per_connection is not None:
+                                result = self._get_event_loop().run_until_complete(model_server.run())
+                                self._set_name(model_server)
+                                return result
+                            return model_server.forward()
+                        except util.TraceBudgetExceeded:
+                            self._simulator_pool.reset(server_address)
+                            raise
+                time.sleep(0.1)
+
         if self._model_server is None:
-            self._model_server = ModelServer(self._server_address)
+            self._model_server = ModelServer(self._server_address, self._timeout_sec)
             self.name = '{} running on {}'.format(self._model_server.model_name, self._model_server.system_name)
 
-        return self._model_server.forward()
+        try:
+            return self._model_server.forward()
+        except util.TraceBudgetExceeded:
+            # The server is left in the middle of an execution or is not responding
+            self.reset()
+            raise
+
+    # With a pool of simulators, importance sampling runs are dispatched to all idle simulators, and the messages of the runs in flight are handled as they arrive, each with the trace state of its run
+    # Metropolis-Hastings chains are sequential and run one trace at a time
+    def _trace_generator(self, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, observe=None, metropolis_hastings_trace=None, num_traces=None, *args, **kwargs):
+        if self._simulator_pool is None or inference_engine not in [InferenceEngine.IMPORTANCE_SAMPLING, InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK]:
+            yield from super()._trace_generator(trace_mode, prior_inflation, inference_engine, inference_network, observe, metropolis_hastings_trace, num_traces, *args, **kwargs)
+            return
+
+        def begin_trace():
+            state.begin_trace(self.forward, trace_mode, prior_inflation, inference_engine, inference_network, observe, metropolis_hastings_trace)
+        if self._simulator_pool.runs_per_connection is None:
+            yield from self._pool_trace_generator(begin_trace, num_traces)
+        else:
+            yield from self._async_trace_generator(begin_trace, num_traces)
+
+    def _pool_trace_generator(self, begin_trace, num_traces):
+        pool = self._simulator_pool
+        idle_context = state._get_context()
+        contexts = {}
+        num_traces_yielded = 0
+        num_consecutive_rejections = 0
+        try:
+            while num_traces is None or num_traces_yielded < num_traces:
+                for server_address in pool.idle_server_addresses():
+                    if num_traces is not None and num_traces_yielded + len(contexts) >= num_traces:
+                        break
+                    model_server = self._pool_model_server(server_address)
+                    if model_server is None:
+                        continue
+                    with util._fast_inference_grad_mode():
+                        begin_trace()
+                    contexts[server_address] = state._get_context()
+                    state._set_context(idle_context)
+                    pool.send_request(server_address, model_server._run_message())
+                traces = []
+                for server_address, reply in pool.receive_replies():
+                    state._set_context(contexts.pop(server_address))
+                    if reply is None:
+                        # The run is dropped with the failed simulator and a new run is dispatched
+                        state.abort_trace()
+                    else:
+                        try:
+                            with util._fast_inference_grad_mode():
+                                done, value = pool.model_server(server_address)._handle_message(reply)
+                                if done:
+                                    traces.append(state.end_trace(value))
+                                    num_consecutive_rejections = 0
+                                else:
+                                    contexts[server_address] = state._get_context()
+                                    pool.send_request(server_address, value)
+                        except util.TraceBudgetExceeded as e:
+                            # Over-budget traces are rejected and replaced by a new trace
+                            state.abort_trace()
+                            pool.reset(server_address)
+                            self._num_traces_rejected += 1
+                            num_consecutive_rejections += 1
+                            _check_consecutive_rejections(num_consecutive_rejections, e)
+                    state._set_context(idle_context)
+                for trace in traces:
+                    num_traces_yielded += 1
+                    yield trace
+        finally:
+            # Runs still in flight when the generator is closed are dropped with their connections
+            for server_address in contexts:
+                pool.reset(server_address)
+            state._set_context(idle_context)
+
+    # Runs are asyncio tasks of AsyncModelServer connections, with up to runs_per_connection runs in flight on each, driven by an event loop kept by the model
+    def _async_trace_generator(self, begin_trace, num_traces):
+        pool = self._simulator_pool
+        loop = self._get_event_loop()
+        tasks = {}
+        num_traces_yielded = 0
+        num_consecutive_rejections = 0
+
+        def drop_runs(server_address):
+            # Runs on a connection are dropped with it
+            for task in [task for task in tasks if tasks[task] == server_address]:
+                task.cancel()
+                del tasks[task]
+            pool.reset(server_address)
+
+        try:
+            while num_traces is None or num_traces_yielded < num_traces:
+                for server_address in pool.idle_server_addresses():
+                    num_runs = list(tasks.values()).count(server_address)
+                    for i in range(pool.runs_per_connection - num_runs):
+                        if num_traces is not None and num_traces_yielded + len(tasks) >= num_traces:
+                            break
+                        model_server = self._pool_model_server(server_address)
+                        task = loop.create_task(model_server.run(begin_trace))
+                        task.add_done_callback(lambda task, model_server=model_server: self._set_name(model_server))
+                        tasks[task] = server_address
+                if len(tasks) == 0:
+                    time.sleep(0.1)
+                    continue
+                done, _ = loop.run_until_complete(asyncio.wait(list(tasks), timeout=0.1, return_when=asyncio.FIRST_COMPLETED))
+                traces = []
+                for task in done:
+                    server_address = tasks.pop(task, None)
+                    if server_address is None or task.cancelled():
+                        continue
+                    exception = task.exception()
+                    if exception is None:
+                        traces.append(task.result())
+                        num_consecutive_rejections = 0
+                    elif isinstance(exception, util.TraceBudgetExceeded):
+                        if pool.model_server(server_address)._requester.timed_out:
+                            drop_runs(server_address)
+                            pool.failed(server_address, 'no reply within {} seconds'.format(self._timeout_sec))
+                        else:
+                            # Over-budget traces are rejected and replaced by a new trace
+                            drop_runs(server_address)
+                            self._num_traces_rejected += 1
+                            num_consecutive_rejections += 1
+                            _check_consecutive_rejections(num_consecutive_rejections, exception)
+                    else:
+                        raise exception
+                for server_address in set(tasks.values()):
+                    if not pool.alive(server_address):
+                        drop_runs(server_address)
+                        pool.failed(server_address, 'process exited with code {}'.format(pool.exit_code(server_address)))
+                for trace in traces:
+                    num_traces_yielded += 1
+                    yield trace
+        finally:
+            # Runs still in flight when the generator is closed are dropped with their connections
+            cancelled = list(tasks)
+            for server_address in set(tasks.values()):
+                drop_runs(server_address)
+            if len(cancelled) > 0:
+                loop.run_until_complete(asyncio.wait(cancelled))
@@ -1,4 +1,8 @@
+from .trace_store import TraceStoreFile, save_trace_store_file, load_trace_store_file, convert_trace_store, append_manifest, read_manifest
+from .replay_buffer import ReplayBuffer
 from .batch import Batch, BatchGenerator
+from .dataset import TraceDataset, DataLoaderBatchGenerator, collate_traces
+from .metrics import MetricsWriter, read_metrics
 from .embedding_feedforward import EmbeddingFeedForward
 from .embedding_cnn_2d_5c import EmbeddingCNN2D5C
 from .embedding_cnn_3d_4c import EmbeddingCNN3D4C
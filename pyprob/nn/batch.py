@@ -1,15 +1,24 @@
 import torch
 import time
 import os
-import shutil
 import uuid
-import tempfile
-import tarfile
 import random
-from threading import Thread
+import queue
+import math
+import json
+import multiprocessing
+from collections import deque
+from threading import Thread, Lock, Event
 from termcolor import colored
 
-from .. import __version__, util, TraceMode
+from .. import util
+from .trace_store import save_trace_store_file, load_trace_store_file, append_manifest, manifest_file_name
+from .replay_buffer import ReplayBuffer
+
+
+def _trace_hash(trace):
+    # The trace type, traces of the same type share the same sequence of controlled addresses
+    return ''.join([variable.address for variable in trace.variables_controlled])
 
 
 class Batch():
@@ -20,132 +29,435 @@ class Batch():
         for trace in traces:
             if trace.length == 0:
                 raise ValueError('Trace of length zero.')
-            trace_hash = ''.join([variable.address for variable in trace.variables_controlled])
+            trace_hash = _trace_hash(trace)
             if trace_hash not in sub_batches:
                 sub_batches[trace_hash] = []
             sub_batches[trace_hash].append(trace)
         self.sub_batches = list(sub_batches.values())
+        # Values of named variables stacked over the traces, with shape [length, -1]
+        self.named_values = {}
+
+    # Stacks the values of the named variables that all the traces have with the same shape, such as observations
+    def stack_named_values(self):
+        self.named_values = {}
+        for name, variable in self.traces[0].named_variables.items():
+            if not torch.is_tensor(variable.value):
+                continue
+            shape = variable.value.shape
+            if all([name in trace.named_variables and torch.is_tensor(trace.named_variables[name].value) and trace.named_variables[name].value.shape == shape for trace in self.traces]):
+                self.named_values[name] = torch.stack([trace.named_variables[name].value for trace in self.traces]).view(self.length, -1)
 
     def to(self, device):
         for trace in self.traces:
             trace.to(device=device)
+        self.named_values = {name: value.to(device=device) for name, value in self.named_values.items()}
+
+    # Used by DataLoader with pin_memory=True
+    def pin_memory(self):
+        self.named_values = {name: value.pin_memory() for name, value in self.named_values.items()}
+        return self
 
 
 class BatchGenerator():
-    def __init__(self, model, prior_inflation, trace_store_dir=None):
+    # trace_store_shuffle_buffer_size: traces from the trace store are streamed through a shuffle buffer of this size. Files are read in epochs, each going through all the files in a new random order, so that every stored trace is used once per epoch
+    # bucketing_buffer_size: when given, traces are buffered by trace type and batches are drawn mostly from the largest buckets, giving larger sub-batches. A bucketing_mix fraction of every batch is drawn from the oldest buffered traces, so that no trace waits in the buffer for long. Every trace is used exactly once, so the training distribution stays the same.
+    # replay_buffer_size: when given, traces sampled online are added to a replay buffer (see ReplayBuffer) and a replay_mix fraction of every batch is sampled from it, so that every trace from an expensive simulator is used in several training steps
+    # vectorized: whether traces sampled online can be sampled vectorized (see Model._check_vectorized)
+    def __init__(self, model, prior_inflation, trace_store_dir=None, trace_store_shuffle_buffer_size=1024, bucketing_buffer_size=None, bucketing_mix=0.25, replay_buffer_size=None, replay_mix=0.5, replay_eviction='fifo', replay_buffer_file_name=None, vectorized=True):
         self._model = model
         self._prior_inflation = prior_inflation
+        self._vectorized = vectorized
         self._trace_store_dir = trace_store_dir
+        self._replay_buffer = None
+        self._replay_mix = replay_mix
+        self._replay_num_traces_new = 0
+        self._replay_num_traces_replayed = 0
+        if replay_buffer_size is not None:
+            if trace_store_dir is not None:
+                raise ValueError('Cannot use a replay buffer with a trace store, the replay buffer holds traces sampled online.')
+            if replay_mix < 0 or replay_mix >= 1:
+                raise ValueError('Expecting 0 <= replay_mix < 1.')
+            self._replay_buffer = ReplayBuffer(replay_buffer_size, eviction=replay_eviction, file_name=replay_buffer_file_name)
+        self._bucketing_buffer_size = bucketing_buffer_size
+        self._bucketing_mix = bucketing_mix
+        self._buckets = {}
+        self._buckets_num_traces = 0
+        self._buckets_num_traces_added = 0
+        # Guards the trace store shuffle buffer and file lists, which are shared by prefetch workers
+        self._lock = Lock()
+        # Model execution is serialized because the trace state (pyprob.state) is global
+        self._model_lock = Lock()
+        self._prefetch_queue = None
+        self._prefetch_workers = []
+        self._prefetch_stop = Event()
         if trace_store_dir is not None:
-            self._trace_store_cache = []
-            self._trace_store_discarded_file_names = []
-            num_files = len(self._trace_store_current_files())
+            self._trace_store_shuffle_buffer = []
+            self._trace_store_shuffle_buffer_size = trace_store_shuffle_buffer_size
+            self._trace_store_epoch = 0
+            self._trace_store_epoch_files = []
+            self._trace_store_epoch_position = 0
+            # Index of the trace store files: a list for sampling in O(1), the position of each file in the list for removal in O(1), and the discarded files
+            self._trace_store_files = []
+            self._trace_store_file_positions = {}
+            self._trace_store_discarded_file_names = set()
+            self._trace_store_manifest_offset = 0
+            self._trace_store_dir_mtime = None
+            self._trace_store_index_time = 0.
+            self._trace_store_rescan_interval_sec = 1.
+            with self._lock:
+                self._trace_store_index_refresh()
+                num_files = len(self._trace_store_files)
             print('Monitoring trace cache (currently with {} files) at {}'.format(num_files, trace_store_dir))
 
+    # Starts num_workers threads that keep up to queue_size batches of length batch_size ready, so that producing batches overlaps with training
+    def start_prefetch(self, batch_size=64, num_workers=1, queue_size=4):
+        if self._prefetch_queue is not None:
+            self.stop_prefetch()
+        self._prefetch_batch_size = batch_size
+        self._prefetch_queue = queue.Queue(maxsize=queue_size)
+        self._prefetch_stop.clear()
+        self._prefetch_num_batches = 0
+        self._prefetch_queue_depth_total = 0
+        self._prefetch_wait_sec = 0.
+        self._prefetch_workers = [Thread(target=self._prefetch_worker, daemon=True) for i in range(num_workers)]
+        for worker in self._prefetch_workers:
+            worker.start()
+
+    def stop_prefetch(self):
+        if self._prefetch_queue is None:
+            return
+        self._prefetch_stop.set()
+        for worker in self._prefetch_workers:
+            worker.join()
+        self._prefetch_workers = []
+        self._prefetch_queue = None
+
+    def close(self):
+        self.stop_prefetch()
+        if self._replay_buffer is not None:
+            self._replay_buffer.close()
+
+    def prefetch_statistics(self):
+        if self._prefetch_queue is None or self._prefetch_num_batches == 0:
+            return None
+        return {'batches': self._prefetch_num_batches,
+                'queue_depth_mean': self._prefetch_queue_depth_total / self._prefetch_num_batches,
+                'wait_sec_total': self._prefetch_wait_sec,
+                'wait_sec_mean': self._prefetch_wait_sec / self._prefetch_num_batches}
+
+    def _prefetch_worker(self):
+        while not self._prefetch_stop.is_set():
+            try:
+                batch = self._get_batch(self._prefetch_batch_size)
+            except Exception as e:
+                # Errors are passed on and raised in the training thread
+                batch = e
+            if batch is None:
+                return
+            # Backpressure: block while the queue is full, checking for shutdown
+            while not self._prefetch_stop.is_set():
+                try:
+                    self._prefetch_queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
     def get_batch(self, length=64, discard_source=False, *args, **kwargs):
+        if self._prefetch_queue is not None and length == self._prefetch_batch_size and not discard_source and len(args) == 0 and len(kwargs) == 0:
+            self._prefetch_queue_depth_total += self._prefetch_queue.qsize()
+            time_start = time.time()
+            batch = self._prefetch_queue.get()
+            self._prefetch_wait_sec += time.time() - time_start
+            self._prefetch_num_batches += 1
+            if isinstance(batch, Exception):
+                raise batch
+            return batch
+        return self._get_batch(length, discard_source, *args, **kwargs)
+
+    def _get_batch(self, length=64, discard_source=False, *args, **kwargs):
+        if self._bucketing_buffer_size is None or discard_source:
+            traces = self._get_traces(length, discard_source, *args, **kwargs)
+            return None if traces is None else Batch(traces)
+        while True:
+            with self._lock:
+                if self._buckets_num_traces >= max(length, self._bucketing_buffer_size):
+                    traces = self._buckets_take(length)
+                    break
+            new_traces = self._get_traces(length, False, *args, **kwargs)
+            if new_traces is None:
+                return None
+            with self._lock:
+                self._buckets_add(new_traces)
+        return Batch(traces)
+
+    def _buckets_add(self, traces):
+        for trace in traces:
+            trace_hash = _trace_hash(trace)
+            if trace_hash not in self._buckets:
+                self._buckets[trace_hash] = deque()
+            # Traces are kept with their arrival index, so that the oldest trace is at the front of its bucket
+            self._buckets[trace_hash].append((self._buckets_num_traces_added, trace))
+            self._buckets_num_traces_added += 1
+            self._buckets_num_traces += 1
+
+    def _buckets_pop(self, trace_hash):
+        bucket = self._buckets[trace_hash]
+        _, trace = bucket.popleft()
+        if len(bucket) == 0:
+            del self._buckets[trace_hash]
+        self._buckets_num_traces -= 1
+        return trace
+
+    def _buckets_take(self, length):
+        traces = []
+        num_oldest = min(length, int(math.ceil(self._bucketing_mix * length)))
+        for i in range(num_oldest):
+            trace_hash = min(self._buckets, key=lambda h: self._buckets[h][0][0])
+            traces.append(self._buckets_pop(trace_hash))
+        for trace_hash in sorted(self._buckets, key=lambda h: len(self._buckets[h]), reverse=True):
+            while len(traces) < length and trace_hash in self._buckets:
+                traces.append(self._buckets_pop(trace_hash))
+            if len(traces) == length:
+                break
+        return traces
+
+    def _get_traces(self, length=64, discard_source=False, *args, **kwargs):
         if self._trace_store_dir is None:
             # There is no trace store on disk, sample traces online from the model
-            traces = self._model._traces(length, trace_mode=TraceMode.PRIOR, prior_inflation=self._prior_inflation, silent=True, *args, **kwargs).get_values()
+            if self._replay_buffer is None or discard_source:
+                with self._model_lock:
+                    traces = self._model._training_traces(length, prior_inflation=self._prior_inflation, silent=True, vectorized=self._vectorized, *args, **kwargs)
+            else:
+                # Replayed traces are sampled before the new traces are added, new traces make up for a replay buffer holding too few traces
+                with self._lock:
+                    traces = self._replay_buffer.sample(int(round(self._replay_mix * length)))
+                with self._model_lock:
+                    new_traces = self._model._training_traces(length - len(traces), prior_inflation=self._prior_inflation, silent=True, vectorized=self._vectorized, *args, **kwargs)
+                with self._lock:
+                    self._replay_buffer.add(new_traces)
+                    self._replay_num_traces_new += len(new_traces)
+                    self._replay_num_traces_replayed += len(traces)
+                traces = traces + new_traces
+        elif discard_source:
+            # Traces from files that are discarded from training, used for the validation batch
+            traces = []
+            while len(traces) < length:
+                current_file = self._trace_store_next_file(discard_source=True)
+                if current_file is None:
+                    return None
+                new_traces = self._load_traces(current_file)
+                random.shuffle(new_traces)
+                traces += new_traces
+            traces = traces[0:length]
         else:
-            # There is a trace store on disk, load traces from disk
-            if discard_source:
-                self._trace_store_cache = []
-
-            while len(self._trace_store_cache) < length:
-                current_files = self._trace_store_current_files()
-                if len(current_files) == 0:
-                    cache_is_empty = True
-                    cache_was_empty = False
-                    while cache_is_empty:
-                        current_files = self._trace_store_current_files()
-                        num_files = len(current_files)
-                        if num_files > 0:
-                            cache_is_empty = False
-                            if cache_was_empty:
-                                print('Resuming, new data appeared in trace cache (currently with {} files) at {}'.format(num_files, self._trace_cache_path))
-                        else:
-                            if not cache_was_empty:
-                                print('Waiting for new data, empty (or fully discarded) trace cache at {}'.format(self._trace_cache_path))
-                                cache_was_empty = True
-                            time.sleep(0.5)
-
-                current_file = random.choice(current_files)
-                if discard_source:
-                    self._trace_store_discarded_file_names.append(current_file)
+            # There is a trace store on disk, stream traces through the shuffle buffer
+            buffer = self._trace_store_shuffle_buffer
+            while True:
+                with self._lock:
+                    if len(buffer) >= max(length, self._trace_store_shuffle_buffer_size):
+                        traces = []
+                        for i in range(length):
+                            # A random trace is swapped with the last one and popped
+                            j = random.randrange(len(buffer))
+                            buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                            traces.append(buffer.pop())
+                        break
+                current_file = self._trace_store_next_file()
+                if current_file is None:
+                    return None
+                # Loading runs outside the lock so that prefetch workers load files concurrently
                 new_traces = self._load_traces(current_file)
-                if len(new_traces) == 0:  # When empty or corrupt file is read
-                    self._trace_store_discarded_file_names.append(current_file)
+                with self._lock:
+                    if len(new_traces) == 0:  # When empty or corrupt file is read
+                        self._trace_store_discard(current_file)
+                    else:
+                        buffer += new_traces
+        return traces
+
+    # Returns a batch with one example trace of each trace type in the trace store
+    def scan_trace_store(self):
+        if self._trace_store_dir is None:
+            raise ValueError('Cannot scan trace store, this batch generator has no trace store.')
+        example_traces = {}
+        # Discarded files are scanned too, as they can hold the validation batch
+        with self._lock:
+            self._trace_store_index_refresh()
+            files = self._trace_store_files + sorted(self._trace_store_discarded_file_names)
+        for file_name in files:
+            for trace in self._load_traces(file_name):
+                trace_hash = _trace_hash(trace)
+                if trace_hash not in example_traces:
+                    example_traces[trace_hash] = trace
+        print('Scanned {} trace store files, found {} trace types'.format(len(files), len(example_traces)))
+        return Batch(list(example_traces.values()))
+
+    # Returns the next file of the current epoch, or a random file that is then discarded when discard_source is True
+    def _trace_store_next_file(self, discard_source=False):
+        waiting = False
+        while True:
+            with self._lock:
+                if discard_source:
+                    if len(self._trace_store_files) == 0 or time.time() - self._trace_store_index_time > self._trace_store_rescan_interval_sec:
+                        self._trace_store_index_refresh()
+                    if len(self._trace_store_files) > 0:
+                        current_file = random.choice(self._trace_store_files)
+                        self._trace_store_discard(current_file)
+                        break
                 else:
-                    random.shuffle(new_traces)
-                    self._trace_store_cache += new_traces
+                    current_file = self._trace_store_epoch_next_file()
+                    if current_file is not None:
+                        break
+            if self._prefetch_stop.is_set() and self._prefetch_queue is not None:
+                return None
+            if not waiting:
+                print('Waiting for new data, empty (or fully discarded) trace cache at {}'.format(self._trace_store_dir))
+                waiting = True
+            time.sleep(0.5)
+        if waiting:
+            print('Resuming, new data appeared in trace cache (currently with {} files) at {}'.format(len(self._trace_store_files), self._trace_store_dir))
+        return current_file
 
-            traces = self._trace_store_cache[0:length]
-            self._trace_store_cache[0:length] = []
-        return Batch(traces)
+    def _trace_store_epoch_next_file(self):
+        while True:
+            while self._trace_store_epoch_position < len(self._trace_store_epoch_files):
+                current_file = self._trace_store_epoch_files[self._trace_store_epoch_position]
+                self._trace_store_epoch_position += 1
+                # Files discarded or deleted from disk during the epoch are skipped
+                if current_file in self._trace_store_file_positions:
+                    return current_file
+            # A new epoch goes through all the files, including those that appeared during the previous epoch, in a new random order
+            self._trace_store_index_refresh()
+            if len(self._trace_store_files) == 0:
+                return None
+            self._trace_store_epoch += 1
+            self._trace_store_epoch_files = random.sample(self._trace_store_files, len(self._trace_store_files))
+            self._trace_store_epoch_position = 0
+
+    def _trace_store_add(self, file_name):
+        if file_name not in self._trace_store_file_positions and file_name not in self._trace_store_discarded_file_names:
+            self._trace_store_file_positions[file_name] = len(self._trace_store_files)
+            self._trace_store_files.append(file_name)
+
+    def _trace_store_remove(self, file_name):
+        if file_name in self._trace_store_file_positions:
+            # The last file takes the place of the removed one
+            position = self._trace_store_file_positions.pop(file_name)
+            last_file_name = self._trace_store_files.pop()
+            if last_file_name != file_name:
+                self._trace_store_files[position] = last_file_name
+                self._trace_store_file_positions[last_file_name] = position
 
-    def save_trace_store(self, trace_store_dir, files=16, traces_per_file=16, *args, **kwargs):
-        f = 0
-        done = False
-        while not done:
-            traces = self._model._traces(traces_per_file, trace_mode=TraceMode.PRIOR, prior_inflation=self._prior_inflation, *args, **kwargs).get_values()
-            file_name = os.path.join(trace_store_dir, 'pyprob_traces_{}_{}'.format(traces_per_file, str(uuid.uuid4())))
-            self._save_traces(traces, file_name)
-            f += 1
-            if (files is not None) and (f >= files):
-                done = True
-
-    def _trace_store_current_files(self):
-        files = [name for name in os.listdir(self._trace_store_dir)]
-        files = list(map(lambda f: os.path.join(self._trace_store_dir, f), files))
-        for discarded_file_name in self._trace_store_discarded_file_names:
-            if discarded_file_name in files:
-                files.remove(discarded_file_name)
-        return files
+    def _trace_store_discard(self, file_name):
+        self._trace_store_remove(file_name)
+        self._trace_store_discarded_file_names.add(file_name)
+
+    def _trace_store_index_refresh(self):
+        # New files are read incrementally from the manifest. The directory is listed again when its modification time changes, which picks up files without a manifest entry (written by earlier versions, copied in, or whose entry was not written) and drops files deleted from disk
+        self._trace_store_index_time = time.time()
+        manifest = os.path.join(self._trace_store_dir, manifest_file_name)
+        if os.path.exists(manifest) and os.path.getsize(manifest) > self._trace_store_manifest_offset:
+            with open(manifest, 'rb') as file:
+                file.seek(self._trace_store_manifest_offset)
+                data = file.read()
+            # The last line can be incomplete while an entry is being written
+            data = data[:data.rfind(b'\n') + 1]
+            self._trace_store_manifest_offset += len(data)
+            for line in data.splitlines():
+                file_name = os.path.join(self._trace_store_dir, json.loads(line)['file_name'])
+                if os.path.exists(file_name):
+                    self._trace_store_add(file_name)
+        dir_mtime = os.stat(self._trace_store_dir).st_mtime_ns
+        if dir_mtime != self._trace_store_dir_mtime:
+            self._trace_store_dir_mtime = dir_mtime
+            # Hidden files are trace store files being written and the manifest
+            file_names = set([os.path.join(self._trace_store_dir, name) for name in os.listdir(self._trace_store_dir) if not name.startswith('.')])
+            for file_name in sorted(file_names):
+                self._trace_store_add(file_name)
+            for file_name in [file_name for file_name in self._trace_store_files if file_name not in file_names]:
+                self._trace_store_remove(file_name)
+            self._trace_store_discarded_file_names &= file_names
+
+    # num_workers > 1 shards the files over forked worker processes with independent random seeds
+    def save_trace_store(self, trace_store_dir, files=16, traces_per_file=16, num_workers=1, *args, **kwargs):
+        if num_workers <= 1:
+            self._save_trace_store_shard(trace_store_dir, files, traces_per_file, False, None, *args, **kwargs)
+            return
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            print(colored('Warning: cannot start worker processes on this platform, saving the trace store with one process', 'red', attrs=['bold']))
+            self._save_trace_store_shard(trace_store_dir, files, traces_per_file, False, None, *args, **kwargs)
+            return
+        context = multiprocessing.get_context('fork')
+        num_files_written = context.Value('l', 0)
+        workers = []
+        for i in range(num_workers):
+            worker_files = None if files is None else files // num_workers + (1 if i < files % num_workers else 0)
+            seed = random.randrange(2**32)
+            workers.append(context.Process(target=self._save_trace_store_worker, args=(trace_store_dir, worker_files, traces_per_file, seed, num_files_written) + args, kwargs=kwargs, daemon=True))
+        time_start = time.time()
+        try:
+            for worker in workers:
+                worker.start()
+            while any([worker.is_alive() for worker in workers]):
+                time.sleep(0.5)
+                print('Trace store files written: {:,}{} | {:,.1f} traces/sec'.format(num_files_written.value, '' if files is None else '/{:,}'.format(files), num_files_written.value * traces_per_file / (time.time() - time_start)), end='\r')
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+        print()
+        failed = [worker for worker in workers if worker.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError('{} of {} trace store workers failed'.format(len(failed), num_workers))
+
+    def _save_trace_store_worker(self, trace_store_dir, files, traces_per_file, seed, num_files_written, *args, **kwargs):
+        util.set_random_seed(seed)
+        # Workers run in parallel, each with a single thread
+        torch.set_num_threads(1)
+        self._save_trace_store_shard(trace_store_dir, files, traces_per_file, True, num_files_written, *args, **kwargs)
+
+    def _save_trace_store_shard(self, trace_store_dir, files, traces_per_file, silent, num_files_written, *args, **kwargs):
+        # Files are written by a writer thread, so that writing a file overlaps with sampling the traces of the next one
+        write_queue = queue.Queue(maxsize=1)
+        errors = []
+
+        def writer():
+            while True:
+                traces = write_queue.get()
+                if traces is None:
+                    return
+                if len(errors) > 0:
+                    continue
+                try:
+                    file_name = os.path.join(trace_store_dir, 'pyprob_traces_{}_{}'.format(len(traces), str(uuid.uuid4())))
+                    trace_types = self._save_traces(traces, file_name)
+                    append_manifest(trace_store_dir, file_name, trace_types)
+                    if num_files_written is not None:
+                        with num_files_written.get_lock():
+                            num_files_written.value += 1
+                except Exception as e:
+                    errors.append(e)
+        writer_thread = Thread(target=writer)
+        writer_thread.start()
+        try:
+            f = 0
+            while (files is None or f < files) and len(errors) == 0:
+                traces = self._model._training_traces(traces_per_file, prior_inflation=self._prior_inflation, silent=silent, vectorized=self._vectorized, *args, **kwargs)
+                write_queue.put(traces)
+                f += 1
+        finally:
+            write_queue.put(None)
+            writer_thread.join()
+        if len(errors) > 0:
+            raise errors[0]
 
     def _save_traces(self, traces, file_name):
-        data = {}
-        data['traces'] = traces
-        data['model_name'] = self._model.name
-        data['pyprob_version'] = __version__
-        data['torch_version'] = torch.__version__
-
-        def thread_save():
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file_name = os.path.join(tmp_dir, 'pyprob_traces')
-            torch.save(data, tmp_file_name)
-            tar = tarfile.open(file_name, 'w:gz', compresslevel=2)
-            tar.add(tmp_file_name, arcname='pyprob_traces')
-            tar.close()
-            shutil.rmtree(tmp_dir)
-        t = Thread(target=thread_save)
-        t.start()
-        t.join()
+        return save_trace_store_file(traces, file_name, self._model.name)
 
     def _load_traces(self, file_name):
-        try:
-            tar = tarfile.open(file_name, 'r:gz')
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file = os.path.join(tmp_dir, 'pyprob_traces')
-            tar.extract('pyprob_traces', tmp_dir)
-            tar.close()
-            if util._cuda_enabled:
-                data = torch.load(tmp_file)
-            else:
-                data = torch.load(tmp_file, map_location=lambda storage, loc: storage)
-            shutil.rmtree(tmp_dir)
-        except:
-            print(colored('Warning: cannot load traces from file, file potentially corrupt: {}'.format(file_name), 'red', attrs=['bold']))
-            return []
-
-        # print('Loading trace cache of length {}'.format(data['length']))
-        # if data['model_name'] != self._model.name:
-            # print(colored('Warning: different model names (loaded traces: {}, current model: {})'.format(data['model_name'], self._model.name), 'red', attrs=['bold']))
-        if data['pyprob_version'] != __version__:
-            print(colored('Warning: different pyprob versions (loaded traces: {}, current system: {})'.format(data['pyprob_version'], __version__), 'red', attrs=['bold']))
-        if data['torch_version'] != torch.__version__:
-            print(colored('Warning: different PyTorch versions (loaded traces: {}, current system: {})'.format(data['torch_version'], torch.__version__), 'red', attrs=['bold']))
-
-        traces = data['traces']
+        traces = load_trace_store_file(file_name)
         for trace in traces:
             trace.to(device=util._device)
         return traces
@@ -0,0 +1,125 @@
+import os
+import random
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .. import util
+from ..util import PriorInflation
+from .batch import Batch
+from .trace_store import load_trace_store_file, read_manifest
+
+
+# Traces sampled online from a model, or read from a trace store, one trace at a time, for use with torch.utils.data.DataLoader and collate_traces
+# With DataLoader worker processes, each worker samples with its own random seed, and the files of the trace store are sharded over the workers
+# num_traces: the number of traces sampled online by each worker, epochs: the number of passes over the trace store; None for no limit
+class TraceDataset(IterableDataset):
+    def __init__(self, model=None, prior_inflation=PriorInflation.DISABLED, trace_store_dir=None, num_traces=None, epochs=None, traces_per_sample=16, *args, **kwargs):
+        if model is None and trace_store_dir is None:
+            raise ValueError('Expecting a model or a trace_store_dir.')
+        self._model = model
+        self._prior_inflation = prior_inflation
+        self._trace_store_dir = trace_store_dir
+        self._num_traces = num_traces
+        self._epochs = epochs
+        self._traces_per_sample = traces_per_sample
+        self._args = args
+        self._kwargs = kwargs
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            # DataLoader gives every worker a different torch seed, the Python and NumPy generators are seeded from it
+            util.set_random_seed(worker_info.seed % 2**32)
+        if self._trace_store_dir is None:
+            return self._iter_model()
+        else:
+            return self._iter_trace_store(worker_id, num_workers)
+
+    def _iter_model(self):
+        num_traces = 0
+        while self._num_traces is None or num_traces < self._num_traces:
+            length = self._traces_per_sample if self._num_traces is None else min(self._traces_per_sample, self._num_traces - num_traces)
+            traces = self._model._training_traces(length, prior_inflation=self._prior_inflation, silent=True, *self._args, **self._kwargs)
+            num_traces += len(traces)
+            yield from traces
+
+    def _iter_trace_store(self, worker_id, num_workers):
+        epoch = 0
+        while self._epochs is None or epoch < self._epochs:
+            # Files are listed again every epoch, so that files written during training are used in the next one
+            file_names = _trace_store_file_names(self._trace_store_dir)
+            if len(file_names) == 0:
+                raise RuntimeError('No trace store files at {}'.format(self._trace_store_dir))
+            file_names = file_names[worker_id::num_workers]
+            if len(file_names) == 0:
+                # With more workers than files this worker has none, and it finishes so that DataLoader, which waits for the workers in turn, continues with the others
+                return
+            random.shuffle(file_names)
+            for file_name in file_names:
+                traces = load_trace_store_file(file_name)
+                random.shuffle(traces)
+                yield from traces
+            epoch += 1
+
+
+def _trace_store_file_names(trace_store_dir):
+    # The manifest entries are merged with a listing of the directory, which picks up files without a manifest entry (written by earlier versions, copied in, or whose entry was not written) and drops files deleted from disk
+    # Hidden files are trace store files being written and the manifest
+    file_names = set([name for name in os.listdir(trace_store_dir) if not name.startswith('.')])
+    file_names |= set([entry['file_name'] for entry in read_manifest(trace_store_dir) if os.path.exists(os.path.join(trace_store_dir, entry['file_name']))])
+    # Files are sorted so that all workers shard the same list
+    return [os.path.join(trace_store_dir, name) for name in sorted(file_names)]
+
+
+# collate_fn for DataLoader, giving a Batch with the named values shared by all the traces stacked into tensors, in the worker processes
+def collate_traces(traces):
+    batch = Batch(traces)
+    batch.stack_named_values()
+    return batch
+
+
+# Adapts a DataLoader giving batches of traces to the BatchGenerator interface used by InferenceNetworkFeedForward.optimize
+class DataLoaderBatchGenerator():
+    def __init__(self, data_loader):
+        self._data_loader = data_loader
+        self._iterator = None
+
+    def _next_batch(self):
+        if self._iterator is None:
+            self._iterator = iter(self._data_loader)
+        try:
+            batch = next(self._iterator)
+        except StopIteration:
+            return None
+        if not isinstance(batch, Batch):
+            raise RuntimeError('Expecting the DataLoader to give batches of traces, use collate_fn=collate_traces.')
+        batch.to(device=util._device)
+        return batch
+
+    # The batch size is that of the DataLoader, except with discard_source, where batches are combined to give length traces that are not used for training
+    def get_batch(self, length=64, discard_source=False):
+        if not discard_source:
+            return self._next_batch()
+        traces = []
+        while len(traces) < length:
+            batch = self._next_batch()
+            if batch is None:
+                return None
+            traces += batch.traces
+        return collate_traces(traces[0:length])
+
+    def scan_trace_store(self):
+        raise ValueError('Cannot scan trace store with a DataLoader.')
+
+    # DataLoader prefetches batches with its own workers
+    def start_prefetch(self, batch_size=64, num_workers=1, queue_size=4):
+        pass
+
+    def stop_prefetch(self):
+        pass
+
+    def prefetch_statistics(self):
+        return None
+
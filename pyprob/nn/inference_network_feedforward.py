@@ -1,29 +1,69 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
 import sys
 import gc
 import time
 import os
-import shutil
+import io
 import uuid
-import tempfile
 import tarfile
+import zipfile
 import copy
 from threading import Thread
+from torch.utils.data import DataLoader
 from termcolor import colored
 
-from . import EmbeddingFeedForward, EmbeddingCNN2D5C, EmbeddingCNN3D4C, ProposalNormalNormalMixture, ProposalUniformTruncatedNormalMixture, ProposalCategoricalCategorical, ProposalPoissonTruncatedNormalMixture
+from . import DataLoaderBatchGenerator, MetricsWriter, EmbeddingFeedForward, EmbeddingCNN2D5C, EmbeddingCNN3D4C, ProposalNormalNormal, ProposalNormalNormalMixture, ProposalUniformBeta, ProposalUniformTruncatedNormalMixture, ProposalCategoricalCategorical, ProposalPoissonTruncatedNormalMixture
 from .. import __version__, util, ObserveEmbedding
 from ..distributions import Normal, Uniform, Categorical, Poisson
 
 
+# Maximum length of the in-memory training histories, full-resolution metrics can be streamed to a file with optimize(metrics_file_name=...)
+_history_max_length = 4096
+
+
+def _history_append(history, history_trace, value, trace):
+    history.append(value)
+    history_trace.append(trace)
+    if len(history) > _history_max_length:
+        # Every other entry is dropped keeping the first and the last, so older parts of the history get progressively sparser
+        del history[1:-1:2]
+        del history_trace[1:-1:2]
+
+
+def _distributed_world_size():
+    # Training is data-parallel when a torch.distributed process group with several processes is initialized
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    else:
+        return 1
+
+
+# The seed set with set_random_seed from which the random number generators of this process were seeded for data-parallel training
+_distributed_base_seed = None
+
+
+def _distributed_seed(rank):
+    # Each process generates or loads its own batches. Processes other than rank 0 are seeded once with the seed set with set_random_seed offset by their rank, and are seeded again only after a new set_random_seed, so that further calls to optimize continue their random streams
+    global _distributed_base_seed
+    if rank != 0 and _distributed_base_seed != util._random_seed:
+        _distributed_base_seed = util._random_seed
+        util._seed_random_generators(util._random_seed + rank)
+
+
 class InferenceNetworkFeedForward(nn.Module):
     # observe_embeddings example: {'obs1': {'embedding':ObserveEmbedding.FEEDFORWARD, 'reshape': [10, 10], 'dim': 32, 'depth': 2}}
-    def __init__(self, model, valid_size=64, observe_embeddings={}):
+    # shared_proposal_trunks: proposal layers of the same type share a trunk, conditioned on a learned embedding of size address_embedding_dim for each address, and each address only gets a single-layer head
+    def __init__(self, model, valid_size=64, observe_embeddings={}, shared_proposal_trunks=False, address_embedding_dim=16):
         super().__init__()
         self._model = model
         self._layer_proposal = nn.ModuleDict()
+        self._layer_proposal_trunk = nn.ModuleDict()
+        self._layer_address_embedding = nn.ModuleDict()
+        self._shared_proposal_trunks = shared_proposal_trunks
+        self._address_embedding_dim = address_embedding_dim
         self._layer_observe_embedding = nn.ModuleDict()
         self._layer_observe_embedding_final = None
         self._layer_hidden_shape = None
@@ -52,6 +92,18 @@ class InferenceNetworkFeedForward(nn.Module):
         self._valid_size = valid_size
         self._observe_embeddings = observe_embeddings
         self._valid_batch = None
+        self._save_thread = None
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # Networks saved by earlier versions have no shared proposal trunks and no background saving
+        if '_shared_proposal_trunks' not in state:
+            self._shared_proposal_trunks = False
+            self._address_embedding_dim = 16
+            self._layer_proposal_trunk = nn.ModuleDict()
+            self._layer_address_embedding = nn.ModuleDict()
+        if '_save_thread' not in state:
+            self._save_thread = None
 
     def _init_layer_observe_embeddings(self, observe_embeddings):
         if len(observe_embeddings) == 0:
@@ -96,43 +148,62 @@ class InferenceNetworkFeedForward(nn.Module):
         self._layer_observe_embedding_final = EmbeddingFeedForward(input_shape=self._layer_hidden_shape, output_shape=self._layer_hidden_shape, num_layers=1)
         self._layer_observe_embedding_final.to(device=util._device)
 
-    def _save(self, file_name):
+    def _snapshot(self):
+        # Parameters and buffers are copied to a state_dict, and the rest of the network is deep-copied with the copied tensors in their place, so that training can continue while the snapshot is written
+        # The copied network shares the storage of the state_dict, which torch.save writes only once
+        state_dict = {name: tensor.detach().to(device='cpu', copy=True) for name, tensor in self.state_dict().items()}
+        memo = {id(self._model): None, id(self._optimizer): None, id(self._save_thread): None, id(self._valid_batch): self._valid_batch}
+        for name, parameter in self.named_parameters():
+            memo[id(parameter)] = nn.Parameter(state_dict[name], requires_grad=parameter.requires_grad)
+        for name, buffer in self.named_buffers():
+            memo[id(buffer)] = state_dict[name] if name in state_dict else buffer.detach().to(device='cpu', copy=True)
+        return copy.deepcopy(self, memo), state_dict
+
+    def _wait_for_save(self):
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+
+    def _save(self, file_name, background=False):
         self._modified = util.get_time_str()
         self._updates += 1
 
+        # At most one checkpoint is being written at a time
+        self._wait_for_save()
+        inference_network, state_dict = self._snapshot()
         data = {}
         data['pyprob_version'] = __version__
         data['torch_version'] = torch.__version__
-        # The following is due to a temporary hack related with https://github.com/pytorch/pytorch/issues/9981 and can be deprecated by using dill as pickler with torch > 0.4.1
-        data['inference_network'] = copy.copy(self)
-        data['inference_network']._model = None
-        data['inference_network']._optimizer = None
+        data['inference_network'] = inference_network
+        data['state_dict'] = state_dict
 
         def thread_save():
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file_name = os.path.join(tmp_dir, 'pyprob_inference_network')
-            torch.save(data, tmp_file_name)
-            tar = tarfile.open(file_name, 'w:gz', compresslevel=2)
-            tar.add(tmp_file_name, arcname='pyprob_inference_network')
-            tar.close()
-            shutil.rmtree(tmp_dir)
-        t = Thread(target=thread_save)
-        t.start()
-        t.join()
+            # Written next to the destination and renamed, so that file_name never holds a partially written network
+            tmp_file_name = '{}.{}.tmp'.format(file_name, uuid.uuid4())
+            try:
+                torch.save(data, tmp_file_name)
+                os.replace(tmp_file_name, file_name)
+            finally:
+                if os.path.exists(tmp_file_name):
+                    os.remove(tmp_file_name)
+        self._save_thread = Thread(target=thread_save)
+        self._save_thread.start()
+        if not background:
+            self._wait_for_save()
 
     @staticmethod
     def _load(file_name):
+        if util._cuda_enabled:
+            map_location = None
+        else:
+            map_location = lambda storage, loc: storage
         try:
-            tar = tarfile.open(file_name, 'r:gz')
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file = os.path.join(tmp_dir, 'pyprob_inference_network')
-            tar.extract('pyprob_inference_network', tmp_dir)
-            tar.close()
-            if util._cuda_enabled:
-                data = torch.load(tmp_file)
+            if zipfile.is_zipfile(file_name):
+                data = util.torch_load(file_name, map_location=map_location)
             else:
-                data = torch.load(tmp_file, map_location=lambda storage, loc: storage)
-                shutil.rmtree(tmp_dir)
+                # Networks saved by earlier versions are a torch.save file inside a tar.gz archive, which is read in memory
+                with tarfile.open(file_name, 'r:gz') as tar:
+                    data = util.torch_load(io.BytesIO(tar.extractfile('pyprob_inference_network').read()), map_location=map_location)
         except:
             raise RuntimeError('Cannot load inference network.')
 
@@ -142,6 +213,8 @@ class InferenceNetworkFeedForward(nn.Module):
             print(colored('Warning: different PyTorch versions (loaded network: {}, current system: {})'.format(data['torch_version'], torch.__version__), 'red', attrs=['bold']))
 
         ret = data['inference_network']
+        if 'state_dict' in data:
+            ret.load_state_dict(data['state_dict'])
         if util._cuda_enabled:
             if ret._on_cuda:
                 if ret._device != util._device:
@@ -159,10 +232,13 @@ class InferenceNetworkFeedForward(nn.Module):
         self._on_cuda = 'cuda' in str(device)
         super().to(device=device, *args, *kwargs)
 
-    def _embed_observe(self, traces=None):
+    def _embed_observe(self, traces=None, named_values={}):
         embedding = []
         for name, layer in self._layer_observe_embedding.items():
-            values = torch.stack([util.to_tensor(trace.named_variables[name].value) for trace in traces]).view(len(traces), -1)
+            if name in named_values:
+                values = named_values[name]
+            else:
+                values = torch.stack([util.to_tensor(trace.named_variables[name].value) for trace in traces]).view(len(traces), -1)
             embedding.append(layer(values))
         embedding = torch.cat(embedding, dim=1)
         embedding = self._layer_observe_embedding_final(embedding)
@@ -171,11 +247,12 @@ class InferenceNetworkFeedForward(nn.Module):
     def infer_trace_init(self, observe=None):
         self._infer_observe = observe
         embedding = []
-        for name, layer in self._layer_observe_embedding.items():
-            value = util.to_tensor(observe[name]).view(1, -1)
-            embedding.append(layer(value))
-        embedding = torch.cat(embedding, dim=1)
-        self._infer_observe_embedding = self._layer_observe_embedding_final(embedding)
+        with torch.no_grad():
+            for name, layer in self._layer_observe_embedding.items():
+                value = util.to_tensor(observe[name]).view(1, -1)
+                embedding.append(layer(value))
+            embedding = torch.cat(embedding, dim=1)
+            self._infer_observe_embedding = self._layer_observe_embedding_final(embedding)
 
     def infer_trace_step(self, variable, previous_variable=None):
         success = True
@@ -186,76 +263,198 @@ class InferenceNetworkFeedForward(nn.Module):
             success = False
 
         if success:
-            proposal_distribution = self._layer_proposal[address].forward(self._infer_observe_embedding, [variable])
+            with torch.no_grad():
+                if self._shared_proposal_trunks:
+                    proposal_input = self._proposal_trunks_forward(self._infer_observe_embedding, {address: [0]})[address]
+                else:
+                    proposal_input = self._infer_observe_embedding
+                proposal_distribution = self._layer_proposal[address].forward(proposal_input, [variable])
             return proposal_distribution
         else:
             print('Warning: no proposal can be made, prior will be used.')
             return distribution
 
     def _polymorph(self, batch):
-        layers_changed = False
+        new_variables = {}
         for sub_batch in batch.sub_batches:
             example_trace = sub_batch[0]
             for variable in example_trace.variables_controlled:
                 address = variable.address
-                distribution = variable.distribution
-                variable_shape = variable.value.shape
-                if address not in self._layer_proposal:
-                    print('New proposal layer for address: {}'.format(util.truncate_str(address)))
-                    if isinstance(distribution, Normal):
-                        layer = ProposalNormalNormalMixture(self._layer_hidden_shape, variable_shape)
-                    elif isinstance(distribution, Uniform):
-                        layer = ProposalUniformTruncatedNormalMixture(self._layer_hidden_shape, variable_shape)
-                    elif isinstance(distribution, Poisson):
-                        layer = ProposalPoissonTruncatedNormalMixture(self._layer_hidden_shape, variable_shape)
-                    elif isinstance(distribution, Categorical):
-                        layer = ProposalCategoricalCategorical(self._layer_hidden_shape, distribution.num_categories)
-                    else:
-                        raise RuntimeError('Distribution currently unsupported: {}'.format(distribution.name))
-                    layer.to(device=util._device)
-                    self._layer_proposal[address] = layer
-                    layers_changed = True
-        if layers_changed:
+                if address not in self._layer_proposal and address not in new_variables:
+                    new_variables[address] = variable
+        distributed = _distributed_world_size() > 1
+        if distributed:
+            new_variables = self._distributed_sync_new_variables(new_variables)
+        new_layers = []
+        for address, variable in new_variables.items():
+            distribution = variable.distribution
+            variable_shape = variable.value.shape
+            print('New proposal layer for address: {}'.format(util.truncate_str(address)))
+            # The mixture proposals support scalar values only, variables holding several iid values (sampled with size > 1) get elementwise proposals
+            scalar = util.prod(variable_shape) == 1
+            num_layers = 1 if self._shared_proposal_trunks else 3
+            if isinstance(distribution, Normal):
+                if scalar:
+                    layer = ProposalNormalNormalMixture(self._layer_hidden_shape, variable_shape, num_layers=num_layers)
+                else:
+                    layer = ProposalNormalNormal(self._layer_hidden_shape, variable_shape, num_layers=num_layers)
+            elif isinstance(distribution, Uniform):
+                if scalar:
+                    layer = ProposalUniformTruncatedNormalMixture(self._layer_hidden_shape, variable_shape, num_layers=num_layers)
+                else:
+                    layer = ProposalUniformBeta(self._layer_hidden_shape, variable_shape, num_layers=num_layers)
+            elif isinstance(distribution, Poisson) and scalar:
+                layer = ProposalPoissonTruncatedNormalMixture(self._layer_hidden_shape, variable_shape, num_layers=num_layers)
+            elif isinstance(distribution, Categorical):
+                layer = ProposalCategoricalCategorical(self._layer_hidden_shape, distribution.num_categories, num_layers=num_layers, output_shape=variable_shape)
+            else:
+                raise RuntimeError('Distribution currently unsupported: {}'.format(distribution.name))
+            self._layer_proposal[address] = layer
+            layers = [layer]
+            if self._shared_proposal_trunks:
+                trunk_name = type(layer).__name__
+                if trunk_name not in self._layer_proposal_trunk:
+                    print('New proposal trunk: {}'.format(trunk_name))
+                    trunk = EmbeddingFeedForward(input_shape=torch.Size([util.prod(self._layer_hidden_shape) + self._address_embedding_dim]), output_shape=self._layer_hidden_shape, num_layers=2)
+                    self._layer_proposal_trunk[trunk_name] = trunk
+                    layers.append(trunk)
+                address_embedding = nn.Embedding(1, self._address_embedding_dim)
+                self._layer_address_embedding[address] = address_embedding
+                layers.append(address_embedding)
+            for layer in layers:
+                layer.to(device=util._device)
+                if distributed:
+                    # All processes start from the parameters of the new layer in process 0
+                    for parameter in layer.parameters():
+                        dist.broadcast(parameter.data, 0)
+            new_layers += layers
+        if len(new_layers) > 0:
             num_params = sum(p.numel() for p in self.parameters())
             print('Total number of parameters: {:,}'.format(num_params))
-            self._history_num_params.append(num_params)
-            self._history_num_params_trace.append(self._total_train_traces)
-        return layers_changed
+            _history_append(self._history_num_params, self._history_num_params_trace, num_params, self._total_train_traces)
+        return new_layers
+
+    def _distributed_sync_new_variables(self, new_variables):
+        # Every process adds the proposal layers for the new addresses seen by any process, in the same order, so that parameters line up across processes in the gradient all-reduce
+        num_new_variables = torch.tensor([len(new_variables)])
+        dist.all_reduce(num_new_variables)
+        if int(num_new_variables) == 0:
+            return {}
+        all_new_variables = [None] * dist.get_world_size()
+        dist.all_gather_object(all_new_variables, list(new_variables.items()))
+        new_variables = {}
+        for process_new_variables in all_new_variables:
+            for address, variable in process_new_variables:
+                if address not in new_variables:
+                    new_variables[address] = variable
+        return {address: new_variables[address] for address in sorted(new_variables)}
+
+    def _distributed_broadcast_parameters(self):
+        for parameter in self.parameters():
+            dist.broadcast(parameter.data, 0)
+
+    def _distributed_average_gradients(self):
+        # A single all-reduce over all gradients, with a flag per parameter to keep parameters unused by all processes without gradient
+        parameters = list(self.parameters())
+        gradients = [p.grad.reshape(-1) if p.grad is not None else torch.zeros(p.numel(), device=p.device) for p in parameters]
+        used = torch.tensor([0. if p.grad is None else 1. for p in parameters], device=gradients[0].device)
+        buffer = torch.cat(gradients + [used])
+        dist.all_reduce(buffer)
+        buffer /= dist.get_world_size()
+        offset = 0
+        for parameter in parameters:
+            numel = parameter.numel()
+            parameter.grad = buffer[offset:offset + numel].view_as(parameter).clone()
+            offset += numel
+        for parameter, used in zip(parameters, buffer[offset:].tolist()):
+            if used == 0:
+                parameter.grad = None
+
+    def _distributed_all(self, value):
+        value = torch.tensor([1 if value else 0])
+        dist.all_reduce(value, op=dist.ReduceOp.MIN)
+        return bool(value)
+
+    def _proposal_trunks_forward(self, observe_embedding, address_trace_indices):
+        # Each shared trunk runs once on the rows of all the addresses that use it, the output is split back by address
+        trunk_addresses = {}
+        for address in address_trace_indices:
+            trunk_name = type(self._layer_proposal[address]).__name__
+            if trunk_name not in trunk_addresses:
+                trunk_addresses[trunk_name] = []
+            trunk_addresses[trunk_name].append(address)
+        proposal_inputs = {}
+        for trunk_name, addresses in trunk_addresses.items():
+            lengths = [len(address_trace_indices[address]) for address in addresses]
+            trace_indices = util.to_tensor([i for address in addresses for i in address_trace_indices[address]], dtype=torch.long)
+            address_embeddings = torch.cat([self._layer_address_embedding[address].weight.expand(length, -1) for address, length in zip(addresses, lengths)])
+            x = self._layer_proposal_trunk[trunk_name](torch.cat([observe_embedding[trace_indices], address_embeddings], dim=1))
+            for address, address_x in zip(addresses, x.split(lengths)):
+                proposal_inputs[address] = address_x
+        return proposal_inputs
 
     def _loss(self, batch):
         gc.collect()
-        batch_loss = 0
-        for sub_batch in batch.sub_batches:
-            example_trace = sub_batch[0]
-            observe_embedding = self._embed_observe(sub_batch)
-            sub_batch_loss = 0.
-            for time_step in range(example_trace.length_controlled):
-                address = example_trace.variables_controlled[time_step].address
-                variables = [trace.variables_controlled[time_step] for trace in sub_batch]
-                values = torch.stack([v.value for v in variables])
-                proposal_distribution = self._layer_proposal[address].forward(observe_embedding, variables)
-                log_prob = proposal_distribution.log_prob(values)
+        # Observation embeddings are computed once for the whole batch, and each proposal layer runs once on all the (trace, time step) pairs at its address, across sub-batches
+        observe_embedding = self._embed_observe(batch.traces, batch.named_values)
+        address_trace_indices = {}
+        address_variables = {}
+        for trace_index, trace in enumerate(batch.traces):
+            for variable in trace.variables_controlled:
+                address = variable.address
+                if address not in address_variables:
+                    address_trace_indices[address] = []
+                    address_variables[address] = []
+                address_trace_indices[address].append(trace_index)
+                address_variables[address].append(variable)
+        if self._shared_proposal_trunks:
+            proposal_inputs = self._proposal_trunks_forward(observe_embedding, address_trace_indices)
+        batch_loss = 0.
+        for address, variables in address_variables.items():
+            if self._shared_proposal_trunks:
+                proposal_input = proposal_inputs[address]
+            else:
+                proposal_input = observe_embedding[util.to_tensor(address_trace_indices[address], dtype=torch.long)]
+            values = torch.stack([v.value for v in variables])
+            proposal_distribution = self._layer_proposal[address].forward(proposal_input, variables)
+            log_prob = proposal_distribution.log_prob(values)
+            if util.has_nan_or_inf(log_prob):
+                print(colored('Warning: NaN, -Inf, or Inf encountered in proposal log_prob.', 'red', attrs=['bold']))
+                print('proposal_distribution', proposal_distribution)
+                print('values', values)
+                print('log_prob', log_prob)
+                print('Fixing -Inf')
+                log_prob = util.replace_negative_inf(log_prob)
+                print('log_prob', log_prob)
                 if util.has_nan_or_inf(log_prob):
-                    print(colored('Warning: NaN, -Inf, or Inf encountered in proposal log_prob.', 'red', attrs=['bold']))
-                    print('proposal_distribution', proposal_distribution)
-                    print('values', values)
-                    print('log_prob', log_prob)
-                    print('Fixing -Inf')
-                    log_prob = util.replace_negative_inf(log_prob)
-                    print('log_prob', log_prob)
-                    if util.has_nan_or_inf(log_prob):
-                        print(colored('Nan or Inf present in proposal log_prob.', 'red', attrs=['bold']))
-                        return False, 0
-                sub_batch_loss += -torch.sum(log_prob)
-            batch_loss += sub_batch_loss
+                    print(colored('Nan or Inf present in proposal log_prob.', 'red', attrs=['bold']))
+                    return False, 0
+            batch_loss += -torch.sum(log_prob)
         return True, batch_loss / batch.length
 
-    def optimize(self, num_traces, batch_generator, batch_size=64, valid_interval=1000, learning_rate=0.0001, weight_decay=1e-5, auto_save_file_name_prefix=None, auto_save_interval_sec=600, *args, **kwargs):
+    def optimize(self, num_traces, batch_generator, batch_size=64, valid_interval=1000, learning_rate=0.0001, weight_decay=1e-5, auto_save_file_name_prefix=None, auto_save_interval_sec=600, prefetch_batches=0, prefetch_workers=1, scan_trace_store=False, metrics_file_name=None, *args, **kwargs):
+        if isinstance(batch_generator, DataLoader):
+            # The batch size and prefetching are those of the DataLoader
+            batch_generator = DataLoaderBatchGenerator(batch_generator)
+        world_size = _distributed_world_size()
+        distributed = world_size > 1
+        if distributed:
+            rank = dist.get_rank()
+            _distributed_seed(rank)
+        else:
+            rank = 0
         if self._valid_batch is None:
             print('Initializing inference network...')
             self._valid_batch = batch_generator.get_batch(self._valid_size, discard_source=True)
             self._init_layer_observe_embeddings(self._observe_embeddings)
             self._polymorph(self._valid_batch)
+        if scan_trace_store:
+            # Layers for all the addresses in the trace store are created before training starts
+            for layer in self._polymorph(batch_generator.scan_trace_store()):
+                if self._optimizer is not None:
+                    self._optimizer.add_param_group({'params': layer.parameters()})
+        if distributed:
+            self._distributed_broadcast_parameters()
 
         prev_total_train_seconds = self._total_train_seconds
         time_start = time.time()
@@ -264,88 +463,132 @@ class InferenceNetworkFeedForward(nn.Module):
         last_validation_trace = -valid_interval + 1
         iteration = 0
         trace = 0
+        num_sub_batches = 0
+        num_sub_batch_traces = 0
         stop = False
         print('Train. time | Trace     | Init. loss| Min. loss | Curr. loss| T.since min | Traces/sec')
         max_print_line_len = 0
         loss_min_str = ''
         time_since_loss_min_str = ''
         last_auto_save_time = time.time() - auto_save_interval_sec
-        while not stop:
-            iteration += 1
-            batch = batch_generator.get_batch(batch_size)
-            layers_changed = self._polymorph(batch)
-
-            if (self._optimizer is None) or layers_changed:
-                self._optimizer = optim.Adam(self.parameters(), lr=learning_rate, weight_decay=weight_decay)
-
-            self._optimizer.zero_grad()
-            success, loss = self._loss(batch)
-            if not success:
-                print(colored('Cannot compute loss, skipping batch. Loss: {}'.format(loss), 'red', attrs=['bold']))
-            else:
-                loss.backward()
-                self._optimizer.step()
-                loss = float(loss)
-
-                if self._loss_initial is None:
-                    self._loss_initial = loss
-                    self._loss_max = loss
-                loss_initial_str = '{:+.2e}'.format(self._loss_initial)
-                # loss_max_str = '{:+.3e}'.format(self._loss_max)
-                if loss < self._loss_min:
-                    self._loss_min = loss
-                    loss_str = colored('{:+.2e}'.format(loss), 'green', attrs=['bold'])
-                    loss_min_str = colored('{:+.2e}'.format(self._loss_min), 'green', attrs=['bold'])
-                    time_loss_min = time.time()
-                    time_since_loss_min_str = colored(util.days_hours_mins_secs_str(0), 'green', attrs=['bold'])
-                elif loss > self._loss_max:
-                    self._loss_max = loss
-                    loss_str = colored('{:+.2e}'.format(loss), 'red', attrs=['bold'])
-                    # loss_max_str = colored('{:+.3e}'.format(self._loss_max), 'red', attrs=['bold'])
+        # Processes hold the same parameters, only process 0 writes metrics
+        metrics_writer = None
+        if metrics_file_name is not None and rank == 0:
+            metrics_writer = MetricsWriter(metrics_file_name)
+        if prefetch_batches > 0:
+            batch_generator.start_prefetch(batch_size, num_workers=prefetch_workers, queue_size=prefetch_batches)
+        try:
+            while not stop:
+                iteration += 1
+                time_batch_wait = time.time()
+                batch = batch_generator.get_batch(batch_size)
+                batch_wait_sec = time.time() - time_batch_wait
+                if distributed:
+                    # All processes stop together when any of them runs out of batches, otherwise the others would wait for it in the collective operations
+                    if not self._distributed_all(batch is not None):
+                        break
+                elif batch is None:
+                    # A finite DataLoader is exhausted
+                    break
+                new_layers = self._polymorph(batch)
+
+                if self._optimizer is None:
+                    self._optimizer = optim.Adam(self.parameters(), lr=learning_rate, weight_decay=weight_decay)
                 else:
-                    if loss < self._loss_previous:
-                        loss_str = colored('{:+.2e}'.format(loss), 'green')
-                    elif loss > self._loss_previous:
-                        loss_str = colored('{:+.2e}'.format(loss), 'red')
-                    else:
-                        loss_str = '{:+.2e}'.format(loss)
-                    loss_min_str = '{:+.2e}'.format(self._loss_min)
+                    # New layers join the optimizer as new parameter groups with fresh state, keeping the state of existing layers
+                    for layer in new_layers:
+                        self._optimizer.add_param_group({'params': layer.parameters()})
+
+                self._optimizer.zero_grad()
+                success, loss = self._loss(batch)
+                if distributed:
+                    # The batch is skipped by all processes if any of them cannot compute its loss
+                    success = self._distributed_all(success)
+                if not success:
+                    print(colored('Cannot compute loss, skipping batch. Loss: {}'.format(loss), 'red', attrs=['bold']))
+                else:
+                    loss.backward()
+                    if distributed:
+                        self._distributed_average_gradients()
+                    self._optimizer.step()
+                    loss = float(loss)
+
+                    if self._loss_initial is None:
+                        self._loss_initial = loss
+                        self._loss_max = loss
+                    loss_initial_str = '{:+.2e}'.format(self._loss_initial)
                     # loss_max_str = '{:+.3e}'.format(self._loss_max)
-                    time_since_loss_min_str = util.days_hours_mins_secs_str(time.time() - time_loss_min)
-
-                self._loss_previous = loss
-                self._total_train_iterations += 1
-                trace += batch.length
-                self._total_train_traces += batch.length
-                total_training_traces_str = '{:9}'.format('{:,}'.format(self._total_train_traces))
-                self._total_train_seconds = prev_total_train_seconds + (time.time() - time_start)
-                total_training_seconds_str = util.days_hours_mins_secs_str(self._total_train_seconds)
-                traces_per_second_str = '{:,.1f}'.format(int(batch.length / (time.time() - time_last_batch)))
-                time_last_batch = time.time()
-                if num_traces is not None:
-                    if trace >= num_traces:
-                        stop = True
-
-                self._history_train_loss.append(loss)
-                self._history_train_loss_trace.append(self._total_train_traces)
-                if trace - last_validation_trace > valid_interval:
-                    print('\rComputing validation loss...', end='\r')
-                    with torch.no_grad():
-                        _, valid_loss = self._loss(self._valid_batch)
-                    valid_loss = float(valid_loss)
-                    self._history_valid_loss.append(valid_loss)
-                    self._history_valid_loss_trace.append(self._total_train_traces)
-                    last_validation_trace = trace - 1
-
-                if auto_save_file_name_prefix is not None:
-                    if time.time() - last_auto_save_time > auto_save_interval_sec:
-                        last_auto_save_time = time.time()
-                        file_name = '{}_{}.network'.format(auto_save_file_name_prefix, util.get_time_stamp())
-                        print('\rSaving to disk...', end='\r')
-                        self._save(file_name)
-
-                print_line = '{} | {} | {} | {} | {} | {} | {}'.format(total_training_seconds_str, total_training_traces_str, loss_initial_str, loss_min_str, loss_str, time_since_loss_min_str, traces_per_second_str)
-                max_print_line_len = max(len(print_line), max_print_line_len)
-                print(print_line.ljust(max_print_line_len), end='\r')
-                sys.stdout.flush()
+                    if loss < self._loss_min:
+                        self._loss_min = loss
+                        loss_str = colored('{:+.2e}'.format(loss), 'green', attrs=['bold'])
+                        loss_min_str = colored('{:+.2e}'.format(self._loss_min), 'green', attrs=['bold'])
+                        time_loss_min = time.time()
+                        time_since_loss_min_str = colored(util.days_hours_mins_secs_str(0), 'green', attrs=['bold'])
+                    elif loss > self._loss_max:
+                        self._loss_max = loss
+                        loss_str = colored('{:+.2e}'.format(loss), 'red', attrs=['bold'])
+                        # loss_max_str = colored('{:+.3e}'.format(self._loss_max), 'red', attrs=['bold'])
+                    else:
+                        if loss < self._loss_previous:
+                            loss_str = colored('{:+.2e}'.format(loss), 'green')
+                        elif loss > self._loss_previous:
+                            loss_str = colored('{:+.2e}'.format(loss), 'red')
+                        else:
+                            loss_str = '{:+.2e}'.format(loss)
+                        loss_min_str = '{:+.2e}'.format(self._loss_min)
+                        # loss_max_str = '{:+.3e}'.format(self._loss_max)
+                        time_since_loss_min_str = util.days_hours_mins_secs_str(time.time() - time_loss_min)
+
+                    self._loss_previous = loss
+                    self._total_train_iterations += 1
+                    # With data-parallel training, traces are counted over all processes
+                    trace += batch.length * world_size
+                    num_sub_batches += len(batch.sub_batches)
+                    num_sub_batch_traces += batch.length
+                    self._total_train_traces += batch.length * world_size
+                    total_training_traces_str = '{:9}'.format('{:,}'.format(self._total_train_traces))
+                    self._total_train_seconds = prev_total_train_seconds + (time.time() - time_start)
+                    total_training_seconds_str = util.days_hours_mins_secs_str(self._total_train_seconds)
+                    traces_per_second = batch.length * world_size / (time.time() - time_last_batch)
+                    traces_per_second_str = '{:,.1f}'.format(int(traces_per_second))
+                    time_last_batch = time.time()
+                    if num_traces is not None:
+                        if trace >= num_traces:
+                            stop = True
+
+                    _history_append(self._history_train_loss, self._history_train_loss_trace, loss, self._total_train_traces)
+                    valid_loss = None
+                    if trace - last_validation_trace > valid_interval:
+                        print('\rComputing validation loss...', end='\r')
+                        with torch.no_grad():
+                            _, valid_loss = self._loss(self._valid_batch)
+                        valid_loss = float(valid_loss)
+                        _history_append(self._history_valid_loss, self._history_valid_loss_trace, valid_loss, self._total_train_traces)
+                        last_validation_trace = trace - 1
+
+                    if metrics_writer is not None:
+                        metrics_writer.write(time_sec=self._total_train_seconds, traces=self._total_train_traces, iteration=self._total_train_iterations, loss=loss, valid_loss=valid_loss, traces_per_sec=traces_per_second, batch_wait_sec=batch_wait_sec, sub_batches=len(batch.sub_batches), sub_batch_size_mean=batch.length / len(batch.sub_batches), num_params=self._history_num_params[-1])
+
+                    # Processes hold the same parameters, only process 0 saves
+                    if auto_save_file_name_prefix is not None and rank == 0:
+                        if time.time() - last_auto_save_time > auto_save_interval_sec:
+                            last_auto_save_time = time.time()
+                            file_name = '{}_{}.network'.format(auto_save_file_name_prefix, util.get_time_stamp())
+                            print('\rSaving to disk...', end='\r')
+                            self._save(file_name, background=True)
+
+                    if rank == 0:
+                        print_line = '{} | {} | {} | {} | {} | {} | {}'.format(total_training_seconds_str, total_training_traces_str, loss_initial_str, loss_min_str, loss_str, time_since_loss_min_str, traces_per_second_str)
+                        max_print_line_len = max(len(print_line), max_print_line_len)
+                        print(print_line.ljust(max_print_line_len), end='\r')
+                        sys.stdout.flush()
+        finally:
+            prefetch_statistics = batch_generator.prefetch_statistics()
+            batch_generator.stop_prefetch()
+            self._wait_for_save()
+            if metrics_writer is not None:
+                metrics_writer.close()
         print()
+        print('Mean sub-batch size: {:.2f}'.format(num_sub_batch_traces / max(1, num_sub_batches)))
+        if prefetch_statistics is not None:
+            print('Prefetched batches: {:,}, mean queue depth: {:.2f}, time waiting for batches: {} ({:.1f} ms/batch)'.format(prefetch_statistics['batches'], prefetch_statistics['queue_depth_mean'], util.days_hours_mins_secs_str(prefetch_statistics['wait_sec_total']), 1000 * prefetch_statistics['wait_sec_mean']))
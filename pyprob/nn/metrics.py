@@ -0,0 +1,61 @@
+import os
+import csv
+import json
+
+
+metrics_columns = ['time_sec', 'traces', 'iteration', 'loss', 'valid_loss', 'traces_per_sec', 'batch_wait_sec', 'sub_batches', 'sub_batch_size_mean', 'num_params']
+
+
+def _metrics_format(file_name):
+    return 'jsonl' if os.path.splitext(file_name)[1].lower() in ['.jsonl', '.json'] else 'csv'
+
+
+# Append-only training metrics file, one row per training iteration, written as JSON lines for file names ending in .jsonl and as CSV otherwise
+class MetricsWriter():
+    def __init__(self, file_name, flush_interval=100):
+        self._file_name = file_name
+        self._format = _metrics_format(file_name)
+        self._flush_interval = flush_interval
+        self._num_rows = 0
+        new_file = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+        self._file = open(file_name, 'a', newline='')
+        if self._format == 'csv':
+            self._csv_writer = csv.DictWriter(self._file, fieldnames=metrics_columns)
+            if new_file:
+                self._csv_writer.writeheader()
+
+    def write(self, **kwargs):
+        row = {column: kwargs.get(column) for column in metrics_columns}
+        if self._format == 'csv':
+            self._csv_writer.writerow(row)
+        else:
+            self._file.write(json.dumps(row) + '\n')
+        self._num_rows += 1
+        if self._num_rows % self._flush_interval == 0:
+            self._file.flush()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_metrics(file_name):
+    if not os.path.exists(file_name):
+        raise RuntimeError('Metrics file does not exist: {}'.format(file_name))
+    metrics = {column: [] for column in metrics_columns}
+    with open(file_name, 'r', newline='') as file:
+        if _metrics_format(file_name) == 'csv':
+            rows = csv.DictReader(file)
+        else:
+            rows = (json.loads(line) for line in file if line.strip() != '')
+        for row in rows:
+            for column in metrics_columns:
+                value = row.get(column)
+                if value is None or value == '':
+                    value = None
+                else:
+                    value = float(value)
+                metrics[column].append(value)
+    return metrics
@@ -7,12 +7,16 @@ from ..distributions import Categorical
 
 
 class ProposalCategoricalCategorical(nn.Module):
-    def __init__(self, input_shape, num_categories, num_layers=3):
+    def __init__(self, input_shape, num_categories, num_layers=3, output_shape=torch.Size()):
         super().__init__()
-        self._ff = EmbeddingFeedForward(input_shape=input_shape, output_shape=torch.Size([num_categories]), num_layers=num_layers, activation=torch.relu, activation_last=None)
+        # output_shape is the shape of the proposed value, which is non-scalar for variables holding several iid values
+        self._num_categories = num_categories
+        self._output_shape = output_shape
+        self._ff = EmbeddingFeedForward(input_shape=input_shape, output_shape=torch.Size([util.prod(output_shape) * num_categories]), num_layers=num_layers, activation=torch.relu, activation_last=None)
 
     def forward(self, x, prior_variables):
         batch_size = x.size(0)
         x = self._ff(x)
-        probs = torch.softmax(x, dim=1).view(batch_size, -1) + util._epsilon
+        x = x.view(torch.Size([batch_size]) + self._output_shape + torch.Size([self._num_categories]))
+        probs = torch.softmax(x, dim=-1) + util._epsilon
         return Categorical(probs)
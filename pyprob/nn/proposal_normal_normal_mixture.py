@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 
 from . import EmbeddingFeedForward
-from ..distributions import Normal, Mixture
+from ..distributions import NormalMixture
 
 
 class ProposalNormalNormalMixture(nn.Module):
@@ -28,5 +28,4 @@ class ProposalNormalNormalMixture(nn.Module):
         stddevs = stddevs * prior_stddevs
         means = means.view(batch_size, -1)
         stddevs = stddevs.view(batch_size, -1)
-        distributions = [Normal(means[:, i:i+1].view(batch_size), stddevs[:, i:i+1].view(batch_size)) for i in range(self._mixture_components)]
-        return Mixture(distributions, coeffs)
+        return NormalMixture(means, stddevs, coeffs)
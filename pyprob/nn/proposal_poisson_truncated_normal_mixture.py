@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 
 from . import EmbeddingFeedForward
-from ..distributions import TruncatedNormal, Mixture
+from ..distributions import TruncatedNormalMixture
 
 
 class ProposalPoissonTruncatedNormalMixture(nn.Module):
@@ -29,5 +29,4 @@ class ProposalPoissonTruncatedNormalMixture(nn.Module):
         prior_highs = torch.zeros(batch_size).fill_(self._high)
         means = prior_lows.view(batch_size, -1).expand_as(means) + (means * (prior_highs - prior_lows).view(batch_size, -1).expand_as(means))
         # stddevs = stddevs * prior_stddevs
-        distributions = [TruncatedNormal(means[:, i:i+1].view(batch_size), stddevs[:, i:i+1].view(batch_size), low=prior_lows, high=prior_highs) for i in range(self._mixture_components)]
-        return Mixture(distributions, coeffs)
+        return TruncatedNormalMixture(means, stddevs, low=prior_lows, high=prior_highs, probs=coeffs)
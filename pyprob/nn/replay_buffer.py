@@ -0,0 +1,63 @@
+import random
+import shelve
+
+
+# A bounded buffer of traces, kept in memory or on disk (as a shelve file) when file_name is given
+# eviction: 'fifo' replaces the oldest trace when the buffer is full, 'reservoir' keeps a uniform random sample of all the traces added so far
+class ReplayBuffer():
+    def __init__(self, size, eviction='fifo', file_name=None):
+        if size < 1:
+            raise ValueError('Expecting a replay buffer size of at least 1.')
+        if eviction not in ['fifo', 'reservoir']:
+            raise ValueError('Unknown replay buffer eviction: {}, expecting fifo or reservoir.'.format(eviction))
+        self._size = size
+        self._eviction = eviction
+        self._file_name = file_name
+        self._num_added = 0
+        self.length = 0
+        if file_name is None:
+            self._traces = []
+        else:
+            self._shelf = shelve.open(file_name, flag='n')
+
+    def __len__(self):
+        return self.length
+
+    def _set(self, slot, trace):
+        if self._file_name is None:
+            if slot == len(self._traces):
+                self._traces.append(trace)
+            else:
+                self._traces[slot] = trace
+        else:
+            self._shelf[str(slot)] = trace
+
+    def _get(self, slot):
+        if self._file_name is None:
+            return self._traces[slot]
+        else:
+            return self._shelf[str(slot)]
+
+    def add(self, traces):
+        for trace in traces:
+            if self._num_added < self._size:
+                slot = self._num_added
+                self.length += 1
+            elif self._eviction == 'fifo':
+                slot = self._num_added % self._size
+            else:
+                # Reservoir sampling, the n-th trace is kept with probability size/n
+                slot = random.randrange(self._num_added + 1)
+                if slot >= self._size:
+                    slot = None
+            self._num_added += 1
+            if slot is not None:
+                self._set(slot, trace)
+
+    # Uniformly sampled traces, without replacement
+    def sample(self, length):
+        return [self._get(slot) for slot in random.sample(range(self.length), min(length, self.length))]
+
+    def close(self):
+        if self._file_name is not None:
+            self._shelf.close()
@@ -0,0 +1,327 @@
+import torch
+import numpy as np
+import os
+import json
+import struct
+import uuid
+import tarfile
+import io
+import time
+import hashlib
+import pickle
+import zlib
+from termcolor import colored
+
+from .. import __version__, util
+from ..distributions import Normal, Categorical, Uniform, Poisson, Beta, TruncatedNormal
+from ..trace import Variable, Trace
+from ..state import _split_distribution
+
+
+# Indexed trace store files start with this marker, followed by the header length, a JSON header and the data arrays. The header indexes the trace types in the file, and for each of them the offsets of one value array and the distribution parameter arrays per variable, holding all the traces of the type
+_magic = b'PYPROBTS'
+_alignment = 64
+# JSON lines file in the trace store directory with one entry per trace store file written, hidden so that it is not taken for a trace store file
+manifest_file_name = '.pyprob_manifest.jsonl'
+# Errors from reading a truncated, corrupt or foreign file, in either trace store format
+_load_errors = (OSError, EOFError, ValueError, KeyError, IndexError, RuntimeError, struct.error, tarfile.TarError, zlib.error, pickle.UnpicklingError)
+
+
+def _distribution_params(distribution):
+    if isinstance(distribution, Normal):
+        return [distribution.mean, distribution.stddev]
+    elif isinstance(distribution, Uniform):
+        return [distribution.low, distribution.high]
+    elif isinstance(distribution, Poisson):
+        return [distribution.rate]
+    elif isinstance(distribution, Categorical):
+        return [distribution.probs]
+    elif isinstance(distribution, Beta):
+        return [distribution.concentration1, distribution.concentration0, distribution.low, distribution.high]
+    elif isinstance(distribution, TruncatedNormal):
+        return [distribution.mean_non_truncated, distribution.stddev_non_truncated, distribution.low, distribution.high]
+    else:
+        raise ValueError('Distribution currently unsupported in trace stores: {}'.format(distribution.name))
+
+
+def _stored_distribution_params(variable):
+    # Controlled variables need their distributions in training, for the other variables distributions of unsupported types are not stored
+    if variable.distribution is None:
+        return None
+    if variable.control:
+        return _distribution_params(variable.distribution)
+    try:
+        return _distribution_params(variable.distribution)
+    except ValueError:
+        return None
+
+
+def _distribution_from_params(name, params):
+    # Builds the distribution batched over the traces of a trace type
+    if name == 'Normal':
+        return Normal(*params)
+    elif name == 'Uniform':
+        return Uniform(*params)
+    elif name == 'Poisson':
+        return Poisson(*params)
+    elif name == 'Categorical':
+        return Categorical(*params)
+    elif name == 'Beta':
+        return Beta(params[0], params[1], low=params[2], high=params[3])
+    elif name == 'TruncatedNormal':
+        return TruncatedNormal(*params)
+    else:
+        raise ValueError('Distribution currently unsupported in trace stores: {}'.format(name))
+
+
+def _trace_store_variables(trace):
+    # The variables kept in trace stores: the controlled variables, in the order that defines the trace type, followed by the other named or observed variables
+    # Not kept are the controlled variables replaced in rejection sampling loops (only the accepted one is kept, with its replace flag), the uncontrolled unnamed variables, and the result of the trace
+    # The log_prob of every kept variable and the log_prob, log_prob_observed and log_importance_weight of the trace are stored, so loaded traces report those of the original trace
+    variables = list(trace.variables_controlled)
+    controlled = set([id(variable) for variable in variables])
+    variables += [variable for variable in trace.variables if (variable.name is not None or variable.observed) and id(variable) not in controlled]
+    return variables
+
+
+def _tensor(value):
+    return util.to_tensor(value) if not torch.is_tensor(value) else value
+
+
+def _trace_type_key(trace, variables):
+    # Traces of the same type whose values or parameters differ in shape, or whose variables differ in their replace or reused flags, are stored in separate groups
+    shapes = []
+    for variable in variables:
+        shapes.append((tuple(_tensor(variable.value).size()), variable.replace, variable.reused))
+        params = _stored_distribution_params(variable)
+        shapes.append(None if params is None else tuple([tuple(_tensor(param).size()) for param in params]))
+    return (''.join([variable.address for variable in trace.variables_controlled]), tuple(shapes))
+
+
+def save_trace_store_file(traces, file_name, model_name=None):
+    groups = {}
+    for trace in traces:
+        variables = _trace_store_variables(trace)
+        key = _trace_type_key(trace, variables)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append((trace, variables))
+
+    arrays = []
+    offset = 0
+
+    def add_array(tensor):
+        nonlocal offset
+        array = tensor.detach().cpu().contiguous().numpy()
+        entry = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        arrays.append(array)
+        offset += array.nbytes
+        padding = (-offset) % _alignment
+        if padding > 0:
+            arrays.append(np.zeros(padding, dtype=np.uint8))
+            offset += padding
+        return entry
+
+    trace_types = []
+    for (trace_hash, _), group in groups.items():
+        example_variables = group[0][1]
+        columns = []
+        for i, variable in enumerate(example_variables):
+            column = {'address': variable.address, 'address_base': variable.address_base, 'instance': variable.instance, 'name': variable.name, 'control': variable.control, 'replace': variable.replace, 'observed': variable.observed, 'reused': variable.reused}
+            column['value'] = add_array(torch.stack([_tensor(variables[i].value) for _, variables in group]))
+            column['log_prob'] = add_array(torch.stack([util.to_tensor(variables[i].log_prob) for _, variables in group]))
+            if _stored_distribution_params(variable) is not None:
+                column['distribution'] = variable.distribution.name
+                params = [_stored_distribution_params(variables[i]) for _, variables in group]
+                column['params'] = [add_array(torch.stack([_tensor(p[j]) for p in params])) for j in range(len(params[0]))]
+            columns.append(column)
+        trace_type = {'hash': trace_hash, 'length': len(group), 'variables': columns}
+        for name in ['log_prob', 'log_prob_observed', 'log_importance_weight']:
+            trace_type[name] = add_array(torch.stack([util.to_tensor(getattr(trace, name)) for trace, _ in group]))
+        trace_types.append(trace_type)
+
+    header = {'format_version': 2, 'pyprob_version': __version__, 'torch_version': torch.__version__, 'model_name': model_name, 'length': len(traces), 'trace_types': trace_types}
+    header = json.dumps(header).encode('utf-8')
+    # The header is padded with spaces so that the data arrays start aligned
+    header += b' ' * ((-(len(_magic) + 8 + len(header))) % _alignment)
+
+    # Written next to the destination and renamed, so that readers monitoring the trace store never see a partially written file
+    tmp_file_name = os.path.join(os.path.dirname(file_name), '.{}.{}.tmp'.format(os.path.basename(file_name), uuid.uuid4()))
+    try:
+        with open(tmp_file_name, 'wb') as file:
+            file.write(_magic)
+            file.write(struct.pack('<Q', len(header)))
+            file.write(header)
+            for array in arrays:
+                file.write(array.tobytes())
+        os.replace(tmp_file_name, file_name)
+    finally:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+    return [(trace_type['hash'], trace_type['length']) for trace_type in trace_types]
+
+
+def _trace_type_digest(trace_hash):
+    return hashlib.md5(trace_hash.encode('utf-8')).hexdigest()[:16]
+
+
+def append_manifest(trace_store_dir, file_name, trace_types):
+    # trace_types: (trace hash, number of traces) pairs, as returned by save_trace_store_file
+    histogram = {}
+    for trace_hash, length in trace_types:
+        digest = _trace_type_digest(trace_hash)
+        histogram[digest] = histogram.get(digest, 0) + length
+    entry = {'file_name': os.path.basename(file_name), 'traces': sum(histogram.values()), 'trace_types': histogram, 'time': time.time()}
+    # A single write to a file opened for appending, so that entries from concurrent writers do not interleave
+    fd = os.open(os.path.join(trace_store_dir, manifest_file_name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def read_manifest(trace_store_dir):
+    file_name = os.path.join(trace_store_dir, manifest_file_name)
+    if not os.path.exists(file_name):
+        return []
+    entries = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            # The last line can be incomplete while an entry is being written
+            if line.endswith('\n'):
+                entries.append(json.loads(line))
+    return entries
+
+
+def is_trace_store_file(file_name):
+    with open(file_name, 'rb') as file:
+        return file.read(len(_magic)) == _magic
+
+
+class TraceStoreFile():
+    def __init__(self, file_name):
+        self._file_name = file_name
+        with open(file_name, 'rb') as file:
+            if file.read(len(_magic)) != _magic:
+                raise RuntimeError('Not an indexed trace store file: {}'.format(file_name))
+            header_length = struct.unpack('<Q', file.read(8))[0]
+            header = json.loads(file.read(header_length).decode('utf-8'))
+        data_start = len(_magic) + 8 + header_length
+        self.pyprob_version = header['pyprob_version']
+        self.torch_version = header['torch_version']
+        self.model_name = header['model_name']
+        self.length = header['length']
+        self.trace_types = header['trace_types']
+        # Copy-on-write memory map, arrays are views into the file that are only read from disk when accessed
+        self._data = np.memmap(file_name, dtype=np.uint8, mode='c')
+
+        def array(entry):
+            start = data_start + entry['offset']
+            dtype = np.dtype(entry['dtype'])
+            num_bytes = dtype.itemsize * int(np.prod(entry['shape']))
+            return torch.from_numpy(self._data[start:start + num_bytes].view(dtype).reshape(entry['shape']))
+
+        self._columns = []
+        self._trace_columns = []
+        self._trace_type_offsets = []
+        offset = 0
+        for trace_type in self.trace_types:
+            # Files of format version 1 have no log_prob arrays, which are then computed from the distributions when accessed
+            self._columns.append([(array(column['value']), [array(param) for param in column['params']] if 'params' in column else None, array(column['log_prob']) if 'log_prob' in column else None) for column in trace_type['variables']])
+            self._trace_columns.append(dict([(name, array(trace_type[name])) for name in ['log_prob', 'log_prob_observed', 'log_importance_weight'] if name in trace_type]))
+            self._trace_type_offsets.append(offset)
+            offset += trace_type['length']
+
+    def __len__(self):
+        return self.length
+
+    def traces(self, indices=None):
+        # Returns the traces at the given indices in the file, in trace type order. Values are views into the memory-mapped arrays and distributions are built batched per trace type, but every returned trace is a full Trace with its Variable and distribution objects, built on each call
+        # Traces hold the variables kept by _trace_store_variables, in that order, and have no result
+        if indices is None:
+            indices = torch.arange(self.length)
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        traces = []
+        for trace_type, columns, trace_columns, trace_type_offset in zip(self.trace_types, self._columns, self._trace_columns, self._trace_type_offsets):
+            type_indices = indices[(indices >= trace_type_offset) & (indices < trace_type_offset + trace_type['length'])] - trace_type_offset
+            num_traces = type_indices.numel()
+            if num_traces == 0:
+                continue
+            contiguous = bool((type_indices[1:] - type_indices[:-1] == 1).all())
+            start = int(type_indices[0])
+
+            def select(array):
+                if array is None:
+                    return None
+                return array[start:start + num_traces] if contiguous else array[type_indices]
+
+            variables = []
+            for column, (values, params, log_probs) in zip(trace_type['variables'], columns):
+                values = select(values)
+                params = None if params is None else [select(param) for param in params]
+                log_probs = [None] * num_traces if log_probs is None else select(log_probs).unbind(0)
+                distributions = [None] * num_traces if params is None else _split_distribution(_distribution_from_params(column['distribution'], params))
+                variables.append((column, values.unbind(0), distributions, log_probs))
+            trace_columns = dict([(name, select(array).unbind(0)) for name, array in trace_columns.items()])
+            for i in range(num_traces):
+                trace = Trace()
+                for column, values, distributions, log_probs in variables:
+                    trace.add(Variable(distribution=distributions[i], value=values[i], address_base=column['address_base'], address=column['address'], instance=column['instance'], log_prob=log_probs[i], control=column['control'], replace=column.get('replace', False), name=column['name'], observed=column['observed'], reused=column.get('reused', False)))
+                trace.end(None, 0.)
+                if 'log_prob' in trace_columns:
+                    trace._log_prob = trace_columns['log_prob'][i]
+                    trace._log_prob_observed = trace_columns['log_prob_observed'][i]
+                    trace.log_importance_weight = trace_columns['log_importance_weight'][i]
+                traces.append(trace)
+        return traces
+
+
+def _load_traces_tar_gz(file_name):
+    # Trace store files written by earlier versions are a torch.save file of pickled traces inside a tar.gz archive, which is read in memory
+    with tarfile.open(file_name, 'r:gz') as tar:
+        data = util.torch_load(io.BytesIO(tar.extractfile('pyprob_traces').read()), map_location=None if util._cuda_enabled else lambda storage, loc: storage)
+    return data
+
+
+def load_trace_store_file(file_name):
+    try:
+        if is_trace_store_file(file_name):
+            trace_store_file = TraceStoreFile(file_name)
+            data = {'pyprob_version': trace_store_file.pyprob_version, 'torch_version': trace_store_file.torch_version, 'model_name': trace_store_file.model_name, 'traces': trace_store_file.traces()}
+        else:
+            data = _load_traces_tar_gz(file_name)
+    except _load_errors:
+        print(colored('Warning: cannot load traces from file, file potentially corrupt: {}'.format(file_name), 'red', attrs=['bold']))
+        return []
+
+    if data['pyprob_version'] != __version__:
+        print(colored('Warning: different pyprob versions (loaded traces: {}, current system: {})'.format(data['pyprob_version'], __version__), 'red', attrs=['bold']))
+    if data['torch_version'] != torch.__version__:
+        print(colored('Warning: different PyTorch versions (loaded traces: {}, current system: {})'.format(data['torch_version'], torch.__version__), 'red', attrs=['bold']))
+    return data['traces']
+
+
+# Converts the tar.gz trace store files in trace_store_dir to indexed trace store files, written to new_trace_store_dir (in place when not given)
+def convert_trace_store(trace_store_dir, new_trace_store_dir=None):
+    if new_trace_store_dir is None:
+        new_trace_store_dir = trace_store_dir
+    if not os.path.exists(new_trace_store_dir):
+        print('Directory does not exist, creating: {}'.format(new_trace_store_dir))
+        os.makedirs(new_trace_store_dir)
+    num_files = 0
+    num_traces = 0
+    for name in sorted(os.listdir(trace_store_dir)):
+        file_name = os.path.join(trace_store_dir, name)
+        if name.startswith('.') or not os.path.isfile(file_name) or is_trace_store_file(file_name):
+            continue
+        try:
+            data = _load_traces_tar_gz(file_name)
+        except _load_errors:
+            print(colored('Warning: cannot load traces from file, skipping: {}'.format(file_name), 'red', attrs=['bold']))
+            continue
+        trace_types = save_trace_store_file(data['traces'], os.path.join(new_trace_store_dir, name), data.get('model_name'))
+        append_manifest(new_trace_store_dir, name, trace_types)
+        num_files += 1
+        num_traces += len(data['traces'])
+    print('Converted {} trace store files with {:,} traces to {}'.format(num_files, num_traces, new_trace_store_dir))
+    return num_files
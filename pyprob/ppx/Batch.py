@@ -0,0 +1,53 @@
+# Not generated: written by hand in the layout of the FlatBuffers compiler output. The ppx schema
+# (ppx.fbs, https://github.com/probprog/ppx) does not have batches yet, these files follow this extension of it:
+#
+#   table Handshake { system_name:string; batch:bool; }
+#   table HandshakeResult { system_name:string; model_name:string; batch:bool; }
+#   table Batch { messages:[Message]; }
+#   table BatchResult { results:[Message]; }
+#   union MessageBody { Handshake, HandshakeResult, Run, RunResult, Sample, SampleResult, Observe, ObserveResult, Reset, Batch, BatchResult }
+#
+# Batch and BatchResult are only sent once both sides set batch in the handshake. Once the upstream schema has them, regenerate with flatc --python
+
+# namespace: ppx
+
+import flatbuffers
+
+class Batch(object):
+    __slots__ = ['_tab']
+
+    @classmethod
+    def GetRootAsBatch(cls, buf, offset):
+        n = flatbuffers.encode.Get(flatbuffers.packer.uoffset, buf, offset)
+        x = Batch()
+        x.Init(buf, n + offset)
+        return x
+
+    # Batch
+    def Init(self, buf, pos):
+        self._tab = flatbuffers.table.Table(buf, pos)
+
+    # Batch
+    def Messages(self, j):
+        o = flatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(4))
+        if o != 0:
+            x = self._tab.Vector(o)
+            x += flatbuffers.number_types.UOffsetTFlags.py_type(j) * 4
+            x = self._tab.Indirect(x)
+            from .Message import Message
+            obj = Message()
+            obj.Init(self._tab.Bytes, x)
+            return obj
+        return None
+
+    # Batch
+    def MessagesLength(self):
+        o = flatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(4))
+        if o != 0:
+            return self._tab.VectorLen(o)
+        return 0
+
+def BatchStart(builder): builder.StartObject(1)
+def BatchAddMessages(builder, messages): builder.PrependUOffsetTRelativeSlot(0, flatbuffers.number_types.UOffsetTFlags.py_type(messages), 0)
+def BatchStartMessagesVector(builder, numElems): return builder.StartVector(4, numElems, 4)
+def BatchEnd(builder): return builder.EndObject()
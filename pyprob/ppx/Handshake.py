@@ -1,4 +1,5 @@
 # automatically generated by the FlatBuffers compiler, do not modify
+# except for the batch field, added by hand for batches, see Batch.py
 
 # namespace: ppx
 
@@ -25,6 +26,14 @@ class Handshake(object):
             return self._tab.String(o + self._tab.Pos)
         return bytes()
 
-def HandshakeStart(builder): builder.StartObject(1)
+    # Handshake
+    def Batch(self):
+        o = flatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(6))
+        if o != 0:
+            return self._tab.Get(flatbuffers.number_types.BoolFlags, o + self._tab.Pos)
+        return 0
+
+def HandshakeStart(builder): builder.StartObject(2)
 def HandshakeAddSystemName(builder, systemName): builder.PrependUOffsetTRelativeSlot(0, flatbuffers.number_types.UOffsetTFlags.py_type(systemName), 0)
+def HandshakeAddBatch(builder, batch): builder.PrependBoolSlot(1, batch, 0)
 def HandshakeEnd(builder): return builder.EndObject()
@@ -1,4 +1,5 @@
 # automatically generated by the FlatBuffers compiler, do not modify
+# except for the batch field, added by hand for batches, see Batch.py
 
 # namespace: ppx
 
@@ -32,7 +33,15 @@ class HandshakeResult(object):
             return self._tab.String(o + self._tab.Pos)
         return bytes()
 
-def HandshakeResultStart(builder): builder.StartObject(2)
+    # HandshakeResult
+    def Batch(self):
+        o = flatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(8))
+        if o != 0:
+            return self._tab.Get(flatbuffers.number_types.BoolFlags, o + self._tab.Pos)
+        return 0
+
+def HandshakeResultStart(builder): builder.StartObject(3)
 def HandshakeResultAddSystemName(builder, systemName): builder.PrependUOffsetTRelativeSlot(0, flatbuffers.number_types.UOffsetTFlags.py_type(systemName), 0)
 def HandshakeResultAddModelName(builder, modelName): builder.PrependUOffsetTRelativeSlot(1, flatbuffers.number_types.UOffsetTFlags.py_type(modelName), 0)
+def HandshakeResultAddBatch(builder, batch): builder.PrependBoolSlot(2, batch, 0)
 def HandshakeResultEnd(builder): return builder.EndObject()
@@ -1,4 +1,5 @@
 # automatically generated by the FlatBuffers compiler, do not modify
+# except for Batch and BatchResult, added by hand for batches, see Batch.py
 
 # namespace: ppx
 
@@ -13,4 +14,6 @@ class MessageBody(object):
     Observe = 7
     ObserveResult = 8
     Reset = 9
+    Batch = 10
+    BatchResult = 11
 
@@ -1,5 +1,16 @@
 import torch
+import numpy as np
 import zmq
+import zmq.asyncio
+import asyncio
+import sys
+import os
+import time
+import uuid
+import shlex
+import shutil
+import tempfile
+import subprocess
 import flatbuffers
 from termcolor import colored
 
@@ -22,14 +33,37 @@ from .ppx import SampleResult as ppx_SampleResult
 from .ppx import Observe as ppx_Observe
 from .ppx import ObserveResult as ppx_ObserveResult
 from .ppx import Reset as ppx_Reset
+from .ppx import Batch as ppx_Batch
+from .ppx import BatchResult as ppx_BatchResult
+
+
+# Writes a one-dimensional little-endian array into a flatbuffers vector with a single copy of its bytes, instead of one Prepend call per element
+def _create_vector(builder, start_vector, array):
+    start_vector(builder, len(array))
+    payload = array.tobytes()
+    builder.head = builder.head - len(payload)
+    builder.Bytes[builder.head:builder.head + len(payload)] = payload
+    return _end_vector(builder, len(array))
+
+
+def _end_vector(builder, length):
+    try:
+        return builder.EndVector()
+    except TypeError:
+        # flatbuffers < 2.0 takes the number of elements
+        return builder.EndVector(length)
 
 
 class ZMQRequester():
-    def __init__(self, server_address):
+    def __init__(self, server_address, timeout_sec=None):
         self._server_address = server_address
-        self._context = zmq.Context.instance()
+        self._timeout_sec = timeout_sec
+        # A context for each connection, so that closing one does not close the others
+        self._context = zmq.Context()
         self._socket = self._context.socket(zmq.REQ)
         self._socket.setsockopt(zmq.LINGER, 100)
+        if timeout_sec is not None:
+            self._socket.setsockopt(zmq.RCVTIMEO, int(timeout_sec * 1000))
         print('ppx (Python): zmq.REQ socket connecting to server {}'.format(self._server_address))
         self._socket.connect(self._server_address)
 
@@ -52,12 +86,71 @@ class ZMQRequester():
         self._socket.send(request)
 
     def receive_reply(self):
-        return self._socket.recv()
+        try:
+            return self._socket.recv()
+        except zmq.Again:
+            # The REQ socket cannot be used after a missing reply and has to be closed
+            raise util.TraceBudgetExceeded('ppx (Python): No reply from server {} within {} seconds.'.format(self._server_address, self._timeout_sec))
+
+
+# An asyncio connection on a zmq.DEALER socket, on which several runs can be in flight
+# Each request is sent in an envelope with the id of its run. REP and ROUTER servers send the envelope back with the reply, which routes the reply to its run
+class AsyncZMQDealer():
+    def __init__(self, server_address, timeout_sec=None):
+        self._server_address = server_address
+        self._timeout_sec = timeout_sec
+        self._context = zmq.asyncio.Context()
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 100)
+        self._replies = {}
+        self._receiver = None
+        self.timed_out = False
+        print('ppx (Python): zmq.DEALER socket connecting to server {}'.format(self._server_address))
+        self._socket.connect(self._server_address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if not self._socket.closed:
+            if self._receiver is not None:
+                self._receiver.cancel()
+            self._socket.close()
+            self._context.destroy()
+            print('ppx (Python): zmq.DEALER socket disconnected from server {}'.format(self._server_address))
+
+    async def request(self, run_id, request):
+        if self._receiver is None:
+            self._receiver = asyncio.ensure_future(self._receive())
+        reply = asyncio.get_event_loop().create_future()
+        self._replies[run_id] = reply
+        try:
+            await self._socket.send_multipart([run_id, b'', request])
+            return await asyncio.wait_for(reply, self._timeout_sec)
+        except asyncio.TimeoutError:
+            self.timed_out = True
+            raise util.TraceBudgetExceeded('ppx (Python): No reply from server {} within {} seconds.'.format(self._server_address, self._timeout_sec))
+        finally:
+            del self._replies[run_id]
+
+    async def _receive(self):
+        while True:
+            frames = await self._socket.recv_multipart()
+            # Replies to runs that are no longer waiting are dropped
+            reply = self._replies.get(frames[0])
+            if reply is not None and not reply.done():
+                reply.set_result(frames[-1])
 
 
 class ModelServer(object):
-    def __init__(self, server_address):
-        self._requester = ZMQRequester(server_address)
+    def __init__(self, server_address, timeout_sec=None):
+        self._requester = ZMQRequester(server_address, timeout_sec)
         self.system_name, self.model_name = self._handshake()
         print('ppx (Python): This system        : {}'.format(colored('pyprob {}'.format(__version__), 'green')))
         print('ppx (Python): Connected to system: {}'.format(colored(self.system_name, 'green')))
@@ -75,45 +168,36 @@ class ModelServer(object):
     def close(self):
         self._requester.close()
 
-    def _protocol_tensor_to_variable(self, protocol_tensor):
+    @staticmethod
+    def _protocol_tensor_to_variable(protocol_tensor):
         if protocol_tensor is None:
             return None
         data = protocol_tensor.DataAsNumpy()
         shape = protocol_tensor.ShapeAsNumpy()
         if len(data) == 0:
             return None
-        else:
-            t = torch.from_numpy(data)
+        # A single copy out of the message buffer, converting to the default dtype and device
+        t = torch.tensor(data, dtype=util._dtype, device=util._device)
         if len(shape) != 0:
             t = t.view(shape.tolist())
-        return util.to_tensor(t)
+        return t
 
-    def _variable_to_protocol_tensor(self, builder, variable):
+    @staticmethod
+    def _variable_to_protocol_tensor(builder, variable):
         if variable is None:
             variable = util.to_tensor(torch.zeros(0))
         variable_numpy = util.to_numpy(variable)
-        data = variable_numpy.flatten().tolist()
-        shape = list(variable_numpy.shape)
-
-        # pack data
-        ppx_Tensor.TensorStartDataVector(builder, len(data))
-        for d in reversed(data):
-            builder.PrependFloat64(d)
-        data = builder.EndVector(len(data))
-
-        # pack shape
-        ppx_Tensor.TensorStartShapeVector(builder, len(shape))
-        for s in reversed(shape):
-            builder.PrependInt32(s)
-        shape = builder.EndVector(len(shape))
-
+        data = _create_vector(builder, ppx_Tensor.TensorStartDataVector, np.ascontiguousarray(variable_numpy, dtype='<f8').reshape(-1))
+        shape = _create_vector(builder, ppx_Tensor.TensorStartShapeVector, np.array(variable_numpy.shape, dtype='<i4'))
         ppx_Tensor.TensorStart(builder)
         ppx_Tensor.TensorAddData(builder, data)
         ppx_Tensor.TensorAddShape(builder, shape)
         return ppx_Tensor.TensorEnd(builder)
 
     def _get_message_body(self, message_buffer):
-        message = ppx_Message.Message.GetRootAsMessage(message_buffer, 0)
+        return self._message_body(ppx_Message.Message.GetRootAsMessage(message_buffer, 0))
+
+    def _message_body(self, message):
         body_type = message.BodyType()
         if body_type == ppx_MessageBody.MessageBody().HandshakeResult:
             message_body = ppx_HandshakeResult.HandshakeResult()
@@ -125,17 +209,21 @@ class ModelServer(object):
             message_body = ppx_Observe.Observe()
         elif body_type == ppx_MessageBody.MessageBody().Reset:
             message_body = ppx_Reset.Reset()
+        elif body_type == ppx_MessageBody.MessageBody().Batch:
+            message_body = ppx_Batch.Batch()
         else:
             raise RuntimeError('ppx (Python): Received unexpected message body type: {}'.format(body_type))
         message_body.Init(message.Body().Bytes, message.Body().Pos)
         return message_body
 
-    def _handshake(self):
+    def _handshake_message(self):
         builder = flatbuffers.Builder(64)
         # consturct MessageBody
         system_name = builder.CreateString('pyprob {}'.format(__version__))
         ppx_Handshake.HandshakeStart(builder)
         ppx_Handshake.HandshakeAddSystemName(builder, system_name)
+        # Simulators that do not know the batch field ignore it and send single samples and observes
+        ppx_Handshake.HandshakeAddBatch(builder, True)
         message_body = ppx_Handshake.HandshakeEnd(builder)
 
         # construct Message
@@ -145,19 +233,23 @@ class ModelServer(object):
         message = ppx_Message.MessageEnd(builder)
         builder.Finish(message)
 
-        message = builder.Output()
-        self._requester.send_request(message)
+        return builder.Output()
 
-        reply = self._requester.receive_reply()
+    def _handshake_result(self, reply):
         message_body = self._get_message_body(reply)
         if isinstance(message_body, ppx_HandshakeResult.HandshakeResult):
             system_name = message_body.SystemName().decode('utf-8')
             model_name = message_body.ModelName().decode('utf-8')
+            self.batch = bool(message_body.Batch())
             return system_name, model_name
         else:
             raise RuntimeError('ppx (Python): Unexpected reply to handshake.')
 
-    def forward(self):
+    def _handshake(self):
+        self._requester.send_request(self._handshake_message())
+        return self._handshake_result(self._requester.receive_reply())
+
+    def _run_message(self):
         builder = flatbuffers.Builder(64)
 
         # construct MessageBody
@@ -171,113 +263,333 @@ class ModelServer(object):
         message = ppx_Message.MessageEnd(builder)
         builder.Finish(message)
 
-        message = builder.Output()
-        self._requester.send_request(message)
+        return builder.Output()
 
+    def forward(self):
+        self._requester.send_request(self._run_message())
         while True:
             reply = self._requester.receive_reply()
-            message_body = self._get_message_body(reply)
-
-            if isinstance(message_body, ppx_RunResult.RunResult):
-                result = self._protocol_tensor_to_variable(message_body.Result())
-                return result
-            elif isinstance(message_body, ppx_Sample.Sample):
-                address = message_body.Address().decode('utf-8')
-                name = message_body.Name().decode('utf-8')
-                if name == '':
-                    name = None
-                control = bool(message_body.Control())
-                replace = bool(message_body.Replace())
-                distribution_type = message_body.DistributionType()
-                if distribution_type == ppx_Distribution.Distribution().Uniform:
-                    uniform = ppx_Uniform.Uniform()
-                    uniform.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    low = self._protocol_tensor_to_variable(uniform.Low())
-                    high = self._protocol_tensor_to_variable(uniform.High())
-                    dist = Uniform(low, high)
-                elif distribution_type == ppx_Distribution.Distribution().Normal:
-                    normal = ppx_Normal.Normal()
-                    normal.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    mean = self._protocol_tensor_to_variable(normal.Mean())
-                    stddev = self._protocol_tensor_to_variable(normal.Stddev())
-                    dist = Normal(mean, stddev)
-                elif distribution_type == ppx_Distribution.Distribution().Categorical:
-                    categorical = ppx_Categorical.Categorical()
-                    categorical.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    probs = self._protocol_tensor_to_variable(categorical.Probs())
-                    dist = Categorical(probs)
-                elif distribution_type == ppx_Distribution.Distribution().Poisson:
-                    poisson = ppx_Poisson.Poisson()
-                    poisson.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    rate = self._protocol_tensor_to_variable(poisson.Rate())
-                    dist = Poisson(rate)
-                else:
-                    raise RuntimeError('ppx (Python): Sample from an unexpected distribution requested.')
-                result = state.sample(distribution=dist, control=control, replace=replace, name=name, address=address)
-                builder = flatbuffers.Builder(64)
-                result = self._variable_to_protocol_tensor(builder, result)
-                ppx_SampleResult.SampleResultStart(builder)
-                ppx_SampleResult.SampleResultAddResult(builder, result)
-                message_body = ppx_SampleResult.SampleResultEnd(builder)
-
-                # construct Message
-                ppx_Message.MessageStart(builder)
-                ppx_Message.MessageAddBodyType(builder, ppx_MessageBody.MessageBody().SampleResult)
-                ppx_Message.MessageAddBody(builder, message_body)
-                message = ppx_Message.MessageEnd(builder)
-                builder.Finish(message)
-
-                message = builder.Output()
-                self._requester.send_request(message)
-            elif isinstance(message_body, ppx_Observe.Observe):
-                address = message_body.Address().decode('utf-8')
-                name = message_body.Name().decode('utf-8')
-                if name == '':
-                    name = None
-                value = self._protocol_tensor_to_variable(message_body.Value())
-                distribution_type = message_body.DistributionType()
-                if distribution_type == ppx_Distribution.Distribution().NONE:
-                    dist = None
-                elif distribution_type == ppx_Distribution.Distribution().Uniform:
-                    uniform = ppx_Uniform.Uniform()
-                    uniform.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    low = self._protocol_tensor_to_variable(uniform.Low())
-                    high = self._protocol_tensor_to_variable(uniform.High())
-                    dist = Uniform(low, high)
-                elif distribution_type == ppx_Distribution.Distribution().Normal:
-                    normal = ppx_Normal.Normal()
-                    normal.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    mean = self._protocol_tensor_to_variable(normal.Mean())
-                    stddev = self._protocol_tensor_to_variable(normal.Stddev())
-                    dist = Normal(mean, stddev)
-                elif distribution_type == ppx_Distribution.Distribution().Categorical:
-                    categorical = ppx_Categorical.Categorical()
-                    categorical.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    probs = self._protocol_tensor_to_variable(categorical.Probs())
-                    dist = Categorical(probs)
-                elif distribution_type == ppx_Distribution.Distribution().Poisson:
-                    poisson = ppx_Poisson.Poisson()
-                    poisson.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
-                    rate = self._protocol_tensor_to_variable(poisson.Rate())
-                    dist = Poisson(rate)
-                else:
-                    raise RuntimeError('ppx (Python): Sample from an unexpected distribution requested: {}'.format(distribution_type))
-
-                state.observe(distribution=dist, value=value, name=name, address=address)
-                builder = flatbuffers.Builder(64)
-                ppx_ObserveResult.ObserveResultStart(builder)
-                message_body = ppx_ObserveResult.ObserveResultEnd(builder)
-
-                # construct Message
-                ppx_Message.MessageStart(builder)
-                ppx_Message.MessageAddBodyType(builder, ppx_MessageBody.MessageBody().ObserveResult)
-                ppx_Message.MessageAddBody(builder, message_body)
-                message = ppx_Message.MessageEnd(builder)
-                builder.Finish(message)
-
-                message = builder.Output()
-                self._requester.send_request(message)
-            elif isinstance(message_body, ppx_Reset.Reset):
-                raise RuntimeError('ppx (Python): Received a reset request. Protocol out of sync.')
+            done, value = self._handle_message(reply)
+            if done:
+                return value
+            self._requester.send_request(value)
+
+    # Handles a message of a run with the current trace state, returns (True, result) for the end of the run, and (False, request) for the request that continues it
+    def _handle_message(self, reply):
+        message_body = self._get_message_body(reply)
+
+        if isinstance(message_body, ppx_RunResult.RunResult):
+            result = self._protocol_tensor_to_variable(message_body.Result())
+            return True, result
+        elif isinstance(message_body, ppx_Batch.Batch):
+            if not self.batch:
+                raise RuntimeError('ppx (Python): Received a batch without negotiating batches in the handshake. Protocol out of sync.')
+            # A block of samples and observes whose values do not depend on each other, handled in order and answered with one BatchResult
+            builder = flatbuffers.Builder(64)
+            results = []
+            for i in range(message_body.MessagesLength()):
+                results.append(self._handle_sample_observe(builder, self._message_body(message_body.Messages(i))))
+            ppx_BatchResult.BatchResultStartResultsVector(builder, len(results))
+            for result in reversed(results):
+                builder.PrependUOffsetTRelative(result)
+            results = _end_vector(builder, len(results))
+            ppx_BatchResult.BatchResultStart(builder)
+            ppx_BatchResult.BatchResultAddResults(builder, results)
+            message_body = ppx_BatchResult.BatchResultEnd(builder)
+
+            # construct Message
+            ppx_Message.MessageStart(builder)
+            ppx_Message.MessageAddBodyType(builder, ppx_MessageBody.MessageBody().BatchResult)
+            ppx_Message.MessageAddBody(builder, message_body)
+            message = ppx_Message.MessageEnd(builder)
+            builder.Finish(message)
+
+            return False, builder.Output()
+        elif isinstance(message_body, ppx_Sample.Sample) or isinstance(message_body, ppx_Observe.Observe):
+            builder = flatbuffers.Builder(64)
+            builder.Finish(self._handle_sample_observe(builder, message_body))
+            return False, builder.Output()
+        elif isinstance(message_body, ppx_Reset.Reset):
+            raise RuntimeError('ppx (Python): Received a reset request. Protocol out of sync.')
+        else:
+            raise RuntimeError('ppx (Python): Received unexpected message.')
+
+    # Handles a Sample or Observe with the current trace state, returns the SampleResult or ObserveResult message built in builder
+    def _handle_sample_observe(self, builder, message_body):
+        if isinstance(message_body, ppx_Sample.Sample):
+            address = message_body.Address().decode('utf-8')
+            name = message_body.Name().decode('utf-8')
+            if name == '':
+                name = None
+            control = bool(message_body.Control())
+            replace = bool(message_body.Replace())
+            distribution_type = message_body.DistributionType()
+            if distribution_type == ppx_Distribution.Distribution().Uniform:
+                uniform = ppx_Uniform.Uniform()
+                uniform.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                low = self._protocol_tensor_to_variable(uniform.Low())
+                high = self._protocol_tensor_to_variable(uniform.High())
+                dist = Uniform(low, high)
+            elif distribution_type == ppx_Distribution.Distribution().Normal:
+                normal = ppx_Normal.Normal()
+                normal.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                mean = self._protocol_tensor_to_variable(normal.Mean())
+                stddev = self._protocol_tensor_to_variable(normal.Stddev())
+                dist = Normal(mean, stddev)
+            elif distribution_type == ppx_Distribution.Distribution().Categorical:
+                categorical = ppx_Categorical.Categorical()
+                categorical.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                probs = self._protocol_tensor_to_variable(categorical.Probs())
+                dist = Categorical(probs)
+            elif distribution_type == ppx_Distribution.Distribution().Poisson:
+                poisson = ppx_Poisson.Poisson()
+                poisson.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                rate = self._protocol_tensor_to_variable(poisson.Rate())
+                dist = Poisson(rate)
+            else:
+                raise RuntimeError('ppx (Python): Sample from an unexpected distribution requested.')
+            result = state.sample(distribution=dist, control=control, replace=replace, name=name, address=address)
+            result = self._variable_to_protocol_tensor(builder, result)
+            ppx_SampleResult.SampleResultStart(builder)
+            ppx_SampleResult.SampleResultAddResult(builder, result)
+            message_body = ppx_SampleResult.SampleResultEnd(builder)
+
+            # construct Message
+            ppx_Message.MessageStart(builder)
+            ppx_Message.MessageAddBodyType(builder, ppx_MessageBody.MessageBody().SampleResult)
+            ppx_Message.MessageAddBody(builder, message_body)
+            return ppx_Message.MessageEnd(builder)
+        elif isinstance(message_body, ppx_Observe.Observe):
+            address = message_body.Address().decode('utf-8')
+            name = message_body.Name().decode('utf-8')
+            if name == '':
+                name = None
+            value = self._protocol_tensor_to_variable(message_body.Value())
+            distribution_type = message_body.DistributionType()
+            if distribution_type == ppx_Distribution.Distribution().NONE:
+                dist = None
+            elif distribution_type == ppx_Distribution.Distribution().Uniform:
+                uniform = ppx_Uniform.Uniform()
+                uniform.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                low = self._protocol_tensor_to_variable(uniform.Low())
+                high = self._protocol_tensor_to_variable(uniform.High())
+                dist = Uniform(low, high)
+            elif distribution_type == ppx_Distribution.Distribution().Normal:
+                normal = ppx_Normal.Normal()
+                normal.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                mean = self._protocol_tensor_to_variable(normal.Mean())
+                stddev = self._protocol_tensor_to_variable(normal.Stddev())
+                dist = Normal(mean, stddev)
+            elif distribution_type == ppx_Distribution.Distribution().Categorical:
+                categorical = ppx_Categorical.Categorical()
+                categorical.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                probs = self._protocol_tensor_to_variable(categorical.Probs())
+                dist = Categorical(probs)
+            elif distribution_type == ppx_Distribution.Distribution().Poisson:
+                poisson = ppx_Poisson.Poisson()
+                poisson.Init(message_body.Distribution().Bytes, message_body.Distribution().Pos)
+                rate = self._protocol_tensor_to_variable(poisson.Rate())
+                dist = Poisson(rate)
+            else:
+                raise RuntimeError('ppx (Python): Sample from an unexpected distribution requested: {}'.format(distribution_type))
+
+            state.observe(distribution=dist, value=value, name=name, address=address)
+            ppx_ObserveResult.ObserveResultStart(builder)
+            message_body = ppx_ObserveResult.ObserveResultEnd(builder)
+
+            # construct Message
+            ppx_Message.MessageStart(builder)
+            ppx_Message.MessageAddBodyType(builder, ppx_MessageBody.MessageBody().ObserveResult)
+            ppx_Message.MessageAddBody(builder, message_body)
+            return ppx_Message.MessageEnd(builder)
+        else:
+            raise RuntimeError('ppx (Python): Received unexpected message in batch.')
+
+
+# A ModelServer on an AsyncZMQDealer, running traces as asyncio tasks, so that many remote traces progress concurrently in one thread
+# Messages are handled with the trace state of their run, which is saved and restored around each message (see state._get_context)
+class AsyncModelServer(ModelServer):
+    def __init__(self, server_address, timeout_sec=None):
+        self._requester = AsyncZMQDealer(server_address, timeout_sec)
+        self._handshake_task = None
+        self._num_runs = 0
+        self.system_name = None
+        self.model_name = None
+        self.batch = False
+
+    async def handshake(self):
+        if self._handshake_task is None:
+            self._handshake_task = asyncio.ensure_future(self._requester.request(b'handshake', self._handshake_message()))
+        # Runs waiting for the handshake can be cancelled without cancelling it
+        reply = await asyncio.shield(self._handshake_task)
+        if self.model_name is None:
+            self.system_name, self.model_name = self._handshake_result(reply)
+            print('ppx (Python): This system        : {}'.format(colored('pyprob {}'.format(__version__), 'green')))
+            print('ppx (Python): Connected to system: {}'.format(colored(self.system_name, 'green')))
+            print('ppx (Python): Model name         : {}'.format(colored(self.model_name, 'green', attrs=['bold'])))
+
+    # begin_trace: starts the trace of the run with state.begin_trace, returns the ended trace
+    # Without begin_trace, runs in the current trace and returns the result, as ModelServer.forward
+    async def run(self, begin_trace=None):
+        await self.handshake()
+        self._num_runs += 1
+        run_id = str(self._num_runs).encode()
+        if begin_trace is None:
+            request = self._run_message()
+            while True:
+                done, request = self._handle_message(await self._requester.request(run_id, request))
+                if done:
+                    return request
+        idle_context = state._get_context()
+        with util._fast_inference_grad_mode():
+            begin_trace()
+        context = state._get_context()
+        state._set_context(idle_context)
+        request = self._run_message()
+        while True:
+            reply = await self._requester.request(run_id, request)
+            state._set_context(context)
+            try:
+                with util._fast_inference_grad_mode():
+                    done, request = self._handle_message(reply)
+                    if done:
+                        return state.end_trace(request)
+                context = state._get_context()
+            finally:
+                state._set_context(idle_context)
+
+
+# Remote simulators at server_addresses, or num_simulators simulators launched locally with simulator_command, in which {address} is replaced by the address each simulator should serve
+# Runs are dispatched to the simulators concurrently. A simulator that does not reply within timeout_sec, or a launched simulator whose process exits, fails its run and is reconnected (and relaunched) for the next one
+# runs_per_connection: connects with AsyncModelServer, with up to this number of runs in flight on each connection (1 for simulators serving on zmq.REP sockets, which reply to one request at a time)
+class SimulatorPool():
+    def __init__(self, server_addresses=None, timeout_sec=None, simulator_command=None, num_simulators=1, runs_per_connection=None):
+        self._timeout_sec = timeout_sec
+        self.runs_per_connection = runs_per_connection
+        self._simulator_command = simulator_command
+        self._processes = {}
+        self._model_servers = {}
+        self._socket_dir = None
+        if simulator_command is not None:
+            server_addresses = self._local_server_addresses(num_simulators)
+            for server_address in server_addresses:
+                self._launch(server_address)
+        if server_addresses is None or len(server_addresses) == 0:
+            raise ValueError('Expecting server_addresses or simulator_command.')
+        self.server_addresses = list(server_addresses)
+        self._request_times = {}
+        self._failure_times = {}
+        # Seconds before a failed simulator gets a new run
+        self._retry_interval_sec = 1. if timeout_sec is None else timeout_sec
+        self.num_failures = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for server_address in list(self._model_servers):
+            self.reset(server_address)
+        for process in self._processes.values():
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        self._processes = {}
+        if self._socket_dir is not None:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
+
+    # Abstract ipc sockets on Linux, which leave no files behind, and socket files in a temporary directory removed on close elsewhere
+    def _local_server_addresses(self, num_simulators):
+        if sys.platform.startswith('linux'):
+            return ['ipc://@pyprob_simulator_{}_{}'.format(uuid.uuid4(), i) for i in range(num_simulators)]
+        if not zmq.has('ipc'):
+            raise RuntimeError('Launching simulators with simulator_command needs zmq ipc transport, which is not available on this platform ({}). Launch the simulators separately and pass their server_addresses instead.'.format(sys.platform))
+        self._socket_dir = tempfile.mkdtemp(prefix='pyprob_')
+        return ['ipc://{}'.format(os.path.join(self._socket_dir, 'simulator_{}'.format(i))) for i in range(num_simulators)]
+
+    def _launch(self, server_address):
+        print('ppx (Python): Launching simulator at {}'.format(server_address))
+        self._processes[server_address] = subprocess.Popen(shlex.split(self._simulator_command.format(address=server_address)))
+
+    # Connects to the simulator with a handshake if it is not connected, relaunching it if its process exited. Returns None if the simulator does not reply to the handshake
+    def model_server(self, server_address):
+        if server_address not in self._model_servers:
+            process = self._processes.get(server_address)
+            if process is not None and process.poll() is not None:
+                self._launch(server_address)
+            if self.runs_per_connection is not None:
+                # Asynchronous connections handshake in their first run
+                self._model_servers[server_address] = AsyncModelServer(server_address, self._timeout_sec)
+                return self._model_servers[server_address]
+            try:
+                self._model_servers[server_address] = ModelServer(server_address, self._timeout_sec)
+            except util.TraceBudgetExceeded:
+                self.failed(server_address, 'no reply to handshake within {} seconds'.format(self._timeout_sec))
+                return None
+        return self._model_servers[server_address]
+
+    # Simulators without a request in flight, except those that failed recently
+    def idle_server_addresses(self):
+        return [server_address for server_address in self.server_addresses if server_address not in self._request_times and time.time() - self._failure_times.get(server_address, 0.) > self._retry_interval_sec]
+
+    # False if the simulator was launched by the pool and its process exited
+    def alive(self, server_address):
+        return self.exit_code(server_address) is None
+
+    # The exit code of the launched simulator process, None if it is running or was not launched by the pool
+    def exit_code(self, server_address):
+        process = self._processes.get(server_address)
+        return None if process is None else process.poll()
+
+    # Drops the connection to a simulator that failed, relaunching its process if it exited, and holds back its next run for a retry interval
+    def failed(self, server_address, reason):
+        print(colored('Warning: simulator at {} failed ({})'.format(server_address, reason), 'red', attrs=['bold']))
+        self.num_failures += 1
+        self._failure_times[server_address] = time.time()
+        self.reset(server_address)
+        process = self._processes.get(server_address)
+        if process is not None and process.poll() is not None:
+            self._launch(server_address)
+
+    def reset(self, server_address):
+        # Drops the connection, the next run reconnects to the server with a new handshake
+        self._request_times.pop(server_address, None)
+        model_server = self._model_servers.pop(server_address, None)
+        if model_server is not None:
+            model_server.close()
+
+    def send_request(self, server_address, request):
+        self._request_times[server_address] = time.time()
+        self._model_servers[server_address]._requester.send_request(request)
+
+    # Waits up to timeout_sec for replies from the simulators with requests in flight, returns (server_address, reply) pairs, where reply is None for a simulator that failed
+    def receive_replies(self, timeout_sec=0.1):
+        if len(self._request_times) == 0:
+            time.sleep(timeout_sec)
+            return []
+        poller = zmq.Poller()
+        for server_address in self._request_times:
+            poller.register(self._model_servers[server_address]._requester._socket, zmq.POLLIN)
+        sockets = dict(poller.poll(int(timeout_sec * 1000)))
+        replies = []
+        for server_address in list(self._request_times):
+            model_server = self._model_servers[server_address]
+            if model_server._requester._socket in sockets:
+                del self._request_times[server_address]
+                replies.append((server_address, model_server._requester.receive_reply()))
+                continue
+            if not self.alive(server_address):
+                reason = 'process exited with code {}'.format(self.exit_code(server_address))
+            elif self._timeout_sec is not None and time.time() - self._request_times[server_address] > self._timeout_sec:
+                reason = 'no reply within {} seconds'.format(self._timeout_sec)
             else:
-                raise RuntimeError('ppx (Python): Received unexpected message.')
+                continue
+            self.failed(server_address, reason)
+            replies.append((server_address, None))
+        return replies
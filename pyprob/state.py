@@ -3,9 +3,10 @@ import sys
 import opcode
 import random
 import time
+import math
 from termcolor import colored
 
-from .distributions import Normal, Categorical, Uniform, TruncatedNormal
+from .distributions import Normal, Categorical, Uniform, Poisson, Beta, TruncatedNormal
 from .trace import Variable, Trace
 from . import util, TraceMode, PriorInflation, InferenceEngine
 
@@ -20,9 +21,27 @@ _current_trace_previous_variable = None
 _current_trace_replaced_variable_proposal_distributions = {}
 _current_trace_observed_variables = None
 _current_trace_execution_start = None
+_current_trace_num_samples = 0
 _metropolis_hastings_trace = None
 _metropolis_hastings_site_address = None
 _metropolis_hastings_site_transition_log_prob = 0
+_replay_trace = None
+_vectorized_num_traces = None
+_vectorized_value_shapes = None
+_context_names = ['_trace_mode', '_inference_engine', '_prior_inflation', '_current_trace', '_current_trace_root_function_name', '_current_trace_inference_network', '_current_trace_previous_variable', '_current_trace_replaced_variable_proposal_distributions', '_current_trace_observed_variables', '_current_trace_execution_start', '_current_trace_num_samples', '_metropolis_hastings_trace', '_metropolis_hastings_site_address', '_metropolis_hastings_site_transition_log_prob', '_replay_trace', '_vectorized_num_traces', '_vectorized_value_shapes']
+
+
+# The state of the current trace, saved and restored to interleave the executions of several traces in one thread, such as runs on several remote simulators
+def _get_context():
+    context = {name: globals()[name] for name in _context_names}
+    context['_trace_deadline'] = util._trace_deadline
+    return context
+
+
+def _set_context(context):
+    for name in _context_names:
+        globals()[name] = context[name]
+    util._trace_deadline = context['_trace_deadline']
 
 
 # extract_address and _extract_target_of_assignment code by Tobias Kohn (kohnt@tobiaskohn.ch)
@@ -82,23 +101,130 @@ def _extract_target_of_assignment():
         return None
 
 
+def _expand_distribution(distribution, size):
+    # Returns the distribution of size iid draws from distribution, with batch_shape [size] + distribution.batch_shape
+    shape = torch.Size([size]) + distribution.batch_shape
+    if isinstance(distribution, Normal):
+        return Normal(distribution.mean.expand(shape), distribution.stddev.expand(shape))
+    elif isinstance(distribution, Uniform):
+        return Uniform(distribution.low.expand(shape), distribution.high.expand(shape))
+    elif isinstance(distribution, Poisson):
+        return Poisson(distribution.rate.expand(shape))
+    elif isinstance(distribution, Categorical):
+        return Categorical(distribution.probs.expand(shape + torch.Size([distribution.num_categories])))
+    elif isinstance(distribution, Beta):
+        return Beta(distribution.concentration1.expand(shape), distribution.concentration0.expand(shape), low=distribution.low.expand(shape), high=distribution.high.expand(shape))
+    elif isinstance(distribution, TruncatedNormal):
+        return TruncatedNormal(distribution.mean_non_truncated.expand(shape), distribution.stddev_non_truncated.expand(shape), low=distribution.low.expand(shape), high=distribution.high.expand(shape))
+    else:
+        raise ValueError('Distribution currently unsupported with size: {}'.format(distribution.name))
+
+
+def _split_distribution(distribution):
+    # Returns the distributions of the elements along the first batch dimension of distribution
+    batch_shape = distribution.batch_shape
+
+    def split(param):
+        param = param.expand(batch_shape)
+        # Scalar parameters are split into Python numbers, which keep the per-trace distributions on their scalar fast paths
+        return param.tolist() if param.dim() == 1 else param.unbind(0)
+
+    if isinstance(distribution, Normal):
+        return [Normal(loc, scale) for loc, scale in zip(split(distribution.mean), split(distribution.stddev))]
+    elif isinstance(distribution, Uniform):
+        return [Uniform(low, high) for low, high in zip(split(distribution.low), split(distribution.high))]
+    elif isinstance(distribution, Poisson):
+        return [Poisson(rate) for rate in split(distribution.rate)]
+    elif isinstance(distribution, Categorical):
+        probs = distribution.probs
+        return [Categorical(p) for p in (probs.tolist() if probs.dim() == 2 else probs.unbind(0))]
+    elif isinstance(distribution, Beta):
+        return [Beta(c1, c0, low=low, high=high) for c1, c0, low, high in zip(split(distribution.concentration1), split(distribution.concentration0), split(distribution.low), split(distribution.high))]
+    elif isinstance(distribution, TruncatedNormal):
+        return [TruncatedNormal(mean, stddev, low=low, high=high) for mean, stddev, low, high in zip(split(distribution.mean_non_truncated), split(distribution.stddev_non_truncated), split(distribution.low), split(distribution.high))]
+    else:
+        raise ValueError('Distribution currently unsupported in vectorized runs: {}'.format(distribution.name))
+
+
+def _index_result(result, i, num_traces):
+    if torch.is_tensor(result) and result.dim() > 0 and result.size(0) == num_traces:
+        return result[i]
+    elif isinstance(result, (tuple, list)):
+        return type(result)([_index_result(r, i, num_traces) for r in result])
+    else:
+        return result
+
+
+def _vectorized_distribution(distribution, address):
+    # In a vectorized run, distributions whose parameters do not depend on batched values are expanded over the traces
+    if address not in _vectorized_value_shapes:
+        raise RuntimeError('Vectorized run diverged from the static trace structure at address: {}'.format(address))
+    value_shape = _vectorized_value_shapes[address]
+    sample_shape = distribution.batch_shape + distribution.event_shape
+    if sample_shape == value_shape:
+        return _expand_distribution(distribution, _vectorized_num_traces)
+    elif sample_shape == torch.Size([_vectorized_num_traces]) + value_shape:
+        return distribution
+    else:
+        raise RuntimeError('Vectorized run has unexpected shape {} at address: {}'.format(sample_shape, address))
+
+
+def _vectorized_value(value, address):
+    if address not in _vectorized_value_shapes:
+        raise RuntimeError('Vectorized run diverged from the static trace structure at address: {}'.format(address))
+    value_shape = _vectorized_value_shapes[address]
+    if value.size() == value_shape:
+        return value.expand(torch.Size([_vectorized_num_traces]) + value_shape)
+    elif value.size() == torch.Size([_vectorized_num_traces]) + value_shape:
+        return value
+    else:
+        raise RuntimeError('Vectorized run has unexpected shape {} at address: {}'.format(value.size(), address))
+
+
+def _vectorized_log_prob(distribution, value):
+    # One log_prob per trace of the vectorized run
+    return distribution.log_prob(value).view(_vectorized_num_traces, -1).sum(1)
+
+
+def _replay_value(address):
+    index = len(_current_trace.variables)
+    if index >= len(_replay_trace.variables) or _replay_trace.variables[index].address != address:
+        raise RuntimeError('Replayed run diverged from the replayed trace at address: {}'.format(address))
+    return _replay_trace.variables[index].value
+
+
+def _check_trace_budget():
+    if _vectorized_num_traces is None:
+        util.check_trace_deadline()
+        if util._trace_sample_budget is not None and _current_trace_num_samples > util._trace_sample_budget:
+            raise util.TraceBudgetExceeded('Trace exceeded its budget of {} samples.'.format(util._trace_sample_budget))
+
+
 def _sample_with_prior_inflation(distribution):
     if _prior_inflation == PriorInflation.ENABLED:
         if isinstance(distribution, Categorical):
-            distribution = Categorical(util.to_tensor(torch.zeros(distribution.num_categories).fill_(1./distribution.num_categories)))
+            distribution = Categorical(util.to_tensor(torch.zeros(distribution.probs.size()).fill_(1./distribution.num_categories)))
         elif isinstance(distribution, Normal):
             distribution = Normal(distribution.mean, distribution.stddev * 3)
     return distribution.sample()
 
 
-def observe(distribution=None, value=None, name=None, address=None):
+# value can hold a batch of iid observations, which are recorded as a single variable and scored with a single log_prob. Give size to sample that many iid observations when value is not given.
+def observe(distribution=None, value=None, name=None, address=None, size=None):
     global _current_trace
+    _check_trace_budget()
     if address is None:
         address_base = extract_address(_current_trace_root_function_name)
     else:
         address_base = address
     instance = _current_trace.last_instance(address_base) + 1
-    address_suffix = 'None' if distribution is None else distribution._address_suffix
+    if distribution is None:
+        address_suffix = 'None'
+    elif size is None:
+        address_suffix = distribution._address_suffix
+    else:
+        address_suffix = '{}(size:{})'.format(distribution._address_suffix, size)
+        distribution = _expand_distribution(distribution, size)
     address = '{}__{}__{}'.format(address_base, address_suffix, instance)
 
     if name in _current_trace_observed_variables:
@@ -106,22 +232,42 @@ def observe(distribution=None, value=None, name=None, address=None):
         value = _current_trace_observed_variables[name]
     elif value is not None:
         value = util.to_tensor(value)
-    elif distribution is not None:
-        value = distribution.sample()
+    if _vectorized_num_traces is not None:
+        if distribution is not None:
+            distribution = _vectorized_distribution(distribution, address)
+        if value is not None:
+            value = _vectorized_value(value, address)
+    if value is None and distribution is not None:
+        if _replay_trace is None:
+            value = distribution.sample()
+        else:
+            value = _replay_value(address)
 
     if distribution is None or value is None:
         log_prob = 0.
+    elif _vectorized_num_traces is not None:
+        log_prob = _vectorized_log_prob(distribution, value)
+    elif util._fast_inference and _trace_mode == TraceMode.PRIOR:
+        # Prior traces do not use importance weights, log_prob is computed on first access
+        log_prob = None
     else:
         log_prob = distribution.log_prob(value, sum=True)
-    if _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING or _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
-        _current_trace.log_importance_weight += log_prob
+    if log_prob is not None and (_inference_engine == InferenceEngine.IMPORTANCE_SAMPLING or _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK):
+        if util._fast_inference and _vectorized_num_traces is None:
+            _current_trace.log_importance_weight += float(log_prob)
+        else:
+            _current_trace.log_importance_weight += log_prob
 
     variable = Variable(distribution=distribution, value=value, address_base=address_base, address=address, instance=instance, log_prob=log_prob, observed=True, name=name)
     _current_trace.add(variable)
 
 
-def sample(distribution, control=True, replace=False, name=None, address=None):
+# size=N samples N iid values from distribution at a single address, recorded as one variable
+def sample(distribution, control=True, replace=False, name=None, address=None, size=None):
     global _current_trace
+    global _current_trace_num_samples
+    _current_trace_num_samples += 1
+    _check_trace_budget()
 
     # Only replace if controlled
     if not control:
@@ -136,7 +282,14 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
     else:
         address_base = address
     instance = _current_trace.last_instance(address_base) + 1
-    address = '{}__{}__{}'.format(address_base, distribution._address_suffix, 'replaced' if replace else str(instance))
+    if size is None:
+        address_suffix = distribution._address_suffix
+    else:
+        address_suffix = '{}(size:{})'.format(distribution._address_suffix, size)
+        distribution = _expand_distribution(distribution, size)
+    address = '{}__{}__{}'.format(address_base, address_suffix, 'replaced' if replace else str(instance))
+    if _vectorized_num_traces is not None:
+        distribution = _vectorized_distribution(distribution, address)
 
     if name in _current_trace_observed_variables:
         # Variable is observed
@@ -150,12 +303,18 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
         update_previous_variable = False
 
         if _trace_mode == TraceMode.PRIOR:
-            value = _sample_with_prior_inflation(distribution)
-            log_prob = distribution.log_prob(value, sum=True)
+            if _replay_trace is None:
+                value = _sample_with_prior_inflation(distribution)
+            else:
+                value = _replay_value(address)
+            if _vectorized_num_traces is not None:
+                log_prob = _vectorized_log_prob(distribution, value)
+            else:
+                log_prob = None if util._fast_inference else distribution.log_prob(value, sum=True)
         else:  # _trace_mode == TraceMode.POSTERIOR
             if _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING:
                 value = distribution.sample()
-                log_prob = distribution.log_prob(value, sum=True)
+                log_prob = None if util._fast_inference else distribution.log_prob(value, sum=True)
                 # _current_trace.log_importance_weight += 0  # Not computed because log_importance_weight is zero when running importance sampling with prior as proposal
             elif _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
                 if control:
@@ -185,10 +344,13 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                         print('distribution', proposal_distribution)
                         print('value', value)
                         print('log_prob', proposal_log_prob)
-                    _current_trace.log_importance_weight += log_prob - proposal_log_prob
+                    if util._fast_inference:
+                        _current_trace.log_importance_weight += float(log_prob - proposal_log_prob)
+                    else:
+                        _current_trace.log_importance_weight += log_prob - proposal_log_prob
                 else:
                     value = distribution.sample()
-                    log_prob = distribution.log_prob(value, sum=True)
+                    log_prob = None if util._fast_inference else distribution.log_prob(value, sum=True)
             else:  # _inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or _inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS
                 if _metropolis_hastings_trace is None:
                     value = distribution.sample()
@@ -217,8 +379,9 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                                 log_prob = distribution.log_prob(value, sum=True)
                                 proposal_kernel_reverse = proposal_kernel_func(value)
 
-                                _metropolis_hastings_site_transition_log_prob = torch.log(alpha * torch.exp(proposal_kernel_reverse.log_prob(_metropolis_hastings_site_value, sum=True)) + (1 - alpha) * torch.exp(_metropolis_hastings_site_log_prob)) + log_prob
-                                _metropolis_hastings_site_transition_log_prob -= torch.log(alpha * torch.exp(proposal_kernel_forward.log_prob(value, sum=True)) + (1 - alpha) * torch.exp(log_prob)) + _metropolis_hastings_site_log_prob
+                                # Computed in log space because the joint log_prob of a site with many iid values (size > 1) underflows exp
+                                _metropolis_hastings_site_transition_log_prob = torch.logsumexp(torch.stack([math.log(alpha) + proposal_kernel_reverse.log_prob(_metropolis_hastings_site_value, sum=True), math.log(1 - alpha) + _metropolis_hastings_site_log_prob]), dim=0) + log_prob
+                                _metropolis_hastings_site_transition_log_prob -= torch.logsumexp(torch.stack([math.log(alpha) + proposal_kernel_forward.log_prob(value, sum=True), math.log(1 - alpha) + log_prob]), dim=0) + _metropolis_hastings_site_log_prob
                             else:
                                 value = distribution.sample()
                                 log_prob = distribution.log_prob(value, sum=True)
@@ -248,20 +411,34 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
     return variable.value
 
 
-def begin_trace(func, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, observe=None, metropolis_hastings_trace=None):
+# replay_trace: a prior run that takes its sampled values from replay_trace, in order
+# vectorized_num_traces: a prior run that samples vectorized_num_traces traces at once with batched values, vectorized_value_shapes gives the (unbatched) value shape for each address
+def begin_trace(func, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, observe=None, metropolis_hastings_trace=None, replay_trace=None, vectorized_num_traces=None, vectorized_value_shapes=None):
     global _trace_mode
     global _inference_engine
     global _prior_inflation
+    global _replay_trace
+    global _vectorized_num_traces
+    global _vectorized_value_shapes
     _trace_mode = trace_mode
     _inference_engine = inference_engine
     _prior_inflation = prior_inflation
+    if (replay_trace is not None or vectorized_num_traces is not None) and trace_mode != TraceMode.PRIOR:
+        raise ValueError('Replayed and vectorized runs are only supported with TraceMode.PRIOR.')
+    _replay_trace = replay_trace
+    _vectorized_num_traces = vectorized_num_traces
+    _vectorized_value_shapes = vectorized_value_shapes
     global _current_trace
     global _current_trace_root_function_name
     global _current_trace_inference_network
     global _current_trace_replaced_variable_proposal_distributions
     global _current_trace_observed_variables
     global _current_trace_execution_start
+    global _current_trace_num_samples
     _current_trace_execution_start = time.time()
+    _current_trace_num_samples = 0
+    if util._trace_time_budget_sec is not None and vectorized_num_traces is None:
+        util._trace_deadline = _current_trace_execution_start + util._trace_time_budget_sec
     _current_trace = Trace()
     _current_trace_root_function_name = func.__code__.co_name
     _current_trace_replaced_variable_proposal_distributions = {}
@@ -294,8 +471,15 @@ def end_trace(result):
     global _current_trace
     global _current_trace_root_function_name
     global _current_trace_inference_network
+    global _replay_trace
+    global _vectorized_num_traces
+    global _vectorized_value_shapes
     _inference_engine = InferenceEngine.IMPORTANCE_SAMPLING
     _prior_inflation = PriorInflation.DISABLED
+    _replay_trace = None
+    _vectorized_num_traces = None
+    _vectorized_value_shapes = None
+    util._trace_deadline = None
     execution_time_sec = time.time() - _current_trace_execution_start
     _current_trace.end(result, execution_time_sec)
     ret = _current_trace
@@ -303,3 +487,39 @@ def end_trace(result):
     _current_trace_root_function_name = None
     _current_trace_inference_network = None
     return ret
+
+
+def abort_trace():
+    # Discards the current trace, used when a trace is aborted before it ends
+    global _current_trace
+    global _current_trace_inference_network
+    global _replay_trace
+    global _vectorized_num_traces
+    global _vectorized_value_shapes
+    _replay_trace = None
+    _vectorized_num_traces = None
+    _vectorized_value_shapes = None
+    util._trace_deadline = None
+    _current_trace = None
+    _current_trace_inference_network = None
+
+
+def split_trace(trace, num_traces):
+    # Splits the trace of a vectorized run into num_traces traces
+    traces = [Trace() for i in range(num_traces)]
+    for variable in trace.variables:
+        distributions = [None] * num_traces if variable.distribution is None else _split_distribution(variable.distribution)
+        values = [None] * num_traces if variable.value is None else variable.value.unbind(0)
+        log_prob = variable.log_prob
+        log_probs = log_prob.unbind(0) if log_prob.dim() > 0 else [log_prob] * num_traces
+        for i in range(num_traces):
+            traces[i].add(Variable(distribution=distributions[i], value=values[i], address_base=variable.address_base, address=variable.address, instance=variable.instance, log_prob=log_probs[i], control=variable.control, replace=variable.replace, name=variable.name, observed=variable.observed, reused=variable.reused))
+    log_importance_weight = trace.log_importance_weight
+    if torch.is_tensor(log_importance_weight) and log_importance_weight.dim() > 0:
+        log_importance_weights = log_importance_weight.tolist()
+    else:
+        log_importance_weights = [float(log_importance_weight)] * num_traces
+    for i in range(num_traces):
+        traces[i].log_importance_weight = log_importance_weights[i]
+        traces[i].end(_index_result(trace.result, i, num_traces), trace.execution_time_sec / num_traces)
+    return traces
@@ -10,7 +10,8 @@ class Variable():
         self.address_base = address_base
         self.address = address
         self.instance = instance
-        self.log_prob = util.to_tensor(log_prob)
+        # log_prob=None defers the computation of log_prob until it is first accessed
+        self._log_prob = None if log_prob is None else util.to_tensor(log_prob)
         self.control = control
         self.replace = replace
         self.name = name
@@ -30,6 +31,21 @@ class Variable():
             str(self.value),
             str(self.log_prob))
 
+    def __setstate__(self, state):
+        # Variables pickled before log_prob was computed lazily store it as log_prob
+        if 'log_prob' in state:
+            state['_log_prob'] = state.pop('log_prob')
+        self.__dict__.update(state)
+
+    @property
+    def log_prob(self):
+        if self._log_prob is None:
+            if self.distribution is None or self.value is None:
+                self._log_prob = util.to_tensor(0.)
+            else:
+                self._log_prob = util.to_tensor(self.distribution.log_prob(self.value, sum=True))
+        return self._log_prob
+
     def to(self, device):
         if self.value is not None:
             self.value.to(device=device)
@@ -49,8 +65,8 @@ class Trace():
         self.variables_dict_address_base = {}
         self.named_variables = {}
         self.result = None
-        self.log_prob = 0.
-        self.log_prob_observed = 0.
+        self._log_prob = 0.
+        self._log_prob_observed = 0.
         self.log_importance_weight = 0.
         self.length = 0
         self.length_controlled = 0
@@ -91,11 +107,30 @@ class Trace():
         self.variables_uncontrolled = [v for v in self.variables if (not v.control) and (not v.observed)]
         self.variables_observed = [v for v in self.variables if v.observed]
         self.variables_observable = [v for v in self.variables if v.observable]
-        self.log_prob = sum([torch.sum(v.log_prob) for v in self.variables if v.control or v.observed])
-        self.log_prob_observed = sum([torch.sum(v.log_prob) for v in self.variables_observed])
+        self._log_prob = None
+        self._log_prob_observed = None
         self.length = len(self.variables)
         self.length_controlled = len(self.variables_controlled)
 
+    def __setstate__(self, state):
+        # Traces pickled before log_prob was computed lazily store log_prob and log_prob_observed
+        for name in ['log_prob', 'log_prob_observed']:
+            if name in state:
+                state['_' + name] = state.pop(name)
+        self.__dict__.update(state)
+
+    @property
+    def log_prob(self):
+        if self._log_prob is None:
+            self._log_prob = sum([torch.sum(v.log_prob) for v in self.variables if v.control or v.observed])
+        return self._log_prob
+
+    @property
+    def log_prob_observed(self):
+        if self._log_prob_observed is None:
+            self._log_prob_observed = sum([torch.sum(v.log_prob) for v in self.variables_observed])
+        return self._log_prob_observed
+
     def last_instance(self, address_base):
         if address_base in self.variables_dict_address_base:
             return self.variables_dict_address_base[address_base].instance
@@ -7,6 +7,7 @@ import sys
 import enum
 import time
 import math
+import contextlib
 from functools import reduce
 import operator
 import datetime
@@ -18,11 +19,20 @@ _device = torch.device('cpu')
 _dtype = torch.float
 _cuda_enabled = False
 _verbosity = 2
+_fast_inference = False
+_trace_time_budget_sec = None
+_trace_sample_budget = None
+_trace_deadline = None
+_trace_max_consecutive_rejections = 1000
 _print_refresh_rate = 0.25  # seconds
 _epsilon = 1e-8
 _log_epsilon = math.log(_epsilon)  # log(1e-8) = -18.420680743952367
 
 
+class TraceBudgetExceeded(RuntimeError):
+    pass
+
+
 class TraceMode(enum.Enum):
     PRIOR = 1
     POSTERIOR = 2
@@ -55,6 +65,11 @@ def set_random_seed(seed=123):
         seed = int((time.time()*1e6) % 1e8)
     global _random_seed
     _random_seed = seed
+    _seed_random_generators(seed)
+
+
+# Seeds the random number generators without changing the seed set with set_random_seed
+def _seed_random_generators(seed):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -81,9 +96,47 @@ def set_verbosity(v=2):
     _verbosity = v
 
 
+def set_fast_inference(enabled=True):
+    # When enabled, traces are generated without autograd, importance weights are accumulated as Python floats, and the log_prob of variables that no inference engine needs is only computed when accessed
+    global _fast_inference
+    _fast_inference = enabled
+
+
+# Disables autograd in fast inference mode, and leaves the grad mode of the caller unchanged otherwise
+def _fast_inference_grad_mode():
+    return torch.no_grad() if _fast_inference else contextlib.nullcontext()
+
+
+def set_trace_budget(time_sec=None, num_samples=None, max_consecutive_rejections=1000):
+    # Traces running longer than time_sec seconds or making more than num_samples sample statements are aborted and rejected, None disables a budget
+    # Trace generation stops with an error after max_consecutive_rejections rejected traces in a row, as the budget is then likely too small for the model
+    global _trace_time_budget_sec
+    global _trace_sample_budget
+    global _trace_max_consecutive_rejections
+    _trace_time_budget_sec = time_sec
+    _trace_sample_budget = num_samples
+    _trace_max_consecutive_rejections = max_consecutive_rejections
+
+
+def check_trace_deadline():
+    if _trace_deadline is not None and time.time() > _trace_deadline:
+        raise TraceBudgetExceeded('Trace exceeded its time budget of {} seconds.'.format(_trace_time_budget_sec))
+
+
+def torch_load(f, map_location=None):
+    # pyprob files hold pickled pyprob objects, which torch.load no longer unpickles by default since PyTorch 2.6
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(f, map_location=map_location, weights_only=False)
+    else:
+        return torch.load(f, map_location=map_location)
+
+
 def to_tensor(value, dtype=None):
     if dtype is None:
         dtype = _dtype
+    if torch.is_tensor(value):
+        # Same as torch.tensor(value), a detached copy, without its copy construct warning
+        return value.detach().to(device=_device, dtype=dtype, copy=True)
     if type(value) == np.int64:
         value = float(value)
     elif type(value) == np.float32:
@@ -91,6 +144,25 @@ def to_tensor(value, dtype=None):
     return torch.tensor(value).to(device=_device, dtype=dtype)
 
 
+# Like to_tensor, but tensors are converted without a copy and stay in the autograd graph, for distribution parameters that are outputs of the inference network or expanded views for iid plates
+def _as_tensor(value, dtype=None):
+    if torch.is_tensor(value):
+        if dtype is None:
+            dtype = _dtype
+        return value.to(device=_device, dtype=dtype)
+    return to_tensor(value, dtype)
+
+
+def is_scalar(value):
+    # Python and NumPy numbers, and 0-d arrays and tensors that are not part of an autograd graph
+    if torch.is_tensor(value):
+        return value.dim() == 0 and not value.requires_grad
+    elif isinstance(value, np.ndarray):
+        return value.ndim == 0
+    else:
+        return isinstance(value, (int, float, np.number))
+
+
 def to_numpy(value):
     if torch.is_tensor(value):
         return value.cpu().numpy()
@@ -2,7 +2,7 @@ import os
 import sys
 from setuptools import setup, find_packages
 PACKAGE_NAME = 'pyprob'
-MINIMUM_PYTHON_VERSION = 3, 5
+MINIMUM_PYTHON_VERSION = 3, 7
 
 
 def check_python_version():
@@ -30,9 +30,9 @@ setup(
     author='Atilim Gunes Baydin and Tuan-Anh Le',
     author_email='gunes@robots.ox.ac.uk',
     packages=find_packages(),
-    install_requires=['torch>=0.4.1', 'torchvision', 'numpy', 'matplotlib', 'termcolor==1.1.0', 'pyzmq>=17.0.0', 'flatbuffers==1.9', 'pydotplus==2.0.2'],
+    install_requires=['torch>=1.12', 'torchvision', 'numpy', 'matplotlib', 'termcolor==1.1.0', 'pyzmq>=17.0.0', 'flatbuffers==1.9', 'pydotplus==2.0.2'],
     url='https://github.com/probprog/pyprob',
-    classifiers=['Development Status :: 4 - Beta', 'License :: OSI Approved :: BSD License', 'Programming Language :: Python :: 3.5'],
+    classifiers=['Development Status :: 4 - Beta', 'License :: OSI Approved :: BSD License', 'Programming Language :: Python :: 3.7'],
     license='BSD',
     keywords='probabilistic programming deep learning inference compilation markov chain monte carlo',
 )
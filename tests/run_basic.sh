@@ -17,6 +17,9 @@ python test_model.py
 # python test_model_remote.py
 #
 
+echo "Running remote model pool tests"
+python test_model_remote_pool.py
+
 echo "Running diagnostics tests"
 python test_diagnostics.py
 
@@ -1,4 +1,5 @@
 import unittest
+import pickle
 import torch
 import numpy as np
 import os
@@ -8,7 +9,7 @@ import tempfile
 
 import pyprob
 from pyprob import util
-from pyprob.distributions import Distribution, Empirical, Normal, Categorical, Uniform, Poisson, Beta, Mixture, TruncatedNormal
+from pyprob.distributions import Distribution, Empirical, Normal, Categorical, Uniform, Poisson, Beta, Mixture, TruncatedNormal, NormalMixture, TruncatedNormalMixture
 
 
 empirical_samples = 20000
@@ -409,6 +410,105 @@ class DistributionsTestCase(unittest.TestCase):
         self.assertTrue(np.allclose(dist_stddevs_empirical, dist_stddevs_correct, atol=0.1))
         self.assertTrue(np.allclose(dist_log_probs, dist_log_probs_correct, atol=0.1))
 
+    def test_dist_scalar_fast_path(self):
+        dists = [Normal(1, 2), Uniform(-1, 3), Poisson(4), Categorical([0.1, 0.2, 0.7])]
+        dists_torch = [Normal(util.to_tensor([1]), util.to_tensor([2])), Uniform(util.to_tensor([-1]), util.to_tensor([3])), Poisson(util.to_tensor([4])), Categorical(util.to_tensor([[0.1, 0.2, 0.7]]))]
+        values = [0.5, 2, 3, 2]
+
+        dist_log_probs = [float(d.log_prob(v)) for d, v in zip(dists, values)]
+        dist_log_probs_correct = [float(d.log_prob(util.to_tensor([v]))) for d, v in zip(dists_torch, values)]
+        dist_means = [float(d.mean) for d in dists[:3]]
+        dist_means_correct = [float(d.mean) for d in dists_torch[:3]]
+        dist_stddevs = [float(d.stddev) for d in dists[:3]]
+        dist_stddevs_correct = [float(d.stddev) for d in dists_torch[:3]]
+        dist_sample_types = [(d.sample().dtype, d.sample().size()) for d in dists]
+        dist_sample_types_correct = [(d.sample().dtype, d.sample().squeeze(0).size()) for d in dists_torch]
+        dist_kl_divergence = float(Distribution.kl_divergence(dists[0], Normal(0, 1)))
+        dist_kl_divergence_correct = float(Distribution.kl_divergence(dists_torch[0], Normal(util.to_tensor([0]), util.to_tensor([1]))))
+
+        util.eval_print('dist_log_probs', 'dist_log_probs_correct', 'dist_means', 'dist_means_correct', 'dist_stddevs', 'dist_stddevs_correct', 'dist_sample_types', 'dist_sample_types_correct', 'dist_kl_divergence', 'dist_kl_divergence_correct')
+
+        self.assertTrue(np.allclose(dist_log_probs, dist_log_probs_correct, atol=1e-5))
+        self.assertTrue(np.allclose(dist_means, dist_means_correct, atol=1e-5))
+        self.assertTrue(np.allclose(dist_stddevs, dist_stddevs_correct, atol=1e-5))
+        self.assertEqual(dist_sample_types, dist_sample_types_correct)
+        self.assertAlmostEqual(dist_kl_divergence, dist_kl_divergence_correct, places=5)
+
+    def test_dist_unpickle_legacy(self):
+        dists = [Normal(util.to_tensor(1), util.to_tensor(2)), Uniform(util.to_tensor(-1), util.to_tensor(3)), Poisson(util.to_tensor(4)), Categorical(util.to_tensor([0.1, 0.2, 0.7]).requires_grad_())]
+        values = [0.5, 2, 3, 2]
+        dist_log_probs_correct = [float(d.log_prob(v)) for d, v in zip(dists, values)]
+
+        # Distributions pickled before the scalar fast paths do not have the scalar parameters
+        for dist, names in zip(dists, [['_loc_scalar', '_scale_scalar'], ['_low_scalar', '_high_scalar'], ['_rate_scalar'], ['_probs_list']]):
+            for name in names:
+                del dist.__dict__[name]
+        dists = [pickle.loads(pickle.dumps(d)) for d in dists]
+        dist_log_probs = [float(d.log_prob(v)) for d, v in zip(dists, values)]
+        dist_samples = [d.sample() for d in dists]
+
+        util.eval_print('dist_log_probs', 'dist_log_probs_correct', 'dist_samples')
+
+        self.assertTrue(np.allclose(dist_log_probs, dist_log_probs_correct, atol=1e-5))
+
+    def test_dist_categorical_scalar_fast_path_support(self):
+        dist = Categorical([0.1, 0.2, 0.7])
+        dist_torch = Categorical(util.to_tensor([0.1, 0.2, 0.7]).requires_grad_())
+        values = [-1, 3, 1.5]
+
+        for value in values:
+            with self.assertRaises(ValueError):
+                dist_torch.log_prob(value)
+            # The scalar fast path does not wrap negative values or raise IndexError for values outside the support
+            with self.assertRaises(ValueError):
+                dist.log_prob(value)
+
+    def test_dist_scalar_fast_path_invalid_params(self):
+        # Invalid scalar parameters are rejected like their tensor counterparts instead of sampling from the fast paths
+        dist_constructors = [lambda: Normal(0, -1), lambda: Normal(0, 0), lambda: Poisson(-1), lambda: Categorical([0.5, -0.1, 0.6]), lambda: Categorical([0, 0, 0])]
+
+        for dist_constructor in dist_constructors:
+            with self.assertRaises(ValueError):
+                dist_constructor()
+
+    def test_dist_scalar_fast_path_non_finite_params(self):
+        # NaN parameters are rejected by torch validation, infinite ones are left to the torch distribution
+        with self.assertRaises(ValueError):
+            Normal(float('nan'), 1.)
+        with self.assertRaises(ValueError):
+            Normal(0., float('nan'))
+        dist_loc_inf = Normal(float('inf'), 1.)
+        dist_scale_inf = Normal(0., float('inf'))
+
+        self.assertIsNone(dist_loc_inf._loc_scalar)
+        self.assertIsNone(dist_scale_inf._loc_scalar)
+
+    def test_dist_poisson_scalar_fast_path_support(self):
+        dist = Poisson(3.)
+        values = [2.5, -0.5, -1, [1, 2.5], [-1, 2]]
+
+        for value in values:
+            # The scalar fast path rejects negative and non-integer counts like the torch distribution
+            with self.assertRaises(ValueError):
+                dist.log_prob(value)
+
+    def test_dist_uniform_scalar_fast_path_support(self):
+        dist = Uniform(0, 1)
+        values = [2., -0.5, [0.5, 2.]]
+        value_high = 1.
+        value_high_log_prob_correct = float('-inf')
+
+        for value in values:
+            # The scalar fast path rejects values outside the support like the torch distribution instead of returning -inf
+            with self.assertRaises(ValueError):
+                dist.log_prob(value)
+        # The torch support includes high, where log_prob is -inf
+        value_high_log_prob = float(dist.log_prob(value_high))
+
+        util.eval_print('value_high', 'value_high_log_prob', 'value_high_log_prob_correct')
+
+        self.assertEqual(value_high_log_prob, value_high_log_prob_correct)
+
     def test_dist_normal_batched_2(self):
         dist_batch_shape_correct = torch.Size([2])
         dist_event_shape_correct = torch.Size()
@@ -660,6 +760,23 @@ class DistributionsTestCase(unittest.TestCase):
         self.assertTrue(np.allclose(dist_stddevs_empirical, dist_stddevs_correct, atol=0.1))
         self.assertTrue(np.allclose(dist_log_probs, dist_log_probs_correct, atol=0.1))
 
+    def test_dist_truncated_normal_tails(self):
+        dist_lows = [6, 10, 30, -50, 100, -float('inf')]
+        dist_highs = [6.0001, float('inf'), 30.01, -40, 101, -8]
+        dist_means_correct = [6.00005, 10.0981, 30.0048, -40.025, 100.01, -8.12137]
+
+        dist = TruncatedNormal([0] * 6, [1] * 6, dist_lows, dist_highs)
+        dist_samples = torch.stack([dist.sample() for i in range(empirical_samples // 10)])
+        dist_means_empirical = util.to_numpy(dist_samples.mean(0))
+        dist_samples_inside = bool(((dist_samples >= dist.low) & (dist_samples <= dist.high)).all())
+        dist_log_probs_finite = bool(torch.isfinite(dist.log_prob(dist_samples)).all())
+
+        util.eval_print('dist_lows', 'dist_highs', 'dist_means_empirical', 'dist_means_correct', 'dist_samples_inside', 'dist_log_probs_finite')
+
+        self.assertTrue(np.allclose(dist_means_empirical, dist_means_correct, atol=0.01))
+        self.assertTrue(dist_samples_inside)
+        self.assertTrue(dist_log_probs_finite)
+
     def test_dist_categorical(self):
         dist_batch_shape_correct = torch.Size()
         dist_event_shape_correct = torch.Size()
@@ -1214,6 +1331,70 @@ class DistributionsTestCase(unittest.TestCase):
         self.assertTrue(np.allclose(dist_stddevs_empirical, dist_stddevs_correct, atol=0.1))
         self.assertTrue(np.allclose(dist_log_probs, dist_log_probs_correct, atol=0.1))
 
+    def test_dist_normal_mixture_batched_2(self):
+        dist_batch_shape_correct = torch.Size([2])
+        dist_event_shape_correct = torch.Size()
+        dist_sample_shape_correct = torch.Size([2])
+        dist_log_prob_shape_correct = torch.Size([2])
+        dist_means_correct = [0.7, 8.1]
+        dist_stddevs_correct = [1.10454, 3.23883]
+        dist_log_probs_correct = [-23.473, -3.06649]
+
+        dist = NormalMixture([[0, 2, 3], [1, 5, 10]], [[0.1, 0.1, 0.1], [1, 1, 1]], probs=[[0.7, 0.2, 0.1], [0.1, 0.2, 0.7]])
+        dist_batch_shape = dist.batch_shape
+        dist_event_shape = dist.event_shape
+        dist_sample_shape = dist.sample().size()
+        dist_empirical = Empirical([dist.sample() for i in range(empirical_samples)])
+        dist_means = util.to_numpy(dist.mean)
+        dist_means_empirical = util.to_numpy(dist_empirical.mean)
+        dist_stddevs = util.to_numpy(dist.stddev)
+        dist_stddevs_empirical = util.to_numpy(dist_empirical.stddev)
+        dist_log_probs = util.to_numpy(dist.log_prob(dist_means_correct))
+        dist_log_prob_shape = dist.log_prob(dist_means_correct).size()
+
+        util.eval_print('dist_batch_shape', 'dist_batch_shape_correct', 'dist_event_shape', 'dist_event_shape_correct', 'dist_sample_shape', 'dist_sample_shape_correct', 'dist_log_prob_shape', 'dist_log_prob_shape_correct', 'dist_means', 'dist_means_empirical', 'dist_means_correct', 'dist_stddevs', 'dist_stddevs_empirical', 'dist_stddevs_correct', 'dist_log_probs', 'dist_log_probs_correct')
+
+        self.assertEqual(dist_batch_shape, dist_batch_shape_correct)
+        self.assertEqual(dist_event_shape, dist_event_shape_correct)
+        self.assertEqual(dist_sample_shape, dist_sample_shape_correct)
+        self.assertEqual(dist_log_prob_shape, dist_log_prob_shape_correct)
+        self.assertTrue(np.allclose(dist_means, dist_means_correct, atol=0.1))
+        self.assertTrue(np.allclose(dist_means_empirical, dist_means_correct, atol=0.1))
+        self.assertTrue(np.allclose(dist_stddevs, dist_stddevs_correct, atol=0.1))
+        self.assertTrue(np.allclose(dist_stddevs_empirical, dist_stddevs_correct, atol=0.1))
+        self.assertTrue(np.allclose(dist_log_probs, dist_log_probs_correct, atol=0.1))
+
+    def test_dist_truncated_normal_mixture_batched_2(self):
+        means_non_truncated = [[0, 2, 3], [1, 5, 10]]
+        stddevs_non_truncated = [[1, 0.5, 2], [1, 1, 3]]
+        low = [-1, 0]
+        high = [2, 6]
+        probs = [[0.7, 0.2, 0.1], [0.1, 0.2, 0.7]]
+        values = [0.5, 5.5]
+        dist_mixture = Mixture([TruncatedNormal([means_non_truncated[0][i], means_non_truncated[1][i]], [stddevs_non_truncated[0][i], stddevs_non_truncated[1][i]], low, high) for i in range(3)], probs=probs)
+        dist_sample_shape_correct = torch.Size([2])
+        dist_means_correct = util.to_numpy(dist_mixture.mean)
+        dist_stddevs_correct = util.to_numpy(dist_mixture.stddev)
+        dist_log_probs_correct = util.to_numpy(dist_mixture.log_prob(values))
+
+        dist = TruncatedNormalMixture(means_non_truncated, stddevs_non_truncated, low, high, probs=probs)
+        dist_sample_shape = dist.sample().size()
+        dist_empirical = Empirical([dist.sample() for i in range(empirical_samples)])
+        dist_means = util.to_numpy(dist.mean)
+        dist_means_empirical = util.to_numpy(dist_empirical.mean)
+        dist_stddevs = util.to_numpy(dist.stddev)
+        dist_stddevs_empirical = util.to_numpy(dist_empirical.stddev)
+        dist_log_probs = util.to_numpy(dist.log_prob(values))
+
+        util.eval_print('dist_sample_shape', 'dist_sample_shape_correct', 'dist_means', 'dist_means_empirical', 'dist_means_correct', 'dist_stddevs', 'dist_stddevs_empirical', 'dist_stddevs_correct', 'dist_log_probs', 'dist_log_probs_correct')
+
+        self.assertEqual(dist_sample_shape, dist_sample_shape_correct)
+        self.assertTrue(np.allclose(dist_means, dist_means_correct, atol=1e-5))
+        self.assertTrue(np.allclose(dist_means_empirical, dist_means_correct, atol=0.1))
+        self.assertTrue(np.allclose(dist_stddevs, dist_stddevs_correct, atol=1e-5))
+        self.assertTrue(np.allclose(dist_stddevs_empirical, dist_stddevs_correct, atol=0.1))
+        self.assertTrue(np.allclose(dist_log_probs, dist_log_probs_correct, atol=1e-5))
+
 
 if __name__ == '__main__':
     pyprob.set_random_seed(123)
@@ -7,8 +7,9 @@ import uuid
 import shutil
 
 import pyprob
-from pyprob import util, Model, InferenceEngine
+from pyprob import util, Model, InferenceEngine, PriorInflation
 from pyprob.distributions import Normal, Uniform, Empirical
+from pyprob.nn import BatchGenerator, read_manifest
 
 
 importance_sampling_samples = 5000
@@ -238,6 +239,18 @@ class ModelTestCase(unittest.TestCase):
         self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, places=0)
         self.assertLess(kl_divergence, 0.25)
 
+    def test_model_vectorized_fallback(self):
+        num_traces = 16
+        vectorized_correct = False
+
+        vectorized = self._model._check_vectorized()
+        traces = self._model._training_traces(num_traces)
+        traces_length = len(traces)
+        util.eval_print('num_traces', 'vectorized', 'vectorized_correct', 'traces_length')
+
+        self.assertEqual(vectorized, vectorized_correct)
+        self.assertEqual(traces_length, num_traces)
+
     def test_model_save_trace_store_load_train(self):
         store_dir = tempfile.mkdtemp()
         store_files = 4
@@ -252,6 +265,49 @@ class ModelTestCase(unittest.TestCase):
 
         self.assertTrue(True)
 
+    def test_model_save_trace_store_workers(self):
+        store_dir = tempfile.mkdtemp()
+        store_files = 5
+        store_traces_per_file = 8
+        store_workers = 2
+        store_traces_correct = store_files * store_traces_per_file
+
+        self._model.save_trace_store(trace_store_dir=store_dir, files=store_files, traces_per_file=store_traces_per_file, num_workers=store_workers)
+        manifest = read_manifest(store_dir)
+        manifest_files = len(manifest)
+        manifest_traces = sum([entry['traces'] for entry in manifest])
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED, store_dir)
+        traces = [trace for entry in manifest for trace in batch_generator._load_traces(os.path.join(store_dir, entry['file_name']))]
+        store_traces = len(traces)
+        # Workers have independent random seeds, so their traces differ
+        store_traces_unique = len(set([float(trace.variables_controlled[0].value) for trace in traces]))
+        shutil.rmtree(store_dir)
+
+        util.eval_print('store_dir', 'store_files', 'store_traces_per_file', 'store_workers', 'manifest_files', 'manifest_traces', 'store_traces', 'store_traces_unique', 'store_traces_correct')
+
+        self.assertEqual(manifest_files, store_files)
+        self.assertEqual(manifest_traces, store_traces_correct)
+        self.assertEqual(store_traces, store_traces_correct)
+        self.assertEqual(store_traces_unique, store_traces_correct)
+
+    def test_model_save_trace_store_scan_train(self):
+        store_dir = tempfile.mkdtemp()
+        store_files = 2
+        store_traces_per_file = 64
+        training_traces = 16
+
+        self._model.save_trace_store(trace_store_dir=store_dir, files=store_files, traces_per_file=store_traces_per_file)
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED, store_dir)
+        store_addresses = set([variable.address for trace in batch_generator.scan_trace_store().traces for variable in trace.variables_controlled])
+        self._model._inference_network = None
+        self._model.learn_inference_network(num_traces=training_traces, trace_store_dir=store_dir, batch_size=16, valid_size=16, observe_embeddings={'obs0': {'dim': 16}, 'obs1': {'dim': 16}}, scan_trace_store=True)
+        network_addresses = set(self._model._inference_network._layer_proposal.keys())
+        shutil.rmtree(store_dir)
+
+        util.eval_print('store_dir', 'store_files', 'store_traces_per_file', 'training_traces', 'store_addresses', 'network_addresses')
+
+        self.assertTrue(store_addresses.issubset(network_addresses))
+
 
 class ModelWithReplacementTestCase(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -325,6 +381,43 @@ class ModelObservationStyle1TestCase(unittest.TestCase):
         self._model = GaussianWithUnknownMean()
         super().__init__(*args, **kwargs)
 
+    def test_observation_style1_gum_training_traces_not_vectorized(self):
+        num_traces = 16
+        model_vectorized_correct = None
+
+        traces = self._model._training_traces(num_traces, vectorized=False)
+        traces_length = len(traces)
+        model_vectorized = self._model._vectorized
+
+        util.eval_print('num_traces', 'traces_length', 'model_vectorized', 'model_vectorized_correct')
+
+        # The model is not probed for a static trace structure when vectorized sampling is turned off
+        self.assertEqual(traces_length, num_traces)
+        self.assertEqual(model_vectorized, model_vectorized_correct)
+
+    def test_observation_style1_gum_vectorized_training_traces(self):
+        num_traces = 5000
+        vectorized_correct = True
+        prior_mean_correct = 1.
+        prior_stddev_correct = math.sqrt(5)
+        trace_length_correct = 3
+
+        vectorized = self._model._check_vectorized()
+        traces = self._model._training_traces(num_traces)
+        prior = Empirical([trace.result for trace in traces])
+        prior_mean = float(prior.mean)
+        prior_stddev = float(prior.stddev)
+        trace_length = traces[0].length
+        trace_log_prob = float(traces[0].log_prob)
+        trace_log_prob_correct = float(sum([Normal(self._model.prior_mean, self._model.prior_stddev).log_prob(traces[0].result)] + [Normal(traces[0].result, self._model.likelihood_stddev).log_prob(variable.value) for variable in traces[0].variables_observed]))
+        util.eval_print('num_traces', 'vectorized', 'vectorized_correct', 'prior_mean', 'prior_mean_correct', 'prior_stddev', 'prior_stddev_correct', 'trace_length', 'trace_length_correct', 'trace_log_prob', 'trace_log_prob_correct')
+
+        self.assertEqual(vectorized, vectorized_correct)
+        self.assertAlmostEqual(prior_mean, prior_mean_correct, places=0)
+        self.assertAlmostEqual(prior_stddev, prior_stddev_correct, places=0)
+        self.assertEqual(trace_length, trace_length_correct)
+        self.assertAlmostEqual(trace_log_prob, trace_log_prob_correct, places=3)
+
     def test_observation_style1_gum_posterior_importance_sampling(self):
         samples = importance_sampling_samples
         true_posterior = Normal(7.25, math.sqrt(1/1.2))
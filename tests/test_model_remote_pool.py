@@ -0,0 +1,617 @@
+import unittest
+import math
+import sys
+import os
+import time
+import uuid
+import threading
+from unittest import mock
+import zmq
+import flatbuffers
+import torch
+
+import pyprob
+from pyprob import util, ModelRemote, InferenceEngine
+from pyprob.remote import ModelServer, SimulatorPool, _end_vector
+from pyprob.ppx import Message as ppx_Message
+from pyprob.ppx import MessageBody as ppx_MessageBody
+from pyprob.ppx import Distribution as ppx_Distribution
+from pyprob.ppx import Normal as ppx_Normal
+from pyprob.ppx import Tensor as ppx_Tensor
+from pyprob.ppx import HandshakeResult as ppx_HandshakeResult
+from pyprob.ppx import RunResult as ppx_RunResult
+from pyprob.ppx import Sample as ppx_Sample
+from pyprob.ppx import SampleResult as ppx_SampleResult
+from pyprob.ppx import Observe as ppx_Observe
+from pyprob.ppx import Handshake as ppx_Handshake
+from pyprob.ppx import Batch as ppx_Batch
+from pyprob.ppx import BatchResult as ppx_BatchResult
+
+
+# A simulator of the Gaussian with unknown mean model, serving ppx requests on a zmq.REP socket, or on a zmq.ROUTER socket with router=True, where several runs can be in flight
+# delay_sec: simulated computation before each sample, hang_after_runs: stops replying after this number of runs
+class GaussianWithUnknownMeanSimulator():
+    def __init__(self, server_address, delay_sec=0., hang_after_runs=None, router=False):
+        self._server_address = server_address
+        self._delay_sec = delay_sec
+        self._hang_after_runs = hang_after_runs
+        self._router = router
+        self._stop = threading.Event()
+        self.num_runs = 0
+        self.max_runs_in_flight = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _message(self, builder, body_type, body):
+        ppx_Message.MessageStart(builder)
+        ppx_Message.MessageAddBodyType(builder, body_type)
+        ppx_Message.MessageAddBody(builder, body)
+        builder.Finish(ppx_Message.MessageEnd(builder))
+        return builder.Output()
+
+    def _normal(self, builder, mean, stddev):
+        mean = ModelServer._variable_to_protocol_tensor(builder, torch.tensor(mean))
+        stddev = ModelServer._variable_to_protocol_tensor(builder, torch.tensor(stddev))
+        ppx_Normal.NormalStart(builder)
+        ppx_Normal.NormalAddMean(builder, mean)
+        ppx_Normal.NormalAddStddev(builder, stddev)
+        return ppx_Normal.NormalEnd(builder)
+
+    def _reply(self, body_type, body_buffer, run):
+        builder = flatbuffers.Builder(64)
+        if body_type == ppx_MessageBody.MessageBody().Handshake:
+            system_name = builder.CreateString('Test simulator')
+            model_name = builder.CreateString('Gaussian with unknown mean')
+            ppx_HandshakeResult.HandshakeResultStart(builder)
+            ppx_HandshakeResult.HandshakeResultAddSystemName(builder, system_name)
+            ppx_HandshakeResult.HandshakeResultAddModelName(builder, model_name)
+            return self._message(builder, ppx_MessageBody.MessageBody().HandshakeResult, ppx_HandshakeResult.HandshakeResultEnd(builder))
+        elif body_type == ppx_MessageBody.MessageBody().Run:
+            self.num_runs += 1
+            address = builder.CreateString('mu')
+            name = builder.CreateString('')
+            distribution = self._normal(builder, 1., math.sqrt(5))
+            ppx_Sample.SampleStart(builder)
+            ppx_Sample.SampleAddAddress(builder, address)
+            ppx_Sample.SampleAddName(builder, name)
+            ppx_Sample.SampleAddDistributionType(builder, ppx_Distribution.Distribution().Normal)
+            ppx_Sample.SampleAddDistribution(builder, distribution)
+            ppx_Sample.SampleAddControl(builder, True)
+            return self._message(builder, ppx_MessageBody.MessageBody().Sample, ppx_Sample.SampleEnd(builder))
+        elif body_type == ppx_MessageBody.MessageBody().SampleResult:
+            sample_result = ppx_SampleResult.SampleResult()
+            sample_result.Init(body_buffer.Bytes, body_buffer.Pos)
+            run['mu'] = float(ModelServer._protocol_tensor_to_variable(sample_result.Result()))
+            address = builder.CreateString('obs')
+            name = builder.CreateString('obs')
+            distribution = self._normal(builder, run['mu'], math.sqrt(2))
+            value = ModelServer._variable_to_protocol_tensor(builder, None)
+            ppx_Observe.ObserveStart(builder)
+            ppx_Observe.ObserveAddAddress(builder, address)
+            ppx_Observe.ObserveAddName(builder, name)
+            ppx_Observe.ObserveAddDistributionType(builder, ppx_Distribution.Distribution().Normal)
+            ppx_Observe.ObserveAddDistribution(builder, distribution)
+            ppx_Observe.ObserveAddValue(builder, value)
+            return self._message(builder, ppx_MessageBody.MessageBody().Observe, ppx_Observe.ObserveEnd(builder))
+        elif body_type == ppx_MessageBody.MessageBody().ObserveResult:
+            result = ModelServer._variable_to_protocol_tensor(builder, torch.tensor(run['mu']))
+            ppx_RunResult.RunResultStart(builder)
+            ppx_RunResult.RunResultAddResult(builder, result)
+            return self._message(builder, ppx_MessageBody.MessageBody().RunResult, ppx_RunResult.RunResultEnd(builder))
+        else:
+            raise RuntimeError('Unexpected message body type: {}'.format(body_type))
+
+    def serve(self):
+        context = zmq.Context()
+        socket = context.socket(zmq.ROUTER if self._router else zmq.REP)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(self._server_address)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        runs = {}
+        # Delayed replies of the ROUTER socket, as (due time, frames)
+        replies = []
+        try:
+            while not self._stop.is_set():
+                for reply in [reply for reply in replies if reply[0] <= time.time()]:
+                    replies.remove(reply)
+                    socket.send_multipart(reply[1])
+                if len(poller.poll(10 if len(replies) > 0 else 100)) == 0:
+                    continue
+                frames = socket.recv_multipart()
+                # The envelope of a ROUTER socket identifies the run, a REP socket runs one at a time
+                envelope = tuple(frames[:-1])
+                message = ppx_Message.Message.GetRootAsMessage(frames[-1], 0)
+                body_type = message.BodyType()
+                if self._hang_after_runs is not None and body_type == ppx_MessageBody.MessageBody().Run and self.num_runs >= self._hang_after_runs:
+                    # The simulator stops responding
+                    self._stop.wait()
+                    break
+                if body_type == ppx_MessageBody.MessageBody().Run:
+                    runs[envelope] = {}
+                    self.max_runs_in_flight = max(self.max_runs_in_flight, len(runs))
+                reply = self._reply(body_type, message.Body(), runs.get(envelope))
+                if body_type == ppx_MessageBody.MessageBody().ObserveResult:
+                    del runs[envelope]
+                if body_type != ppx_MessageBody.MessageBody().Run or self._delay_sec == 0.:
+                    socket.send_multipart(list(envelope) + [reply])
+                elif self._router:
+                    replies.append((time.time() + self._delay_sec, list(envelope) + [reply]))
+                else:
+                    time.sleep(self._delay_sec)
+                    socket.send_multipart(list(envelope) + [reply])
+        finally:
+            socket.close()
+            context.destroy()
+
+
+# A simulator sampling num_samples independent uncontrolled Normal(0, 1) values, observing obs from Normal(0, 1), and returning the sum of the samples
+# With batch=True, the samples and the observe are sent in one Batch message if pyprob offers batches in the handshake
+# With announce_batch=False, batches are sent without accepting them in the handshake result, which is a protocol error
+class IndependentNormalsSimulator(GaussianWithUnknownMeanSimulator):
+    def __init__(self, server_address, num_samples=10, batch=True, announce_batch=True):
+        super().__init__(server_address)
+        self._num_samples = num_samples
+        self._batch = batch
+        self._announce_batch = announce_batch
+        self.batch_negotiated = False
+        self.num_requests = 0
+
+    def _sample_message(self, builder):
+        address = builder.CreateString('x')
+        name = builder.CreateString('')
+        distribution = self._normal(builder, 0., 1.)
+        ppx_Sample.SampleStart(builder)
+        ppx_Sample.SampleAddAddress(builder, address)
+        ppx_Sample.SampleAddName(builder, name)
+        ppx_Sample.SampleAddDistributionType(builder, ppx_Distribution.Distribution().Normal)
+        ppx_Sample.SampleAddDistribution(builder, distribution)
+        ppx_Sample.SampleAddControl(builder, False)
+        body = ppx_Sample.SampleEnd(builder)
+        ppx_Message.MessageStart(builder)
+        ppx_Message.MessageAddBodyType(builder, ppx_MessageBody.MessageBody().Sample)
+        ppx_Message.MessageAddBody(builder, body)
+        return ppx_Message.MessageEnd(builder)
+
+    def _observe_message(self, builder):
+        address = builder.CreateString('obs')
+        name = builder.CreateString('obs')
+        distribution = self._normal(builder, 0., 1.)
+        value = ModelServer._variable_to_protocol_tensor(builder, None)
+        ppx_Observe.ObserveStart(builder)
+        ppx_Observe.ObserveAddAddress(builder, address)
+        ppx_Observe.ObserveAddName(builder, name)
+        ppx_Observe.ObserveAddDistributionType(builder, ppx_Distribution.Distribution().Normal)
+        ppx_Observe.ObserveAddDistribution(builder, distribution)
+        ppx_Observe.ObserveAddValue(builder, value)
+        body = ppx_Observe.ObserveEnd(builder)
+        ppx_Message.MessageStart(builder)
+        ppx_Message.MessageAddBodyType(builder, ppx_MessageBody.MessageBody().Observe)
+        ppx_Message.MessageAddBody(builder, body)
+        return ppx_Message.MessageEnd(builder)
+
+    def _run_result(self, builder, run):
+        result = ModelServer._variable_to_protocol_tensor(builder, torch.tensor(sum(run['x'])))
+        ppx_RunResult.RunResultStart(builder)
+        ppx_RunResult.RunResultAddResult(builder, result)
+        return self._message(builder, ppx_MessageBody.MessageBody().RunResult, ppx_RunResult.RunResultEnd(builder))
+
+    def _reply(self, body_type, body_buffer, run):
+        self.num_requests += 1
+        builder = flatbuffers.Builder(64)
+        if body_type == ppx_MessageBody.MessageBody().Handshake:
+            handshake = ppx_Handshake.Handshake()
+            handshake.Init(body_buffer.Bytes, body_buffer.Pos)
+            self.batch_negotiated = self._batch and bool(handshake.Batch())
+            system_name = builder.CreateString('Test simulator')
+            model_name = builder.CreateString('Independent normals')
+            ppx_HandshakeResult.HandshakeResultStart(builder)
+            ppx_HandshakeResult.HandshakeResultAddSystemName(builder, system_name)
+            ppx_HandshakeResult.HandshakeResultAddModelName(builder, model_name)
+            ppx_HandshakeResult.HandshakeResultAddBatch(builder, self.batch_negotiated and self._announce_batch)
+            return self._message(builder, ppx_MessageBody.MessageBody().HandshakeResult, ppx_HandshakeResult.HandshakeResultEnd(builder))
+        elif body_type == ppx_MessageBody.MessageBody().Run:
+            self.num_runs += 1
+            run['x'] = []
+            if self.batch_negotiated:
+                messages = [self._sample_message(builder) for i in range(self._num_samples)] + [self._observe_message(builder)]
+                ppx_Batch.BatchStartMessagesVector(builder, len(messages))
+                for message in reversed(messages):
+                    builder.PrependUOffsetTRelative(message)
+                messages = _end_vector(builder, len(messages))
+                ppx_Batch.BatchStart(builder)
+                ppx_Batch.BatchAddMessages(builder, messages)
+                return self._message(builder, ppx_MessageBody.MessageBody().Batch, ppx_Batch.BatchEnd(builder))
+            builder.Finish(self._sample_message(builder))
+            return builder.Output()
+        elif body_type == ppx_MessageBody.MessageBody().BatchResult:
+            batch_result = ppx_BatchResult.BatchResult()
+            batch_result.Init(body_buffer.Bytes, body_buffer.Pos)
+            for i in range(batch_result.ResultsLength()):
+                message = batch_result.Results(i)
+                if message.BodyType() == ppx_MessageBody.MessageBody().SampleResult:
+                    sample_result = ppx_SampleResult.SampleResult()
+                    sample_result.Init(message.Body().Bytes, message.Body().Pos)
+                    run['x'].append(float(ModelServer._protocol_tensor_to_variable(sample_result.Result())))
+            return self._run_result(builder, run)
+        elif body_type == ppx_MessageBody.MessageBody().SampleResult:
+            sample_result = ppx_SampleResult.SampleResult()
+            sample_result.Init(body_buffer.Bytes, body_buffer.Pos)
+            run['x'].append(float(ModelServer._protocol_tensor_to_variable(sample_result.Result())))
+            if len(run['x']) < self._num_samples:
+                builder.Finish(self._sample_message(builder))
+            else:
+                builder.Finish(self._observe_message(builder))
+            return builder.Output()
+        elif body_type == ppx_MessageBody.MessageBody().ObserveResult:
+            return self._run_result(builder, run)
+        else:
+            raise RuntimeError('Unexpected message body type: {}'.format(body_type))
+
+
+class ModelRemotePoolTestCase(unittest.TestCase):
+    def test_model_remote_pool_prior_posterior(self):
+        num_simulators = 4
+        prior_traces = 400
+        posterior_traces = 2000
+        prior_mean_correct = 1
+        prior_stddev_correct = math.sqrt(5)
+        posterior_mean_correct = 6
+        posterior_stddev_correct = math.sqrt(1 / 0.7)
+
+        server_addresses = ['ipc://@pyprob_test_{}'.format(uuid.uuid4()) for i in range(num_simulators)]
+        simulators = [GaussianWithUnknownMeanSimulator(server_address).start() for server_address in server_addresses]
+        model = ModelRemote(server_addresses)
+        prior = model.prior_distribution(prior_traces)
+        prior_mean = float(prior.mean)
+        prior_stddev = float(prior.stddev)
+        posterior = model.posterior_distribution(posterior_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, observe={'obs': 8})
+        posterior_mean = float(posterior.mean)
+        posterior_stddev = float(posterior.stddev)
+        model.close()
+        for simulator in simulators:
+            simulator.stop()
+        num_runs = [simulator.num_runs for simulator in simulators]
+        num_runs_total = sum(num_runs)
+        num_runs_total_correct = prior_traces + posterior_traces
+
+        util.eval_print('num_simulators', 'prior_traces', 'prior_mean', 'prior_mean_correct', 'prior_stddev', 'prior_stddev_correct', 'posterior_traces', 'posterior_mean', 'posterior_mean_correct', 'posterior_stddev', 'posterior_stddev_correct', 'num_runs', 'num_runs_total', 'num_runs_total_correct')
+
+        self.assertAlmostEqual(prior_mean, prior_mean_correct, delta=0.5)
+        self.assertAlmostEqual(prior_stddev, prior_stddev_correct, delta=0.5)
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, delta=0.5)
+        self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, delta=0.5)
+        self.assertEqual(num_runs_total, num_runs_total_correct)
+        self.assertTrue(all([n > 0 for n in num_runs]))
+
+    def test_model_remote_pool_max_consecutive_rejections(self):
+        num_simulators = 2
+        num_traces = 10
+        max_consecutive_rejections = 8
+
+        # Every trace samples once and exceeds a budget of no samples, trace generation stops with an error instead of rejecting traces forever
+        for runs_per_connection in [None, 4]:
+            server_addresses = ['ipc://@pyprob_test_{}'.format(uuid.uuid4()) for i in range(num_simulators)]
+            simulators = [GaussianWithUnknownMeanSimulator(server_address, router=runs_per_connection is not None).start() for server_address in server_addresses]
+            model = ModelRemote(server_addresses, runs_per_connection=runs_per_connection)
+            pyprob.set_trace_budget(num_samples=0, max_consecutive_rejections=max_consecutive_rejections)
+            try:
+                with self.assertRaises(RuntimeError) as context:
+                    model.prior_traces(num_traces)
+            finally:
+                pyprob.set_trace_budget()
+                model.close()
+                for simulator in simulators:
+                    simulator.stop()
+            num_traces_rejected = model._num_traces_rejected
+
+            util.eval_print('runs_per_connection', 'num_simulators', 'num_traces', 'max_consecutive_rejections', 'num_traces_rejected')
+
+            self.assertNotIsInstance(context.exception, util.TraceBudgetExceeded)
+            self.assertEqual(num_traces_rejected, max_consecutive_rejections)
+
+    def test_model_remote_pool_concurrent(self):
+        num_simulators = 4
+        num_traces = 40
+        delay_sec = 0.05
+        duration_sequential = num_traces * delay_sec
+
+        server_addresses = ['ipc://@pyprob_test_{}'.format(uuid.uuid4()) for i in range(num_simulators)]
+        simulators = [GaussianWithUnknownMeanSimulator(server_address, delay_sec=delay_sec).start() for server_address in server_addresses]
+        model = ModelRemote(server_addresses)
+        model.prior_traces(num_simulators)
+        time_start = time.time()
+        prior = model.prior_traces(num_traces)
+        duration = time.time() - time_start
+        model.close()
+        for simulator in simulators:
+            simulator.stop()
+        prior_length = prior.length
+
+        util.eval_print('num_simulators', 'num_traces', 'delay_sec', 'prior_length', 'duration', 'duration_sequential')
+
+        self.assertEqual(prior_length, num_traces)
+        self.assertLess(duration, 0.75 * duration_sequential)
+
+    def test_model_remote_pool_redispatch(self):
+        num_traces = 20
+        timeout_sec = 0.5
+
+        server_addresses = ['ipc://@pyprob_test_{}'.format(uuid.uuid4()) for i in range(2)]
+        simulators = [GaussianWithUnknownMeanSimulator(server_addresses[0]).start(), GaussianWithUnknownMeanSimulator(server_addresses[1], hang_after_runs=1).start()]
+        model = ModelRemote(server_addresses, timeout_sec=timeout_sec)
+        prior = model.prior_traces(num_traces)
+        num_failures = model._simulator_pool.num_failures
+        model.close()
+        for simulator in simulators:
+            simulator.stop()
+        prior_length = prior.length
+
+        util.eval_print('num_traces', 'timeout_sec', 'prior_length', 'num_failures')
+
+        self.assertEqual(prior_length, num_traces)
+        self.assertGreaterEqual(num_failures, 1)
+
+    def test_model_remote_pool_launcher(self):
+        num_simulators = 2
+        num_traces = 20
+        simulator_command = '{} {} {{address}}'.format(sys.executable, os.path.abspath(__file__))
+
+        # The launched simulators import pyprob from this source tree
+        python_path = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(pyprob.__file__)))
+        try:
+            model = ModelRemote(simulator_command=simulator_command, num_simulators=num_simulators, timeout_sec=10)
+            prior_length_1 = model.prior_traces(num_traces).length
+            # A simulator that dies is relaunched
+            process = list(model._simulator_pool._processes.values())[0]
+            process.kill()
+            process.wait()
+            prior_length_2 = model.prior_traces(num_traces).length
+            num_processes_alive = len([server_address for server_address in model._simulator_pool.server_addresses if model._simulator_pool.alive(server_address)])
+            model.close()
+        finally:
+            if python_path is None:
+                del os.environ['PYTHONPATH']
+            else:
+                os.environ['PYTHONPATH'] = python_path
+
+        util.eval_print('num_simulators', 'num_traces', 'prior_length_1', 'prior_length_2', 'num_processes_alive')
+
+        self.assertEqual(prior_length_1, num_traces)
+        self.assertEqual(prior_length_2, num_traces)
+        self.assertEqual(num_processes_alive, num_simulators)
+
+    def test_model_remote_pool_launcher_socket_files(self):
+        num_simulators = 2
+        simulator_command = '{} -c "import time; time.sleep(60)" {{address}}'.format(sys.executable)
+
+        # Platforms other than Linux have no abstract ipc sockets, the launched simulators get socket files in a temporary directory
+        with mock.patch.object(sys, 'platform', 'darwin'):
+            pool = SimulatorPool(simulator_command=simulator_command, num_simulators=num_simulators)
+        socket_dir = pool._socket_dir
+        server_addresses = pool.server_addresses
+        socket_dir_exists = os.path.isdir(socket_dir)
+        pool.close()
+        socket_dir_exists_after_close = os.path.isdir(socket_dir)
+
+        util.eval_print('num_simulators', 'socket_dir', 'server_addresses', 'socket_dir_exists', 'socket_dir_exists_after_close')
+
+        self.assertEqual(len(server_addresses), num_simulators)
+        self.assertEqual(len(set(server_addresses)), num_simulators)
+        for server_address in server_addresses:
+            self.assertTrue(server_address.startswith('ipc://' + socket_dir))
+        self.assertTrue(socket_dir_exists)
+        self.assertFalse(socket_dir_exists_after_close)
+
+    def test_model_remote_async_prior_posterior(self):
+        runs_per_connection = 8
+        prior_traces = 400
+        posterior_traces = 2000
+        prior_mean_correct = 1
+        prior_stddev_correct = math.sqrt(5)
+        posterior_mean_correct = 6
+        posterior_stddev_correct = math.sqrt(1 / 0.7)
+
+        server_address = 'ipc://@pyprob_test_{}'.format(uuid.uuid4())
+        simulator = GaussianWithUnknownMeanSimulator(server_address, router=True).start()
+        model = ModelRemote(server_address, runs_per_connection=runs_per_connection)
+        prior = model.prior_distribution(prior_traces)
+        prior_mean = float(prior.mean)
+        prior_stddev = float(prior.stddev)
+        posterior = model.posterior_distribution(posterior_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, observe={'obs': 8})
+        posterior_mean = float(posterior.mean)
+        posterior_stddev = float(posterior.stddev)
+        model.close()
+        simulator.stop()
+        num_runs = simulator.num_runs
+        num_runs_correct = prior_traces + posterior_traces
+        max_runs_in_flight = simulator.max_runs_in_flight
+        model_name = model.name
+        model_name_correct = 'Gaussian with unknown mean running on Test simulator'
+
+        util.eval_print('runs_per_connection', 'prior_traces', 'prior_mean', 'prior_mean_correct', 'prior_stddev', 'prior_stddev_correct', 'posterior_traces', 'posterior_mean', 'posterior_mean_correct', 'posterior_stddev', 'posterior_stddev_correct', 'num_runs', 'num_runs_correct', 'max_runs_in_flight', 'model_name', 'model_name_correct')
+
+        self.assertAlmostEqual(prior_mean, prior_mean_correct, delta=0.5)
+        self.assertAlmostEqual(prior_stddev, prior_stddev_correct, delta=0.5)
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, delta=0.5)
+        self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, delta=0.5)
+        self.assertEqual(num_runs, num_runs_correct)
+        self.assertGreater(max_runs_in_flight, 1)
+        self.assertLessEqual(max_runs_in_flight, runs_per_connection)
+        self.assertEqual(model_name, model_name_correct)
+
+    def test_model_remote_async_concurrent(self):
+        runs_per_connection = 8
+        num_traces = 40
+        delay_sec = 0.05
+        duration_sequential = num_traces * delay_sec
+
+        server_address = 'ipc://@pyprob_test_{}'.format(uuid.uuid4())
+        simulator = GaussianWithUnknownMeanSimulator(server_address, delay_sec=delay_sec, router=True).start()
+        model = ModelRemote(server_address, runs_per_connection=runs_per_connection)
+        model.prior_traces(runs_per_connection)
+        time_start = time.time()
+        prior = model.prior_traces(num_traces)
+        duration = time.time() - time_start
+        model.close()
+        simulator.stop()
+        prior_length = prior.length
+
+        util.eval_print('runs_per_connection', 'num_traces', 'delay_sec', 'prior_length', 'duration', 'duration_sequential')
+
+        self.assertEqual(prior_length, num_traces)
+        self.assertLess(duration, 0.5 * duration_sequential)
+
+    def test_model_remote_async_rep_redispatch(self):
+        num_traces = 20
+        timeout_sec = 0.5
+
+        # Simulators on zmq.REP sockets, with one run in flight on each connection
+        server_addresses = ['ipc://@pyprob_test_{}'.format(uuid.uuid4()) for i in range(2)]
+        simulators = [GaussianWithUnknownMeanSimulator(server_addresses[0]).start(), GaussianWithUnknownMeanSimulator(server_addresses[1], hang_after_runs=1).start()]
+        model = ModelRemote(server_addresses, timeout_sec=timeout_sec, runs_per_connection=1)
+        prior = model.prior_traces(num_traces)
+        num_failures = model._simulator_pool.num_failures
+        model.close()
+        for simulator in simulators:
+            simulator.stop()
+        prior_length = prior.length
+        num_runs = [simulator.num_runs for simulator in simulators]
+
+        util.eval_print('num_traces', 'timeout_sec', 'prior_length', 'num_failures', 'num_runs')
+
+        self.assertEqual(prior_length, num_traces)
+        self.assertGreaterEqual(num_failures, 1)
+        self.assertEqual(num_runs[1], 1)
+
+    def test_model_remote_batch(self):
+        num_samples = 10
+        num_traces = 200
+        posterior_mean_correct = 0
+        posterior_stddev_correct = math.sqrt(num_samples)
+        num_variables_correct = num_samples + 1
+        # Run and BatchResult with batches, and Run, a SampleResult for each sample, and ObserveResult without
+        requests_per_trace_batch_correct = 2
+        requests_per_trace_no_batch_correct = num_samples + 2
+
+        results = {}
+        for batch in [True, False]:
+            server_address = 'ipc://@pyprob_test_{}'.format(uuid.uuid4())
+            simulator = IndependentNormalsSimulator(server_address, num_samples=num_samples, batch=batch).start()
+            model = ModelRemote(server_address)
+            posterior = model.posterior_traces(num_traces, observe={'obs': 0})
+            model.close()
+            simulator.stop()
+            num_variables = set([len(trace.variables) for trace in posterior.get_values()])
+            num_variables_observed = set([len(trace.variables_observed) for trace in posterior.get_values()])
+            results[batch] = (posterior.map(lambda trace: trace.result), num_variables, num_variables_observed, simulator.batch_negotiated, (simulator.num_requests - 1) / num_traces)
+            posterior.close()
+
+        posterior_mean_batch = float(results[True][0].mean)
+        posterior_stddev_batch = float(results[True][0].stddev)
+        posterior_mean_no_batch = float(results[False][0].mean)
+        posterior_stddev_no_batch = float(results[False][0].stddev)
+        num_variables_batch, num_variables_observed_batch, batch_negotiated, requests_per_trace_batch = results[True][1:]
+        num_variables_no_batch, num_variables_observed_no_batch, no_batch_negotiated, requests_per_trace_no_batch = results[False][1:]
+
+        util.eval_print('num_samples', 'num_traces', 'posterior_mean_batch', 'posterior_mean_no_batch', 'posterior_mean_correct', 'posterior_stddev_batch', 'posterior_stddev_no_batch', 'posterior_stddev_correct', 'num_variables_batch', 'num_variables_no_batch', 'num_variables_correct', 'num_variables_observed_batch', 'num_variables_observed_no_batch', 'batch_negotiated', 'no_batch_negotiated', 'requests_per_trace_batch', 'requests_per_trace_batch_correct', 'requests_per_trace_no_batch', 'requests_per_trace_no_batch_correct')
+
+        self.assertAlmostEqual(posterior_mean_batch, posterior_mean_correct, delta=0.75)
+        self.assertAlmostEqual(posterior_mean_no_batch, posterior_mean_correct, delta=0.75)
+        self.assertAlmostEqual(posterior_stddev_batch, posterior_stddev_correct, delta=0.75)
+        self.assertAlmostEqual(posterior_stddev_no_batch, posterior_stddev_correct, delta=0.75)
+        self.assertEqual(num_variables_batch, {num_variables_correct})
+        self.assertEqual(num_variables_no_batch, {num_variables_correct})
+        self.assertEqual(num_variables_observed_batch, {1})
+        self.assertEqual(num_variables_observed_no_batch, {1})
+        self.assertTrue(batch_negotiated)
+        self.assertFalse(no_batch_negotiated)
+        self.assertEqual(requests_per_trace_batch, requests_per_trace_batch_correct)
+        self.assertEqual(requests_per_trace_no_batch, requests_per_trace_no_batch_correct)
+
+    def test_model_remote_batch_not_negotiated(self):
+        server_address = 'ipc://@pyprob_test_{}'.format(uuid.uuid4())
+        simulator = IndependentNormalsSimulator(server_address, announce_batch=False).start()
+        model = ModelRemote(server_address)
+        with self.assertRaises(RuntimeError):
+            model.prior_traces(1)
+        model.close()
+        simulator.stop()
+
+
+class ProtocolTensorTestCase(unittest.TestCase):
+    def _encode(self, variable):
+        builder = flatbuffers.Builder(64)
+        builder.Finish(ModelServer._variable_to_protocol_tensor(builder, variable))
+        return builder.Output()
+
+    def _decode(self, buffer):
+        return ModelServer._protocol_tensor_to_variable(ppx_Tensor.Tensor.GetRootAsTensor(buffer, 0))
+
+    def test_protocol_tensor_round_trip(self):
+        tensors = {'multi_dimensional': torch.arange(24, dtype=torch.float64).view(2, 3, 4),
+                   'non_contiguous': torch.arange(12.).view(3, 4).t(),
+                   'float64': torch.tensor([0.1, -2.5, 1e10], dtype=torch.float64),
+                   'int': torch.tensor([[1, -2], [3, 2**31]], dtype=torch.int64),
+                   'vector': torch.tensor([1.5])}
+        self.assertFalse(tensors['non_contiguous'].is_contiguous())
+        for name, t in tensors.items():
+            decoded = self._decode(self._encode(t))
+            util.eval_print('name', 't', 'decoded')
+            self.assertEqual(decoded.shape, t.shape)
+            self.assertEqual(decoded.dtype, util._dtype)
+            self.assertTrue(torch.equal(decoded, t.to(dtype=util._dtype)))
+
+    def test_protocol_tensor_round_trip_scalar(self):
+        # A 0-d tensor is sent with an empty shape and comes back as a single element
+        t = torch.tensor(3.25)
+        decoded = self._decode(self._encode(t))
+
+        util.eval_print('t', 'decoded')
+
+        self.assertEqual(decoded.numel(), 1)
+        self.assertEqual(float(decoded), 3.25)
+
+    def test_protocol_tensor_round_trip_empty_none(self):
+        decoded_empty = self._decode(self._encode(torch.zeros(0)))
+        decoded_none = self._decode(self._encode(None))
+
+        util.eval_print('decoded_empty', 'decoded_none')
+
+        self.assertIsNone(decoded_empty)
+        self.assertIsNone(decoded_none)
+        self.assertIsNone(ModelServer._protocol_tensor_to_variable(None))
+
+    def test_protocol_tensor_round_trip_no_shared_storage(self):
+        t = torch.tensor([[1., 2.], [3., 4.]])
+        t_correct = t.clone()
+        buffer = self._encode(t)
+        # Mutating the source after encoding must not change the message
+        t.add_(100)
+        decoded = self._decode(buffer)
+        # Mutating the decoded tensor must not change the message buffer
+        decoded.mul_(-1)
+        decoded_again = self._decode(buffer)
+
+        util.eval_print('t', 'decoded', 'decoded_again', 't_correct')
+
+        self.assertTrue(torch.equal(decoded, -t_correct))
+        self.assertTrue(torch.equal(decoded_again, t_correct))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and '://' in sys.argv[1]:
+        # Runs as a simulator launched by test_model_remote_pool_launcher
+        GaussianWithUnknownMeanSimulator(sys.argv[1]).serve()
+    else:
+        pyprob.set_random_seed(123)
+        pyprob.set_verbosity(1)
+        unittest.main(verbosity=2)
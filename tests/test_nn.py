@@ -1,9 +1,22 @@
 import unittest
+import math
+import random
+import os
+import uuid
+import tempfile
+import shutil
+import tarfile
+import socket
+import time
 import torch
+from torch.utils.data import DataLoader
 
 import pyprob
-from pyprob import util
-from pyprob.nn import EmbeddingFeedForward, EmbeddingCNN2D5C, EmbeddingCNN3D4C
+from pyprob import util, Model, PriorInflation
+from pyprob.distributions import Normal, Categorical
+from pyprob.nn import EmbeddingFeedForward, EmbeddingCNN2D5C, EmbeddingCNN3D4C, Batch, BatchGenerator, ReplayBuffer, TraceDataset, collate_traces, InferenceNetworkFeedForward, MetricsWriter, read_metrics, TraceStoreFile, save_trace_store_file, load_trace_store_file, convert_trace_store
+from pyprob.nn import inference_network_feedforward
+from pyprob.diagnostics import network_statistics
 
 
 class NNTestCase(unittest.TestCase):
@@ -56,6 +69,711 @@ class NNTestCase(unittest.TestCase):
         self.assertEqual(output_batch_shape, output_batch_shape_correct)
 
 
+
+class BatchGeneratorTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class GaussianModel(Model):
+            def __init__(self):
+                super().__init__('Gaussian model')
+
+            def forward(self):
+                mu = pyprob.sample(Normal(1., 2.))
+                pyprob.observe(Normal(mu, 1.), name='obs')
+                return mu
+
+        class GeometricModel(Model):
+            def __init__(self):
+                super().__init__('Geometric model')
+
+            def forward(self):
+                num_steps = 1
+                while float(pyprob.sample(Categorical([0.3, 0.7]))) == 1:
+                    num_steps += 1
+                return num_steps
+
+        self._model = GaussianModel()
+        self._geometric_model = GeometricModel()
+        super().__init__(*args, **kwargs)
+
+    def test_batch_generator_prefetch(self):
+        batch_size = 16
+        num_batches = 5
+        prefetch_batches = 2
+        batch_lengths_correct = [batch_size] * num_batches
+
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED)
+        batch_generator.start_prefetch(batch_size, num_workers=2, queue_size=prefetch_batches)
+        batch_lengths = [batch_generator.get_batch(batch_size).length for i in range(num_batches)]
+        prefetch_statistics = batch_generator.prefetch_statistics()
+        batch_generator.stop_prefetch()
+        prefetch_workers = len(batch_generator._prefetch_workers)
+        prefetch_workers_correct = 0
+        util.eval_print('batch_size', 'num_batches', 'prefetch_batches', 'batch_lengths', 'batch_lengths_correct', 'prefetch_statistics', 'prefetch_workers', 'prefetch_workers_correct')
+
+        self.assertEqual(batch_lengths, batch_lengths_correct)
+        self.assertEqual(prefetch_statistics['batches'], num_batches)
+        self.assertLessEqual(prefetch_statistics['queue_depth_mean'], prefetch_batches)
+        self.assertEqual(prefetch_workers, prefetch_workers_correct)
+
+    def test_batch_generator_bucketing(self):
+        batch_size = 32
+        num_batches = 100
+        trace_length_mean_correct = 1 / 0.3
+
+        batch_generator = BatchGenerator(self._geometric_model, PriorInflation.DISABLED)
+        batches = [batch_generator.get_batch(batch_size) for i in range(num_batches)]
+        sub_batch_size_mean = sum([batch.length for batch in batches]) / sum([len(batch.sub_batches) for batch in batches])
+
+        batch_generator = BatchGenerator(self._geometric_model, PriorInflation.DISABLED, bucketing_buffer_size=8 * batch_size)
+        batches = [batch_generator.get_batch(batch_size) for i in range(num_batches)]
+        sub_batch_size_mean_bucketing = sum([batch.length for batch in batches]) / sum([len(batch.sub_batches) for batch in batches])
+        trace_length_mean = sum([trace.length for batch in batches for trace in batch.traces]) / (num_batches * batch_size)
+        batch_lengths_correct = [batch_size] * num_batches
+        batch_lengths = [batch.length for batch in batches]
+
+        util.eval_print('batch_size', 'num_batches', 'sub_batch_size_mean', 'sub_batch_size_mean_bucketing', 'trace_length_mean', 'trace_length_mean_correct')
+
+        self.assertEqual(batch_lengths, batch_lengths_correct)
+        self.assertGreater(sub_batch_size_mean_bucketing, sub_batch_size_mean)
+        self.assertAlmostEqual(trace_length_mean, trace_length_mean_correct, places=0)
+
+    def test_batch_generator_trace_store_index(self):
+        num_files = 4
+        traces_per_file = 8
+        trace_store_dir = tempfile.mkdtemp()
+
+        BatchGenerator(self._model, PriorInflation.DISABLED).save_trace_store(trace_store_dir, files=num_files, traces_per_file=traces_per_file)
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED, trace_store_dir)
+        batch_generator._trace_store_rescan_interval_sec = 0
+        num_files_indexed = len(batch_generator._trace_store_files)
+        batch_generator.get_batch(traces_per_file, discard_source=True)
+        num_files_after_discard = len(batch_generator._trace_store_files)
+        num_files_discarded = len(batch_generator._trace_store_discarded_file_names)
+        # Files written by another producer are picked up from the manifest
+        BatchGenerator(self._model, PriorInflation.DISABLED).save_trace_store(trace_store_dir, files=num_files, traces_per_file=traces_per_file)
+        batch_generator.get_batch(traces_per_file)
+        num_files_after_rescan = len(batch_generator._trace_store_files)
+        # A file copied in without a manifest entry is indexed, and a file deleted from disk is dropped from the index
+        file_name_deleted = batch_generator._trace_store_files[0]
+        file_name_copied = os.path.join(trace_store_dir, 'pyprob_traces_copied')
+        shutil.copyfile(batch_generator._trace_store_files[1], file_name_copied)
+        os.remove(file_name_deleted)
+        # The modification time of the directory is made to differ from the one seen at the last listing, which file systems with coarse timestamps do not guarantee within a test
+        os.utime(trace_store_dir, ns=(time.time_ns(), batch_generator._trace_store_dir_mtime + 1))
+        with batch_generator._lock:
+            batch_generator._trace_store_index_refresh()
+        num_files_after_changes = len(batch_generator._trace_store_files)
+        file_copied_indexed = file_name_copied in batch_generator._trace_store_file_positions
+        file_deleted_indexed = file_name_deleted in batch_generator._trace_store_file_positions
+        positions_correct = all([batch_generator._trace_store_files[position] == file_name for file_name, position in batch_generator._trace_store_file_positions.items()])
+        shutil.rmtree(trace_store_dir)
+
+        util.eval_print('num_files', 'traces_per_file', 'num_files_indexed', 'num_files_after_discard', 'num_files_discarded', 'num_files_after_rescan', 'num_files_after_changes', 'file_copied_indexed', 'file_deleted_indexed', 'positions_correct')
+
+        self.assertEqual(num_files_indexed, num_files)
+        self.assertEqual(num_files_after_discard, num_files - 1)
+        self.assertEqual(num_files_discarded, 1)
+        self.assertEqual(num_files_after_rescan, 2 * num_files - 1)
+        self.assertEqual(num_files_after_changes, 2 * num_files - 1)
+        self.assertTrue(file_copied_indexed)
+        self.assertFalse(file_deleted_indexed)
+        self.assertTrue(positions_correct)
+
+    def test_batch_generator_trace_store_epoch(self):
+        num_files = 4
+        traces_per_file = 8
+        batch_size = 8
+        shuffle_buffer_size = 12
+        trace_store_dir = tempfile.mkdtemp()
+
+        BatchGenerator(self._model, PriorInflation.DISABLED).save_trace_store(trace_store_dir, files=num_files, traces_per_file=traces_per_file)
+        traces_stored = []
+        for file_name in os.listdir(trace_store_dir):
+            if not file_name.startswith('.'):
+                traces_stored += load_trace_store_file(os.path.join(trace_store_dir, file_name))
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED, trace_store_dir, trace_store_shuffle_buffer_size=shuffle_buffer_size)
+        traces_used = []
+        buffer_length_max = 0
+        for i in range(num_files * traces_per_file // batch_size - 1):
+            traces_used += batch_generator.get_batch(batch_size).traces
+            buffer_length_max = max(buffer_length_max, len(batch_generator._trace_store_shuffle_buffer))
+        epoch = batch_generator._trace_store_epoch
+        # The traces left in the shuffle buffer complete the epoch
+        traces_used += batch_generator._trace_store_shuffle_buffer
+        shutil.rmtree(trace_store_dir)
+
+        def trace_key(trace):
+            return tuple(float(variable.value) for variable in trace.variables_controlled)
+
+        traces_stored = sorted(trace_key(trace) for trace in traces_stored)
+        traces_used = sorted(trace_key(trace) for trace in traces_used)
+        traces_used_once_correct = traces_stored == traces_used
+
+        util.eval_print('num_files', 'traces_per_file', 'batch_size', 'shuffle_buffer_size', 'epoch', 'buffer_length_max', 'traces_used_once_correct')
+
+        self.assertEqual(epoch, 1)
+        self.assertLess(buffer_length_max, shuffle_buffer_size)
+        self.assertTrue(traces_used_once_correct)
+
+    def test_replay_buffer(self):
+        size = 16
+        num_traces = 64
+        traces = self._model._training_traces(num_traces, PriorInflation.DISABLED)
+        file_name = os.path.join(tempfile.mkdtemp(), 'replay_buffer')
+
+        buffer_fifo = ReplayBuffer(size, eviction='fifo')
+        buffer_fifo.add(traces)
+        buffer_fifo_traces = buffer_fifo.sample(num_traces)
+        buffer_fifo_length = len(buffer_fifo)
+        # FIFO eviction keeps the latest traces
+        buffer_fifo_latest_correct = set([id(trace) for trace in buffer_fifo_traces]) == set([id(trace) for trace in traces[-size:]])
+
+        buffer_reservoir = ReplayBuffer(size, eviction='reservoir')
+        buffer_reservoir.add(traces)
+        buffer_reservoir_length = len(buffer_reservoir)
+        buffer_reservoir_unique = len(set([id(trace) for trace in buffer_reservoir.sample(size)]))
+
+        buffer_disk = ReplayBuffer(size, eviction='fifo', file_name=file_name)
+        buffer_disk.add(traces)
+        buffer_disk_values = sorted([float(trace.variables_controlled[0].value) for trace in buffer_disk.sample(size)])
+        buffer_disk.close()
+        buffer_disk_values_correct = sorted([float(trace.variables_controlled[0].value) for trace in traces[-size:]])
+        shutil.rmtree(os.path.dirname(file_name))
+
+        util.eval_print('size', 'num_traces', 'buffer_fifo_length', 'buffer_fifo_latest_correct', 'buffer_reservoir_length', 'buffer_reservoir_unique', 'buffer_disk_values', 'buffer_disk_values_correct')
+
+        self.assertEqual(buffer_fifo_length, size)
+        self.assertTrue(buffer_fifo_latest_correct)
+        self.assertEqual(buffer_reservoir_length, size)
+        self.assertEqual(buffer_reservoir_unique, size)
+        self.assertEqual(buffer_disk_values, buffer_disk_values_correct)
+
+    def test_batch_generator_replay(self):
+        batch_size = 16
+        num_batches = 8
+        replay_buffer_size = 64
+        replay_mix = 0.75
+        num_traces_replayed_correct = (num_batches - 1) * int(round(replay_mix * batch_size))
+        num_traces_new_correct = batch_size * num_batches - num_traces_replayed_correct
+
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED, replay_buffer_size=replay_buffer_size, replay_mix=replay_mix)
+        batch_lengths = [batch_generator.get_batch(batch_size).length for i in range(num_batches)]
+        batch_generator.close()
+        batch_lengths_correct = [batch_size] * num_batches
+        num_traces_new = batch_generator._replay_num_traces_new
+        num_traces_replayed = batch_generator._replay_num_traces_replayed
+
+        util.eval_print('batch_size', 'num_batches', 'replay_buffer_size', 'replay_mix', 'batch_lengths', 'batch_lengths_correct', 'num_traces_new', 'num_traces_new_correct', 'num_traces_replayed', 'num_traces_replayed_correct')
+
+        self.assertEqual(batch_lengths, batch_lengths_correct)
+        self.assertEqual(num_traces_new, num_traces_new_correct)
+        self.assertEqual(num_traces_replayed, num_traces_replayed_correct)
+
+    def test_trace_dataset_trace_store_workers(self):
+        num_files = 4
+        traces_per_file = 8
+        batch_size = 8
+        num_workers = 2
+        trace_store_dir = tempfile.mkdtemp()
+
+        BatchGenerator(self._model, PriorInflation.DISABLED).save_trace_store(trace_store_dir, files=num_files, traces_per_file=traces_per_file)
+        traces_stored = []
+        for file_name in os.listdir(trace_store_dir):
+            if not file_name.startswith('.'):
+                traces_stored += load_trace_store_file(os.path.join(trace_store_dir, file_name))
+        data_loader = DataLoader(TraceDataset(trace_store_dir=trace_store_dir, epochs=1), batch_size=batch_size, num_workers=num_workers, collate_fn=collate_traces)
+        batches = list(data_loader)
+        shutil.rmtree(trace_store_dir)
+        num_batches = len(batches)
+        num_batches_correct = num_files * traces_per_file // batch_size
+        named_values_shape = list(batches[0].named_values['obs'].shape)
+        named_values_shape_correct = [batch_size, 1]
+        named_values_correct = all([torch.equal(batch.named_values['obs'][i], batch.traces[i].named_variables['obs'].value.view(-1)) for batch in batches for i in range(batch.length)])
+
+        def trace_key(trace):
+            return tuple(float(variable.value) for variable in trace.variables_controlled)
+
+        traces_stored = sorted(trace_key(trace) for trace in traces_stored)
+        traces_used = sorted(trace_key(trace) for batch in batches for trace in batch.traces)
+        traces_used_once_correct = traces_stored == traces_used
+
+        util.eval_print('num_files', 'traces_per_file', 'batch_size', 'num_workers', 'num_batches', 'num_batches_correct', 'named_values_shape', 'named_values_shape_correct', 'named_values_correct', 'traces_used_once_correct')
+
+        self.assertEqual(num_batches, num_batches_correct)
+        self.assertEqual(named_values_shape, named_values_shape_correct)
+        self.assertTrue(named_values_correct)
+        self.assertTrue(traces_used_once_correct)
+
+    def test_trace_dataset_trace_store_more_workers_than_files(self):
+        num_files = 2
+        traces_per_file = 8
+        batch_size = 4
+        num_workers = 4
+        trace_store_dir = tempfile.mkdtemp()
+
+        BatchGenerator(self._model, PriorInflation.DISABLED).save_trace_store(trace_store_dir, files=num_files, traces_per_file=traces_per_file)
+        data_loader = DataLoader(TraceDataset(trace_store_dir=trace_store_dir, epochs=1), batch_size=batch_size, num_workers=num_workers, collate_fn=collate_traces)
+        # Workers without files finish without traces
+        num_traces = sum([batch.length for batch in data_loader])
+        num_traces_correct = num_files * traces_per_file
+        shutil.rmtree(trace_store_dir)
+
+        util.eval_print('num_files', 'traces_per_file', 'batch_size', 'num_workers', 'num_traces', 'num_traces_correct')
+
+        self.assertEqual(num_traces, num_traces_correct)
+
+    def test_trace_dataset_trace_store_partial_manifest(self):
+        num_files = 2
+        traces_per_file = 8
+        batch_size = 4
+        trace_store_dir = tempfile.mkdtemp()
+
+        BatchGenerator(self._model, PriorInflation.DISABLED).save_trace_store(trace_store_dir, files=num_files, traces_per_file=traces_per_file)
+        file_names = [name for name in os.listdir(trace_store_dir) if not name.startswith('.')]
+        # A file copied in without a manifest entry is read, and a file in the manifest deleted from disk is not
+        shutil.copyfile(os.path.join(trace_store_dir, file_names[0]), os.path.join(trace_store_dir, 'pyprob_traces_copied'))
+        os.remove(os.path.join(trace_store_dir, file_names[1]))
+        data_loader = DataLoader(TraceDataset(trace_store_dir=trace_store_dir, epochs=1), batch_size=batch_size, collate_fn=collate_traces)
+        num_traces = sum([batch.length for batch in data_loader])
+        num_traces_correct = num_files * traces_per_file
+        shutil.rmtree(trace_store_dir)
+
+        util.eval_print('num_files', 'traces_per_file', 'batch_size', 'num_traces', 'num_traces_correct')
+
+        self.assertEqual(num_traces, num_traces_correct)
+
+    def test_trace_store_file(self):
+        num_traces = 100
+        indices = [50, 3, 99, 7]
+        file_name = os.path.join(tempfile.mkdtemp(), 'pyprob_traces')
+
+        traces = self._geometric_model._training_traces(num_traces, PriorInflation.DISABLED)
+        save_trace_store_file(traces, file_name, self._geometric_model.name)
+        trace_store_file = TraceStoreFile(file_name)
+        traces_loaded = trace_store_file.traces()
+        trace_store_length = len(trace_store_file)
+        num_trace_types = len(trace_store_file.trace_types)
+        num_trace_types_correct = len(Batch(traces).sub_batches)
+        trace_lengths = sorted([trace.length for trace in traces])
+        trace_lengths_loaded = sorted([trace.length for trace in traces_loaded])
+        log_prob = sum([float(trace.log_prob) for trace in traces])
+        log_prob_loaded = sum([float(trace.log_prob) for trace in traces_loaded])
+        num_traces_indexed = len(trace_store_file.traces(indices))
+        os.remove(file_name)
+
+        util.eval_print('num_traces', 'trace_store_length', 'num_trace_types', 'num_trace_types_correct', 'log_prob', 'log_prob_loaded', 'indices', 'num_traces_indexed')
+
+        self.assertEqual(trace_store_length, num_traces)
+        self.assertEqual(num_trace_types, num_trace_types_correct)
+        self.assertEqual(trace_lengths, trace_lengths_loaded)
+        self.assertAlmostEqual(log_prob, log_prob_loaded, places=3)
+        self.assertEqual(num_traces_indexed, len(indices))
+
+    def test_trace_store_file_fields(self):
+        num_traces = 50
+        file_name = os.path.join(tempfile.mkdtemp(), 'pyprob_traces')
+
+        class RejectionSamplingModel(Model):
+            def __init__(self):
+                super().__init__('Rejection sampling model')
+
+            def forward(self):
+                x = -1
+                while float(x) < 0:
+                    x = pyprob.sample(Normal(0., 1.), replace=True)
+                pyprob.sample(Normal(x, 1.), control=False)
+                pyprob.observe(Normal(x, 1.), 0.5)
+                pyprob.observe(Normal(x, 1.), name='obs')
+                return x
+
+        traces = RejectionSamplingModel()._training_traces(num_traces, PriorInflation.DISABLED)
+        save_trace_store_file(traces, file_name)
+        traces_loaded = load_trace_store_file(file_name)
+        os.remove(file_name)
+
+        def variable_fields(variable):
+            return (variable.address, variable.name, variable.control, variable.replace, variable.observed, variable.reused, float(variable.value), round(float(variable.log_prob), 4))
+
+        def trace_key(trace):
+            return float(trace.variables_controlled[0].value)
+
+        traces = sorted(traces, key=trace_key)
+        traces_loaded = sorted(traces_loaded, key=trace_key)
+        # Kept: the accepted controlled variable and the observed variables, with all their fields, and the log_prob, log_prob_observed and log_importance_weight of the trace
+        variables_correct = [[variable_fields(variable) for variable in trace.variables_controlled + trace.variables_observed] for trace in traces]
+        variables_loaded = [[variable_fields(variable) for variable in trace.variables] for trace in traces_loaded]
+        log_probs_correct = [[round(float(trace.log_prob), 4), round(float(trace.log_prob_observed), 4), round(float(trace.log_importance_weight), 4)] for trace in traces]
+        log_probs_loaded = [[round(float(trace.log_prob), 4), round(float(trace.log_prob_observed), 4), round(float(trace.log_importance_weight), 4)] for trace in traces_loaded]
+        # Not kept: the replaced variables, the uncontrolled unnamed variable, and the result
+        num_variables_replaced = sum([len(trace.variables_replaced) for trace in traces])
+        num_variables_replaced_loaded = sum([len(trace.variables_replaced) for trace in traces_loaded])
+        num_variables_uncontrolled_loaded = sum([len(trace.variables_uncontrolled) for trace in traces_loaded])
+        results_loaded = set([trace.result for trace in traces_loaded])
+
+        util.eval_print('num_traces', 'num_variables_replaced', 'num_variables_replaced_loaded', 'num_variables_uncontrolled_loaded', 'results_loaded')
+
+        self.assertEqual(variables_loaded, variables_correct)
+        self.assertEqual(log_probs_loaded, log_probs_correct)
+        self.assertGreater(num_variables_replaced, 0)
+        self.assertEqual(num_variables_replaced_loaded, 0)
+        self.assertEqual(num_variables_uncontrolled_loaded, 0)
+        self.assertEqual(results_loaded, {None})
+
+    def test_trace_store_convert(self):
+        num_traces = 32
+        trace_store_dir = tempfile.mkdtemp()
+        file_name = os.path.join(trace_store_dir, 'pyprob_traces')
+
+        traces = self._model._training_traces(num_traces, PriorInflation.DISABLED)
+        # A trace store file in the format of earlier versions
+        tmp_file_name = os.path.join(tempfile.mkdtemp(), 'pyprob_traces')
+        torch.save({'traces': traces, 'model_name': self._model.name, 'pyprob_version': pyprob.__version__, 'torch_version': torch.__version__}, tmp_file_name)
+        with tarfile.open(file_name, 'w:gz') as tar:
+            tar.add(tmp_file_name, arcname='pyprob_traces')
+        values = [float(trace.named_variables['obs'].value) for trace in traces]
+        values_tar_gz = [float(trace.named_variables['obs'].value) for trace in load_trace_store_file(file_name)]
+        num_files_converted = convert_trace_store(trace_store_dir)
+        values_converted = [float(trace.named_variables['obs'].value) for trace in load_trace_store_file(file_name)]
+        shutil.rmtree(trace_store_dir)
+
+        util.eval_print('num_traces', 'num_files_converted')
+
+        self.assertEqual(num_files_converted, 1)
+        self.assertEqual(values_tar_gz, values)
+        self.assertEqual(values_converted, values)
+
+
+class DistributedModel(Model):
+    def __init__(self, rank):
+        super().__init__('Distributed model')
+        self._rank = rank
+
+    def forward(self):
+        mu = pyprob.sample(Normal(1., 2.))
+        # An address that only this process sees
+        pyprob.sample(Normal(0., 1.), address='rank{}'.format(self._rank))
+        pyprob.observe(Normal(mu, 1.), name='obs')
+        return mu
+
+
+def distributed_optimize(rank, world_size, port, num_traces_per_rank, batch_size, result_dir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        model = DistributedModel(rank)
+        inference_network = InferenceNetworkFeedForward(model=model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4)
+        # Finite DataLoaders of different lengths, all processes stop when the shortest is exhausted
+        data_loader = DataLoader(TraceDataset(model, num_traces=num_traces_per_rank[rank]), batch_size=batch_size, collate_fn=collate_traces)
+        inference_network.optimize(None, data_loader)
+        torch.save({'addresses': list(inference_network._layer_proposal.keys()), 'state_dict': inference_network.state_dict(), 'total_train_traces': inference_network._total_train_traces}, os.path.join(result_dir, str(rank)))
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+class InferenceNetworkTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class GeometricModel(Model):
+            def __init__(self):
+                super().__init__('Geometric model')
+
+            def forward(self):
+                num_steps = 1
+                while float(pyprob.sample(Categorical([0.3, 0.7]))) == 1:
+                    pyprob.sample(Normal(0., 1.))
+                    num_steps += 1
+                pyprob.observe(Normal(num_steps, 1.), name='obs')
+                return num_steps
+
+        self._model = GeometricModel()
+        super().__init__(*args, **kwargs)
+
+    def test_inference_network_loss_grouped_by_address(self):
+        batch_size = 64
+
+        inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4)
+        batch = BatchGenerator(self._model, PriorInflation.DISABLED).get_batch(batch_size)
+        inference_network._valid_batch = batch
+        inference_network._init_layer_observe_embeddings(inference_network._observe_embeddings)
+        inference_network._polymorph(batch)
+
+        # The loss as computed before grouping by address: per sub-batch, with one proposal layer call per time step
+        def loss_per_sub_batch(batch):
+            batch_loss = 0.
+            for sub_batch in batch.sub_batches:
+                example_trace = sub_batch[0]
+                observe_embedding = inference_network._embed_observe(sub_batch)
+                for time_step in range(example_trace.length_controlled):
+                    address = example_trace.variables_controlled[time_step].address
+                    variables = [trace.variables_controlled[time_step] for trace in sub_batch]
+                    values = torch.stack([v.value for v in variables])
+                    proposal_distribution = inference_network._layer_proposal[address].forward(observe_embedding, variables)
+                    batch_loss += -torch.sum(proposal_distribution.log_prob(values))
+            return batch_loss / batch.length
+
+        _, loss = inference_network._loss(batch)
+        loss.backward()
+        grads = [p.grad.clone() for p in inference_network.parameters()]
+        inference_network.zero_grad()
+        loss_correct = loss_per_sub_batch(batch)
+        loss_correct.backward()
+        grads_correct = [p.grad.clone() for p in inference_network.parameters()]
+        loss, loss_correct = float(loss), float(loss_correct)
+        num_sub_batches = len(batch.sub_batches)
+        num_addresses_max = max([trace.length_controlled for trace in batch.traces])
+        grads_correct_close = all([torch.allclose(g, g_correct, atol=1e-5) for g, g_correct in zip(grads, grads_correct)])
+
+        util.eval_print('batch_size', 'num_sub_batches', 'num_addresses_max', 'loss', 'loss_correct', 'grads_correct_close')
+
+        self.assertGreater(num_sub_batches, 1)
+        self.assertGreater(num_addresses_max, 1)
+        self.assertAlmostEqual(loss, loss_correct, places=4)
+        self.assertTrue(grads_correct_close)
+
+    @unittest.skipIf(not torch.distributed.is_available(), 'torch.distributed is not available')
+    def test_inference_network_distributed_seed(self):
+        seed = 123
+        # Rank 0 keeps the random stream of the caller
+        pyprob.set_random_seed(seed)
+        value_rank_0_correct = random.random()
+        pyprob.set_random_seed(seed)
+        inference_network_feedforward._distributed_seed(0)
+        value_rank_0 = random.random()
+        # Other ranks are seeded once from the seed offset by the rank, further calls continue their random streams
+        pyprob.set_random_seed(seed)
+        inference_network_feedforward._distributed_seed(1)
+        value_rank_1_first = random.random()
+        inference_network_feedforward._distributed_seed(1)
+        value_rank_1_second = random.random()
+        # A new set_random_seed seeds them again
+        pyprob.set_random_seed(seed)
+        inference_network_feedforward._distributed_seed(1)
+        value_rank_1_reseeded = random.random()
+        random_seed = util._random_seed
+        inference_network_feedforward._distributed_base_seed = None
+        pyprob.set_random_seed(seed)
+
+        util.eval_print('seed', 'random_seed', 'value_rank_0', 'value_rank_0_correct', 'value_rank_1_first', 'value_rank_1_second', 'value_rank_1_reseeded')
+
+        self.assertEqual(random_seed, seed)
+        self.assertEqual(value_rank_0, value_rank_0_correct)
+        self.assertNotEqual(value_rank_1_first, value_rank_0)
+        self.assertNotEqual(value_rank_1_second, value_rank_1_first)
+        self.assertEqual(value_rank_1_reseeded, value_rank_1_first)
+
+    def test_inference_network_distributed(self):
+        world_size = 2
+        batch_size = 16
+        num_traces_per_rank = [4 * batch_size, 8 * batch_size]
+        # The validation batch takes the first batch of each process
+        total_train_traces_correct = (min(num_traces_per_rank) // batch_size - 1) * batch_size * world_size
+        result_dir = tempfile.mkdtemp()
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        torch.multiprocessing.spawn(distributed_optimize, args=(world_size, port, num_traces_per_rank, batch_size, result_dir), nprocs=world_size)
+        results = [util.torch_load(os.path.join(result_dir, str(rank))) for rank in range(world_size)]
+        shutil.rmtree(result_dir)
+        addresses = [result['addresses'] for result in results]
+        rank_addresses_correct = all([any([address.startswith('rank{}__'.format(rank)) for address in addresses[0]]) for rank in range(world_size)])
+        total_train_traces = [result['total_train_traces'] for result in results]
+        state_dicts = [result['state_dict'] for result in results]
+        parameters_equal = state_dicts[0].keys() == state_dicts[1].keys() and all([torch.equal(state_dicts[0][name], state_dicts[1][name]) for name in state_dicts[0]])
+
+        util.eval_print('world_size', 'batch_size', 'num_traces_per_rank', 'addresses', 'rank_addresses_correct', 'total_train_traces', 'total_train_traces_correct', 'parameters_equal')
+
+        self.assertEqual(addresses[0], addresses[1])
+        self.assertTrue(rank_addresses_correct)
+        self.assertEqual(total_train_traces, [total_train_traces_correct] * world_size)
+        self.assertTrue(parameters_equal)
+
+    def test_inference_network_polymorph_keeps_optimizer_state(self):
+        num_traces = 512
+        batch_size = 16
+
+        inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4)
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED)
+        inference_network.optimize(num_traces, batch_generator, batch_size=batch_size, prefetch_batches=0)
+        num_params = len(list(inference_network.parameters()))
+        num_params_optimizer = sum([len(param_group['params']) for param_group in inference_network._optimizer.param_groups])
+        num_param_groups = len(inference_network._optimizer.param_groups)
+        num_proposal_layers = len(inference_network._layer_proposal)
+        num_params_with_state = len(inference_network._optimizer.state)
+        util.eval_print('num_traces', 'batch_size', 'num_params', 'num_params_optimizer', 'num_param_groups', 'num_proposal_layers', 'num_params_with_state')
+
+        self.assertEqual(num_params_optimizer, num_params)
+        self.assertGreater(num_param_groups, 1)
+        self.assertGreater(num_params_with_state, 0)
+
+    def test_inference_network_shared_proposal_trunks(self):
+        num_traces = 512
+        batch_size = 16
+
+        inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4, shared_proposal_trunks=True)
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED)
+        inference_network.optimize(num_traces, batch_generator, batch_size=batch_size, prefetch_batches=0)
+        num_proposal_layers = len(inference_network._layer_proposal)
+        num_proposal_trunks = len(inference_network._layer_proposal_trunk)
+        num_params = len(list(inference_network.parameters()))
+        num_params_optimizer = sum([len(param_group['params']) for param_group in inference_network._optimizer.param_groups])
+        loss = float(inference_network._history_train_loss[-1])
+        util.eval_print('num_traces', 'batch_size', 'num_proposal_layers', 'num_proposal_trunks', 'num_params', 'num_params_optimizer', 'loss')
+
+        self.assertGreater(num_proposal_layers, num_proposal_trunks)
+        self.assertEqual(num_params_optimizer, num_params)
+        self.assertTrue(math.isfinite(loss))
+
+    def test_inference_network_optimize_data_loader(self):
+        num_traces_per_worker = 128
+        batch_size = 16
+        num_workers = 2
+        valid_size = 4
+
+        inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=valid_size)
+        data_loader = DataLoader(TraceDataset(self._model, num_traces=num_traces_per_worker), batch_size=batch_size, num_workers=num_workers, collate_fn=collate_traces)
+        # The DataLoader is finite, training stops when it is exhausted
+        inference_network.optimize(None, data_loader)
+        num_traces = inference_network._total_train_traces
+        # The validation batch takes the first batch
+        num_traces_correct = num_traces_per_worker * num_workers - batch_size
+        loss = float(inference_network._history_train_loss[-1])
+
+        util.eval_print('num_traces_per_worker', 'batch_size', 'num_workers', 'num_traces', 'num_traces_correct', 'loss')
+
+        self.assertEqual(num_traces, num_traces_correct)
+        self.assertTrue(math.isfinite(loss))
+
+    def test_inference_network_save_background_snapshot(self):
+        num_traces = 128
+        batch_size = 16
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+
+        inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4)
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED)
+        inference_network.optimize(num_traces, batch_generator, batch_size=batch_size, prefetch_batches=0)
+        state_dict_saved = {name: tensor.clone() for name, tensor in inference_network.state_dict().items()}
+        inference_network._save(file_name, background=True)
+        # Parameters change while the checkpoint is being written
+        with torch.no_grad():
+            for parameter in inference_network.parameters():
+                parameter.add_(1.)
+        inference_network._wait_for_save()
+        inference_network_loaded = InferenceNetworkFeedForward._load(file_name)
+        os.remove(file_name)
+        state_dict_loaded = inference_network_loaded.state_dict()
+        num_tensors_saved = len(state_dict_saved)
+        num_tensors_loaded = len(state_dict_loaded)
+        snapshot_correct = all([torch.equal(state_dict_saved[name], state_dict_loaded[name]) for name in state_dict_saved])
+
+        util.eval_print('num_traces', 'batch_size', 'file_name', 'num_tensors_saved', 'num_tensors_loaded', 'snapshot_correct')
+
+        self.assertEqual(num_tensors_saved, num_tensors_loaded)
+        self.assertTrue(snapshot_correct)
+
+    def test_inference_network_load_legacy(self):
+        num_traces = 128
+        batch_size = 16
+        observe = {'obs': 3}
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+
+        inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4)
+        batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED)
+        inference_network.optimize(num_traces, batch_generator, batch_size=batch_size)
+        # A network saved by an earlier version, without shared proposal trunks and background saving, as a torch.save file inside a tar.gz archive
+        del inference_network._modules['_layer_proposal_trunk']
+        del inference_network._modules['_layer_address_embedding']
+        for name in ['_shared_proposal_trunks', '_address_embedding_dim', '_save_thread']:
+            del inference_network.__dict__[name]
+        inference_network._model = None
+        inference_network._optimizer = None
+        tmp_file_name = os.path.join(tempfile.mkdtemp(), 'pyprob_inference_network')
+        torch.save({'pyprob_version': pyprob.__version__, 'torch_version': torch.__version__, 'inference_network': inference_network}, tmp_file_name)
+        with tarfile.open(file_name, 'w:gz') as tar:
+            tar.add(tmp_file_name, arcname='pyprob_inference_network')
+        os.remove(tmp_file_name)
+
+        self._model.load_inference_network(file_name)
+        os.remove(file_name)
+        shared_proposal_trunks = self._model._inference_network._shared_proposal_trunks
+        self._model._inference_network.optimize(num_traces, batch_generator, batch_size=batch_size)
+        posterior = self._model.posterior_traces(num_traces=16, inference_engine=pyprob.InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, observe=observe)
+        total_train_traces = self._model._inference_network._total_train_traces
+        total_train_traces_correct = 2 * num_traces
+        posterior_length = posterior.length
+
+        util.eval_print('num_traces', 'batch_size', 'shared_proposal_trunks', 'total_train_traces', 'total_train_traces_correct', 'posterior_length')
+
+        self.assertFalse(shared_proposal_trunks)
+        self.assertEqual(total_train_traces, total_train_traces_correct)
+        self.assertEqual(posterior_length, 16)
+
+    def test_inference_network_metrics_file(self):
+        num_traces = 512
+        batch_size = 16
+        num_iterations_correct = num_traces // batch_size
+        history_max_length = 8
+        metrics_dir = tempfile.mkdtemp()
+
+        history_max_length_default = inference_network_feedforward._history_max_length
+        inference_network_feedforward._history_max_length = history_max_length
+        try:
+            inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4)
+            batch_generator = BatchGenerator(self._model, PriorInflation.DISABLED)
+            for file_extension in ['csv', 'jsonl']:
+                inference_network.optimize(num_traces // 2, batch_generator, batch_size=batch_size, valid_interval=64, prefetch_batches=0, metrics_file_name=os.path.join(metrics_dir, 'metrics.' + file_extension))
+        finally:
+            inference_network_feedforward._history_max_length = history_max_length_default
+        history_length = len(inference_network._history_train_loss)
+        metrics_csv = read_metrics(os.path.join(metrics_dir, 'metrics.csv'))
+        metrics_jsonl = read_metrics(os.path.join(metrics_dir, 'metrics.jsonl'))
+        num_iterations = len(metrics_csv['loss']) + len(metrics_jsonl['loss'])
+        num_valid_losses = len([v for v in metrics_csv['valid_loss'] + metrics_jsonl['valid_loss'] if v is not None])
+        traces_final = metrics_jsonl['traces'][-1]
+        train_loss_final = inference_network._history_train_loss[-1]
+        stats = network_statistics(inference_network, metrics_file_name=os.path.join(metrics_dir, 'metrics.jsonl'))
+        stats_train_loss_final = stats['train_loss_final']
+        shutil.rmtree(metrics_dir)
+
+        util.eval_print('num_traces', 'batch_size', 'history_max_length', 'history_length', 'num_iterations', 'num_iterations_correct', 'num_valid_losses', 'traces_final', 'train_loss_final', 'stats_train_loss_final')
+
+        self.assertLessEqual(history_length, history_max_length)
+        self.assertEqual(num_iterations, num_iterations_correct)
+        self.assertGreater(num_valid_losses, 1)
+        self.assertEqual(traces_final, num_traces)
+        self.assertAlmostEqual(stats_train_loss_final, train_loss_final, places=5)
+
+    def test_inference_network_metrics_file_empty_cells(self):
+        metrics_dir = tempfile.mkdtemp()
+        metrics_file_name = os.path.join(metrics_dir, 'metrics.jsonl')
+
+        inference_network = InferenceNetworkFeedForward(model=self._model, observe_embeddings={'obs': {'dim': 8}}, valid_size=4)
+        inference_network.optimize(64, BatchGenerator(self._model, PriorInflation.DISABLED), batch_size=16)
+        # Rows of a resumed run, without validation entries and with empty cells
+        metrics_writer = MetricsWriter(metrics_file_name)
+        metrics_writer.write(time_sec=1., traces=16, iteration=1, loss=2., traces_per_sec=16., num_params=100)
+        metrics_writer.write(time_sec=2., traces=32, iteration=2, loss=1.5, traces_per_sec=16., batch_wait_sec=0.5, sub_batches=1, sub_batch_size_mean=16., num_params=100)
+        metrics_writer.close()
+        with self.assertRaises(RuntimeError):
+            network_statistics(inference_network, metrics_file_name=metrics_file_name)
+        metrics_writer = MetricsWriter(metrics_file_name)
+        metrics_writer.write(time_sec=3., traces=48, iteration=3, loss=1., valid_loss=1.25, num_params=100)
+        metrics_writer.close()
+        stats = network_statistics(inference_network, metrics_file_name=metrics_file_name)
+        shutil.rmtree(metrics_dir)
+        train_loss_final = stats['train_loss_final']
+        valid_loss_final = stats['valid_loss_final']
+        batch_wait_sec_total = stats['batch_wait_sec_total']
+        sub_batch_size_mean = stats['sub_batch_size_mean']
+
+        util.eval_print('train_loss_final', 'valid_loss_final', 'batch_wait_sec_total', 'sub_batch_size_mean')
+
+        self.assertEqual(train_loss_final, 1.)
+        self.assertEqual(valid_loss_final, 1.25)
+        self.assertEqual(batch_wait_sec_total, 0.5)
+        self.assertEqual(sub_batch_size_mean, 16.)
+
+
 if __name__ == '__main__':
     pyprob.set_random_seed(123)
     pyprob.set_verbosity(1)
@@ -1,4 +1,6 @@
 import unittest
+import torch
+import time
 
 import pyprob
 from pyprob import util, state, Model
@@ -75,6 +77,231 @@ class PriorInflationTestCase(unittest.TestCase):
         self.assertAlmostEqual(normal_prior_inflated_stddev, normal_prior_inflated_stddev_correct, places=0)
 
 
+class FastInferenceTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class GaussianModel(Model):
+            def __init__(self):
+                super().__init__('Gaussian model')
+
+            def forward(self):
+                mu = pyprob.sample(Normal(1., 2.))
+                pyprob.observe(Normal(mu, 1.), name='obs')
+                return mu
+
+        self._model = GaussianModel()
+        super().__init__(*args, **kwargs)
+
+    def test_fast_inference_prior(self):
+        samples = 5000
+        prior_mean_correct = 1.
+        prior_stddev_correct = 2.
+
+        pyprob.set_fast_inference(True)
+        prior_traces = self._model.prior_traces(samples)
+        pyprob.set_fast_inference(False)
+        prior = prior_traces.map(lambda trace: trace.result)
+        prior_mean = float(prior.mean)
+        prior_stddev = float(prior.stddev)
+        trace = prior_traces[0]
+        variable = trace.variables_controlled[0]
+        variable_log_prob = float(variable.log_prob)
+        variable_log_prob_correct = float(variable.distribution.log_prob(variable.value))
+        requires_grad = variable.log_prob.requires_grad
+
+        util.eval_print('samples', 'prior_mean', 'prior_mean_correct', 'prior_stddev', 'prior_stddev_correct', 'variable_log_prob', 'variable_log_prob_correct', 'requires_grad')
+
+        self.assertAlmostEqual(prior_mean, prior_mean_correct, places=0)
+        self.assertAlmostEqual(prior_stddev, prior_stddev_correct, places=0)
+        self.assertAlmostEqual(variable_log_prob, variable_log_prob_correct, places=5)
+        self.assertFalse(requires_grad)
+
+    def test_fast_inference_importance_sampling(self):
+        samples = 10
+
+        pyprob.set_fast_inference(True)
+        posterior_traces = self._model.posterior_traces(samples, observe={'obs': 2.})
+        pyprob.set_fast_inference(False)
+        trace = posterior_traces[0]
+        log_importance_weight = trace.log_importance_weight
+        log_importance_weight_correct = float(trace.variables_observed[0].log_prob)
+
+        util.eval_print('samples', 'log_importance_weight', 'log_importance_weight_correct')
+
+        self.assertIsInstance(log_importance_weight, float)
+        self.assertAlmostEqual(log_importance_weight, log_importance_weight_correct, places=5)
+
+    def test_fast_inference_disabled_keeps_no_grad(self):
+        class GradModeModel(Model):
+            def __init__(self):
+                super().__init__('Grad mode model')
+
+            def forward(self):
+                pyprob.sample(Normal(1., 2.))
+                return torch.is_grad_enabled()
+
+        model = GradModeModel()
+        with torch.no_grad():
+            grad_enabled = model.prior_traces(1)[0].result
+        grad_enabled_correct = False
+
+        util.eval_print('grad_enabled', 'grad_enabled_correct')
+
+        self.assertEqual(grad_enabled, grad_enabled_correct)
+
+
+class PlateTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class PlateModel(Model):
+            def __init__(self):
+                super().__init__('Plate model')
+
+            def forward(self):
+                mu = pyprob.sample(Normal(0., 2.))
+                noise = pyprob.sample(Normal(0., 1.), size=5)
+                c = pyprob.sample(Categorical([0.2, 0.8]), size=3)
+                pyprob.observe(Normal(mu, 1.), size=100, name='obs')
+                return mu, noise, c
+
+        self._model = PlateModel()
+        super().__init__(*args, **kwargs)
+
+    def test_plate_sample_observe(self):
+        controlled_correct = 3
+        observed_correct = 1
+        noise_shape_correct = torch.Size([5])
+        c_shape_correct = torch.Size([3])
+        obs_shape_correct = torch.Size([100])
+
+        trace = self._model.prior_traces(1)[0]
+        controlled = len(trace.variables_controlled)
+        observed = len(trace.variables_observed)
+        mu, noise, c = trace.result
+        noise_shape = noise.size()
+        c_shape = c.size()
+        obs = trace.named_variables['obs']
+        obs_shape = obs.value.size()
+        obs_log_prob = float(obs.log_prob)
+        obs_log_prob_correct = float(sum([Normal(mu, 1.).log_prob(v) for v in obs.value]))
+
+        util.eval_print('controlled', 'controlled_correct', 'observed', 'observed_correct', 'noise_shape', 'noise_shape_correct', 'c_shape', 'c_shape_correct', 'obs_shape', 'obs_shape_correct', 'obs_log_prob', 'obs_log_prob_correct')
+
+        self.assertEqual(controlled, controlled_correct)
+        self.assertEqual(observed, observed_correct)
+        self.assertEqual(noise_shape, noise_shape_correct)
+        self.assertEqual(c_shape, c_shape_correct)
+        self.assertEqual(obs_shape, obs_shape_correct)
+        self.assertAlmostEqual(obs_log_prob, obs_log_prob_correct, places=2)
+
+    def test_plate_importance_sampling(self):
+        samples = 5000
+        observation = Normal(1., 1.).sample() + torch.zeros(100)
+        # Conjugate Gaussian: prior variance 4, likelihood variance 1, 100 observations
+        posterior_mean_correct = float(observation.sum()) / (100 + 1 / 4)
+
+        posterior = self._model.posterior_distribution(samples, observe={'obs': observation}).map(lambda x: x[0])
+        posterior_mean = float(posterior.mean)
+
+        util.eval_print('samples', 'posterior_mean', 'posterior_mean_correct')
+
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, places=0)
+
+    def test_plate_inference_network(self):
+        training_traces = 128
+        samples = 10
+        observation = torch.zeros(100)
+
+        self._model.learn_inference_network(num_traces=training_traces, observe_embeddings={'obs': {'dim': 16}})
+        posterior = self._model.posterior_traces(samples, inference_engine=pyprob.InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, observe={'obs': observation})
+        noise_shape = posterior[0].result[1].size()
+        noise_shape_correct = torch.Size([5])
+
+        util.eval_print('training_traces', 'samples', 'noise_shape', 'noise_shape_correct')
+
+        self.assertEqual(noise_shape, noise_shape_correct)
+
+
+
+class TraceBudgetTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class GeometricModel(Model):
+            def __init__(self):
+                super().__init__('Geometric model')
+
+            def forward(self):
+                num_steps = 1
+                while float(pyprob.sample(Categorical([0.2, 0.8]))) == 1:
+                    num_steps += 1
+                return num_steps
+
+        class RunawayModel(Model):
+            def __init__(self):
+                super().__init__('Runaway model')
+
+            def forward(self):
+                num_steps = 1
+                if float(pyprob.sample(Categorical([0.5, 0.5]))) == 1:
+                    while True:
+                        time.sleep(0.001)
+                        pyprob.sample(Normal(0., 1.))
+                        num_steps += 1
+                return num_steps
+
+        self._geometric_model = GeometricModel()
+        self._runaway_model = RunawayModel()
+        super().__init__(*args, **kwargs)
+
+    def test_trace_budget_num_samples(self):
+        num_traces = 200
+        trace_sample_budget = 4
+
+        pyprob.set_trace_budget(num_samples=trace_sample_budget)
+        try:
+            prior = self._geometric_model.prior_traces(num_traces)
+        finally:
+            pyprob.set_trace_budget()
+        trace_length_max = max([trace.length for trace in prior.get_values()])
+        num_traces_rejected = self._geometric_model._num_traces_rejected
+        util.eval_print('num_traces', 'trace_sample_budget', 'trace_length_max', 'num_traces_rejected')
+
+        self.assertEqual(prior.length, num_traces)
+        self.assertLessEqual(trace_length_max, trace_sample_budget)
+        self.assertGreater(num_traces_rejected, 0)
+
+    def test_trace_budget_time(self):
+        num_traces = 20
+        trace_time_budget_sec = 0.05
+        result_correct = 1
+
+        pyprob.set_trace_budget(time_sec=trace_time_budget_sec)
+        try:
+            prior = self._runaway_model.prior_distribution(num_traces)
+        finally:
+            pyprob.set_trace_budget()
+        results = prior.get_values()
+        num_traces_rejected = self._runaway_model._num_traces_rejected
+        util.eval_print('num_traces', 'trace_time_budget_sec', 'num_traces_rejected')
+
+        self.assertEqual(results, [result_correct] * num_traces)
+        self.assertGreater(num_traces_rejected, 0)
+
+    def test_trace_budget_max_consecutive_rejections(self):
+        num_traces = 10
+        trace_sample_budget = 0
+        max_consecutive_rejections = 20
+
+        # Every trace of the geometric model makes at least one sample statement and exceeds the budget
+        pyprob.set_trace_budget(num_samples=trace_sample_budget, max_consecutive_rejections=max_consecutive_rejections)
+        try:
+            with self.assertRaises(RuntimeError):
+                self._geometric_model.prior_traces(num_traces)
+        finally:
+            pyprob.set_trace_budget()
+        num_traces_rejected = self._geometric_model._num_traces_rejected
+        util.eval_print('num_traces', 'trace_sample_budget', 'max_consecutive_rejections', 'num_traces_rejected')
+
+        self.assertEqual(num_traces_rejected, max_consecutive_rejections)
+
+
 if __name__ == '__main__':
     pyprob.set_random_seed(123)
     pyprob.set_verbosity(1)
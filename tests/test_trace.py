@@ -1,4 +1,5 @@
 import unittest
+import pickle
 import shutil
 import tempfile
 
@@ -49,6 +50,28 @@ class TraceTestCase(unittest.TestCase):
         self.assertEqual(observed, observed_correct)
         self.assertTrue(observed_val)
 
+    def test_trace_unpickle_legacy(self):
+        trace = self._model._traces(1)[0]
+        log_prob_correct = float(trace.log_prob)
+        log_prob_observed_correct = float(trace.log_prob_observed)
+        variable_log_prob_correct = float(trace.variables[0].log_prob)
+
+        # Traces and variables pickled before log_prob was computed lazily have log_prob in their __dict__
+        trace.__dict__['log_prob'] = trace.__dict__.pop('_log_prob')
+        trace.__dict__['log_prob_observed'] = trace.__dict__.pop('_log_prob_observed')
+        for variable in trace.variables:
+            variable.__dict__['log_prob'] = variable.__dict__.pop('_log_prob')
+        trace = pickle.loads(pickle.dumps(trace))
+        log_prob = float(trace.log_prob)
+        log_prob_observed = float(trace.log_prob_observed)
+        variable_log_prob = float(trace.variables[0].log_prob)
+
+        util.eval_print('log_prob', 'log_prob_correct', 'log_prob_observed', 'log_prob_observed_correct', 'variable_log_prob', 'variable_log_prob_correct')
+
+        self.assertEqual(log_prob, log_prob_correct)
+        self.assertEqual(log_prob_observed, log_prob_observed_correct)
+        self.assertEqual(variable_log_prob, variable_log_prob_correct)
+
 
 if __name__ == '__main__':
     pyprob.set_random_seed(123)
@@ -1,4 +1,5 @@
 import unittest
+import torch
 
 import pyprob
 from pyprob import util
@@ -29,6 +30,22 @@ class UtilTestCase(unittest.TestCase):
         self.assertTrue(not all(sample == stochastic_samples[0] for sample in stochastic_samples))
         self.assertTrue(all(sample == deterministic_samples[0] for sample in deterministic_samples))
 
+    def test_to_tensor_copy(self):
+        value = torch.ones(3, requires_grad=True)
+        value_tensor = util.to_tensor(value)
+        value_tensor[0] = 2
+        dist = pyprob.distributions.Normal(value * 2, 1)
+        dist.log_prob(0, sum=True).backward()
+
+        value_tensor_requires_grad = value_tensor.requires_grad
+        value_grad = value.grad
+
+        util.eval_print('value', 'value_tensor', 'value_tensor_requires_grad', 'value_grad')
+        # to_tensor returns a detached copy, while distribution parameters stay in the autograd graph
+        self.assertFalse(value_tensor_requires_grad)
+        self.assertEqual(float(value[0]), 1)
+        self.assertIsNotNone(value_grad)
+
 
 if __name__ == '__main__':
     pyprob.set_random_seed(123)